@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the CPU spent encoding one notification on its way to the websocket clients.
+
+The "double" path is the former one : the content is JSON encoded into a string by the writer,
+the channel layer msgpack-encodes the message, and the consumer JSON-encodes the whole message
+again. The "single" path encodes the content once and the consumer sends the text as is.
+The channel layer stage is reported apart as it is paid by both paths (and is slow when msgpack
+runs without its C extension).
+
+Run it from the repository root with :
+
+    python -m benchmarks.encoding [--number 100000] [--connections 1]
+"""
+import argparse
+import json
+import timeit
+from time import time
+
+import msgpack
+
+from generic import encoding
+
+CONTENT = {
+    "id": 123456,
+    "quantity": 1500.0,
+    "initial_price": 99.75,
+    "instrument": "BNP",
+    "type": "data.update",
+    "time": time(),
+}
+
+
+def double_encoding():
+    message = {"type": "data.send", "content": json.dumps(CONTENT)}
+    return (
+        # Writer
+        lambda: {"type": "data.send", "content": json.dumps(CONTENT)},
+        # Channel layer
+        lambda: msgpack.unpackb(msgpack.packb(message, use_bin_type=True), raw=False),
+        # Consumer send_json, the message is already decoded by the layer
+        lambda: json.dumps(message),
+    )
+
+
+def single_encoding():
+    message = {"type": "data.send", "items": [[CONTENT["id"], CONTENT["type"], encoding.dumps(CONTENT), 1]]}
+    return (
+        # Writer
+        lambda: {"type": "data.send", "items": [[CONTENT["id"], CONTENT["type"], encoding.dumps(CONTENT), 1]]},
+        # Channel layer
+        lambda: msgpack.unpackb(msgpack.packb(message, use_bin_type=True), raw=False),
+        # Consumer send(text_data=...), the message is already decoded by the layer
+        lambda: encoding.join([item[2] for item in message["items"]]),
+    )
+
+
+def measure(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def run(number, connections):
+    """
+    Returns the microseconds spent per message in each stage of both paths. The consumer
+    stage is paid once per receiving connection.
+    """
+    results = {}
+    for name, path in (("double", double_encoding), ("single", single_encoding)):
+        writer, layer, consumer = path()
+        results[name] = {
+            "writer": measure(writer, number),
+            "layer": measure(layer, number),
+            "consumer": measure(consumer, number) * connections,
+        }
+        results[name]["total"] = sum(results[name].values())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=100000, help="Messages per measure")
+    parser.add_argument("--connections", type=int, default=1, help="Connections receiving each message")
+    args = parser.parse_args()
+
+    results = run(args.number, args.connections)
+    print("Encoder : {}, msgpack : {}".format(
+        "orjson" if encoding.orjson is not None else "json", msgpack.Packer.__module__))
+    print("{:<8} {:>10} {:>10} {:>10} {:>10}  (us/message)".format("path", "writer", "layer", "consumer", "total"))
+    for name, stages in results.items():
+        print("{:<8} {writer:10.2f} {layer:10.2f} {consumer:10.2f} {total:10.2f}".format(name, **stages))
+    for stage in ("writer", "consumer", "total"):
+        print("Saving on {:<8} {:6.1f} %".format(
+            stage, (1 - results["single"][stage] / results["double"][stage]) * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Latency of the group messages through the Redis channel layer and through the HybridChannelLayer.
+
+A group has two subscribers : one co-located with the sender, in the same process (the sender
+is a thread with its own event loop, as the dispatcher of the notifications), and one remote, in
+another process. For each layer the sender sends the messages to the group one by one and the
+report holds the time from the group_send to the reception (p50, p99) of each subscriber :
+
+    redis  : channels_redis.core.RedisChannelLayer
+    hybrid : generic.layers.HybridChannelLayer over the same Redis
+
+Run it from the repository root with :
+
+    python -m benchmarks.hybrid_layer [--redis localhost:6379] [--number 2000] [--interval 1]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import threading
+from time import sleep, time
+
+import django
+import numpy as np
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webapp.settings")
+
+# Room for the messages received late by a slow subscriber
+CAPACITY = 100000
+
+
+def layer_configs(redis):
+    host, _, port = redis.partition(":")
+    remote = {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {"hosts": [(host, int(port or 6379))], "capacity": CAPACITY},
+    }
+    return {
+        "redis": remote,
+        "hybrid": {"BACKEND": "generic.layers.HybridChannelLayer",
+                   "CONFIG": {"remote": remote, "capacity": CAPACITY}},
+    }
+
+
+def make_layer(config):
+    from django.utils.module_loading import import_string
+
+    return import_string(config["BACKEND"])(**config.get("CONFIG", {}))
+
+
+async def subscribe(layer, group, number, ready):
+    """
+    Receives number messages of the group, returns their latencies in milliseconds.
+    """
+    channel = await layer.new_channel()
+    await layer.group_add(group, channel)
+    ready()
+    latencies = []
+    while len(latencies) < number:
+        message = await layer.receive(channel)
+        latencies.append((time() - message["time"]) * 1000)
+    await layer.group_discard(group, channel)
+    return latencies
+
+
+def remote_subscriber(config, group, number, ready, results):
+    django.setup()
+    results.put(asyncio.run(subscribe(make_layer(config), group, number, ready.set)))
+
+
+def send(layer, group, number, interval):
+    async def run():
+        for i in range(number):
+            await layer.group_send(group, {"type": "bench.message", "number": i, "time": time()})
+            await asyncio.sleep(interval)
+
+    asyncio.run(run())
+
+
+def measure(config, group, number, interval):
+    context = multiprocessing.get_context("spawn")
+    ready, results = context.Event(), context.Queue()
+    process = context.Process(target=remote_subscriber, args=(config, group, number, ready, results), daemon=True)
+    process.start()
+    layer = make_layer(config)
+
+    async def run():
+        local_ready = asyncio.Event()
+        receiver = asyncio.ensure_future(subscribe(layer, group, number, local_ready.set))
+        await local_ready.wait()
+        await asyncio.get_event_loop().run_in_executor(None, ready.wait)
+        # The sender is another thread of the process, with its own event loop
+        sender = threading.Thread(target=send, args=(layer, group, number, interval))
+        sender.start()
+        latencies = await receiver
+        sender.join()
+        return latencies
+
+    local = asyncio.run(run())
+    remote = results.get()
+    process.join()
+    return local, remote
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis", default="localhost:6379", help="host:port of the Redis server")
+    parser.add_argument("--number", type=int, default=2000, help="messages sent per layer")
+    parser.add_argument("--interval", type=float, default=1, help="milliseconds between two messages")
+    args = parser.parse_args()
+    django.setup()
+
+    print("{:<10}{:>16}{:>16}{:>16}{:>16}".format(
+        "layer", "local p50 ms", "local p99 ms", "remote p50 ms", "remote p99 ms"))
+    for name, config in layer_configs(args.redis).items():
+        local, remote = measure(config, "benchmark_{}_{}".format(name, os.getpid()), args.number, args.interval / 1000)
+        print("{:<10}{:>16.3f}{:>16.3f}{:>16.3f}{:>16.3f}".format(
+            name, *np.percentile(local, [50, 99]), *np.percentile(remote, [50, 99])))
+        # Lets the subscribers of the previous layer leave
+        sleep(0.5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Load test of the websocket fan-out and of the REST writes.
+
+N DataConsumer clients (WebsocketCommunicator, spread over the users) subscribe to the realtime
+updates while orders are created through /api/data/ at the given rate. The report holds :
+
+    latency  : time from the notification built by the save to its reception by a client (p50, p99)
+    messages : notifications received per second by all the clients
+    rest     : orders created per second and duration of the POST requests (p50, p99)
+    memory   : Python memory allocated per connected and subscribed client
+    frames   : bytes received per notification, and time spent encoding a frame by the consumers
+
+The clients ask for the frame format given by --format (json or msgpack), compressed with --compress.
+
+The database is a new SQLite file and the channel layer the in memory one, or Redis with --redis.
+The results are saved as JSON, and compared to a previous run with --compare.
+
+Run it from the repository root with :
+
+    python -m benchmarks.load [--clients 100] [--users 10] [--rate 50] [--duration 10]
+                              [--format msgpack] [--compress]
+                              [--redis localhost:6379] [--output load.json] [--compare previous.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import tracemalloc
+import zlib
+from time import monotonic, time
+
+import django
+import msgpack
+import numpy as np
+from django.conf import settings
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webapp.settings")
+
+# Results compared by --compare, and whether a higher value is better
+COMPARED = {
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "messages_per_second": True,
+    "writes_per_second": True,
+    "rest_p50_ms": False,
+    "rest_p99_ms": False,
+    "memory_per_connection_kb": False,
+    "bytes_per_message": False,
+    "encode_us_per_frame": False,
+}
+
+
+def configure(redis):
+    if redis:
+        host, _, port = redis.partition(":")
+        settings.CHANNEL_LAYERS = {"default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [(host, int(port or 6379))]},
+        }}
+    else:
+        settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+        # The in memory channel layer can only be used from the event loop of the clients
+        settings.DATA_DISPATCH = dict(settings.DATA_DISPATCH, BACKGROUND=False)
+    settings.DATABASES["default"]["ENGINE"] = "django.db.backends.sqlite3"
+    # Host of the requests made by the test clients
+    settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ["testserver"]
+    django.setup()
+    logging.getLogger("generic").setLevel(logging.WARNING)
+
+
+def create_users(count):
+    """
+    Returns the users, with their session cookie.
+    """
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.models import Permission
+    from django.test import Client
+
+    users = []
+    for i in range(count):
+        user = get_user_model().objects.create_user(username="load{}".format(i), password="load")
+        user.user_permissions.set(Permission.objects.filter(codename__in=("add_data", "view_data")))
+        client = Client()
+        client.force_login(user)
+        users.append((user, client.cookies["sessionid"].value))
+    return users
+
+
+def percentiles(values):
+    if not values:
+        return None, None
+    p50, p99 = np.percentile(values, [50, 99]) * 1000
+    return round(float(p50), 3), round(float(p99), 3)
+
+
+class StreamClient:
+    """
+    Websocket client counting the notifications it receives, their latency and the bytes of their frames.
+    """
+
+    def __init__(self, session, frame_format="json", compress=False):
+        from channels.testing import WebsocketCommunicator
+        from webapp.routing import application
+
+        self.frame_format = frame_format
+        self.subprotocol = frame_format + ("+deflate" if compress else "")
+        self.communicator = WebsocketCommunicator(
+            application, "/data/stream/", headers=[(b"cookie", "sessionid={}".format(session).encode())],
+            subprotocols=[self.subprotocol],
+        )
+        self.latencies = []
+        self.bytes = 0
+        self.task = None
+
+    async def start(self):
+        connected, subprotocol = await self.communicator.connect()
+        assert connected, "Connection refused"
+        assert subprotocol == self.subprotocol, subprotocol
+        await self.communicator.send_json_to({"command": "subscribe"})
+        response = self.decode(await self.communicator.receive_output(timeout=10))
+        assert response.get("status") == "ok", response
+        self.task = asyncio.ensure_future(self.receive())
+
+    def decode(self, message):
+        """
+        Returns the content of a frame : JSON text, MessagePack or zlib compressed binary.
+        """
+        if message.get("text") is not None:
+            return json.loads(message["text"])
+        data = message["bytes"]
+        if data[0] == 0x78:
+            data = zlib.decompress(data)
+            if self.frame_format == "json":
+                return json.loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+    async def receive(self):
+        while True:
+            # No timeout, it would stop the consumer
+            message = await self.communicator.receive_output(timeout=None)
+            if message["type"] != "websocket.send":
+                return
+            received = time()
+            self.bytes += len(message["bytes"]) if message.get("text") is None else len(message["text"].encode())
+            notifications = self.decode(message)
+            if isinstance(notifications, dict):
+                notifications = [notifications]
+            self.latencies.extend(received - notification["time"] for notification in notifications)
+
+    async def stop(self):
+        self.task.cancel()
+        await self.communicator.disconnect()
+
+
+def post_order(user, i):
+    from rest_framework.test import APIClient
+
+    client = APIClient()
+    client.force_authenticate(user=user)
+    start = monotonic()
+    response = client.post("/api/data/", {
+        "instrument": "BNP", "quantity": i, "initial_price": 1.5, "user": user.id,
+    }, format="json")
+    assert response.status_code == 201, response.content
+    return monotonic() - start
+
+
+async def drive(users, rate, duration):
+    """
+    Creates the orders at the rate for the duration, returns the durations of the requests.
+    """
+    from asgiref.sync import sync_to_async
+
+    post = sync_to_async(post_order, thread_sensitive=False)
+    requests = []
+    start = monotonic()
+    for i in range(int(rate * duration)):
+        delay = start + i / rate - monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        requests.append(asyncio.ensure_future(post(users[i % len(users)][0], i)))
+    return await asyncio.gather(*requests)
+
+
+async def run(args, users):
+    from generic.encoding import encode_seconds
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    clients = [StreamClient(users[i % len(users)][1], args.format, args.compress) for i in range(args.clients)]
+    for client in clients:
+        await client.start()
+    memory = (tracemalloc.get_traced_memory()[0] - before) / args.clients
+    tracemalloc.stop()
+
+    encoded = encode_seconds.value
+    start = monotonic()
+    durations = await drive(users, args.rate, args.duration)
+    elapsed = monotonic() - start
+    # The last notifications on their way
+    await asyncio.sleep(args.drain)
+    for client in clients:
+        await client.stop()
+
+    frames = encode_seconds.value["count"] - encoded["count"]
+    encode_time = encode_seconds.value["sum"] - encoded["sum"]
+    latencies = [latency for client in clients for latency in client.latencies]
+    latency_p50, latency_p99 = percentiles(latencies)
+    rest_p50, rest_p99 = percentiles(durations)
+    return {
+        "latency_p50_ms": latency_p50,
+        "latency_p99_ms": latency_p99,
+        "messages": len(latencies),
+        "messages_expected": len(durations) * args.clients // len(users),
+        "messages_per_second": round(len(latencies) / elapsed, 1),
+        "writes_per_second": round(len(durations) / elapsed, 1),
+        "rest_p50_ms": rest_p50,
+        "rest_p99_ms": rest_p99,
+        "memory_per_connection_kb": round(memory / 1024, 1),
+        "bytes_per_message": round(sum(client.bytes for client in clients) / len(latencies), 1) if latencies else None,
+        "encode_us_per_frame": round(encode_time / frames * 1e6, 2) if frames else None,
+    }
+
+
+def compare(results, previous):
+    print("{:<28}{:>12}{:>12}{:>10}".format("", "previous", "current", "change"))
+    for name, higher_is_better in COMPARED.items():
+        old, new = previous["results"].get(name), results["results"].get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        worse = change < 0 if higher_is_better else change > 0
+        print("{:<28}{:>12}{:>12}{:>9.1f}%{}".format(name, old, new, change, " (worse)" if worse else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=100, help="websocket clients")
+    parser.add_argument("--users", type=int, default=10, help="users the clients and the orders are spread over")
+    parser.add_argument("--rate", type=float, default=50, help="orders created per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds the orders are created")
+    parser.add_argument("--drain", type=float, default=1, help="seconds waited for the last notifications")
+    parser.add_argument("--format", choices=("json", "msgpack"), default="json", help="format of the frames")
+    parser.add_argument("--compress", action="store_true", help="compress the large frames")
+    parser.add_argument("--redis", help="host:port of the Redis channel layer, the in memory one by default")
+    parser.add_argument("--output", help="JSON file the results are saved to")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    args = parser.parse_args()
+    args.users = min(args.users, args.clients)
+
+    configure(args.redis)
+    from django.core.management import call_command
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings.DATABASES["default"]["NAME"] = os.path.join(directory, "load.sqlite3")
+        call_command("migrate", verbosity=0)
+        users = create_users(args.users)
+        results = {
+            "parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+            "environment": {"python": platform.python_version(), "django": django.get_version(),
+                            "machine": platform.machine(), "time": time()},
+            "results": asyncio.get_event_loop().run_until_complete(run(args, users)),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+    print(json.dumps(results["results"], indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+
+if __name__ == "__main__":
+    main()
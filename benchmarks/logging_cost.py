@@ -0,0 +1,114 @@
+"""
+Micro-benchmark of the cost of the logging in DataConsumer.data_send, per notification received.
+
+The consumer handles "data.send" messages of one notification, with its send stubbed out, under
+the logging setups (the frames are sent by its writer task between the measured chunks of
+messages, so the queue stays below the HIGH_WATER_MARK of the slow connections) :
+
+    off     : the generic loggers at INFO, the per-message events are not enabled
+    file    : DEBUG, every event formatted and written to a file by the calling thread
+    queue   : DEBUG, every event handed to the QueueHandler, written by its listener thread
+    sampled : DEBUG, the QueueHandler and the default sampling (one event in SAMPLE_RATE)
+
+Run it from the repository root with :
+
+    python -m benchmarks.logging_cost [--number 20000]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+from time import perf_counter, time
+from types import SimpleNamespace
+
+import django
+from django.conf import settings
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webapp.settings")
+
+
+def consumer():
+    from generic.consumers import DataConsumer
+
+    class Consumer(DataConsumer):
+        async def send(self, text_data=None, bytes_data=None, close=False):
+            pass
+
+    return Consumer({"type": "websocket", "user": SimpleNamespace(id=1), "path": "/data/stream/"})
+
+
+def message(i):
+    from generic import encoding
+
+    content = {"id": i, "version": 1, "quantity": 1500.0, "initial_price": 99.75, "instrument": "BNP",
+               "type": "data.update", "time": time()}
+    route = {"instrument": "BNP", "quantity": 1500.0, "initial_price": 99.75, "version": 1}
+    return {"type": "data.send", "items": [[i, "data.update", encoding.dumps(content), i, route]], "time": time()}
+
+
+def measure(number):
+    instance = consumer()
+    messages = [message(i) for i in range(number)]
+    chunk = max(instance.high_water_mark // 2, 1)
+
+    async def run():
+        elapsed = 0
+        for start in range(0, number, chunk):
+            begin = perf_counter()
+            for item in messages[start:start + chunk]:
+                await instance.data_send(item)
+            elapsed += perf_counter() - begin
+            # Drained by the writer task, out of the measure
+            while instance.writer_task is not None:
+                await asyncio.sleep(0)
+        return elapsed
+
+    return asyncio.get_event_loop().run_until_complete(run()) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="notifications per setup")
+    args = parser.parse_args()
+
+    # The handlers are set up by each setup
+    settings.LOGGING = {"version": 1, "disable_existing_loggers": False}
+    django.setup()
+    from generic import log
+
+    logger = logging.getLogger("generic")
+    logger.propagate = False
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    directory = tempfile.mkdtemp()
+
+    def file_handler(name):
+        handler = logging.FileHandler(os.path.join(directory, name + ".log"))
+        handler.setFormatter(formatter)
+        return handler
+
+    def queue_handler(name):
+        handler = log.QueueHandler(targets=[{"class": "logging.FileHandler",
+                                             "filename": os.path.join(directory, name + ".log")}])
+        handler.setFormatter(formatter)
+        return handler
+
+    setups = (
+        ("off", logging.INFO, file_handler, 1),
+        ("file", logging.DEBUG, file_handler, 1),
+        ("queue", logging.DEBUG, queue_handler, 1),
+        ("sampled", logging.DEBUG, queue_handler, log.DEFAULTS["SAMPLE_RATE"]),
+    )
+    print("{:<10}{:>16}".format("logging", "us/message"))
+    for name, level, handler_factory, sample_rate in setups:
+        handler = handler_factory(name)
+        logger.handlers = [handler]
+        logger.setLevel(level)
+        settings.DATA_LOGGING = {"SAMPLE_RATE": sample_rate}
+        print("{:<10}{:>16.2f}".format(name, measure(args.number)))
+        logger.handlers = []
+        handler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Throughput of the orders written to SQLite by concurrent threads, with readers listing them.
+
+Three setups are measured, each on a new database file :
+
+    default : the SQLite defaults (rollback journal, full sync), one insert per transaction
+    profile : the DATA_SQLITE profile pragmas (WAL, synchronous=NORMAL, busy timeout)
+    batched : the profile pragmas and the single writer thread batching the inserts
+
+The "database is locked" errors are counted, the failed writes are not retried.
+
+Run it from the repository root with :
+
+    python -m benchmarks.sqlite_writes [--threads 32] [--readers 2] [--duration 5]
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from time import monotonic
+
+import django
+from django.conf import settings
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webapp.settings")
+
+SETUPS = {
+    "default": {"ENABLED": False},
+    "profile": {"ENABLED": True, "BATCH_WINDOW": 0},
+    "batched": {"ENABLED": True, "BATCH_WINDOW": 5},
+}
+
+
+def setup(directory, name, config):
+    """
+    Points the default database to a new file and migrates it.
+    """
+    from django.core.management import call_command
+    from django.db import connections
+
+    connections.close_all()
+    settings.DATABASES["default"]["NAME"] = os.path.join(directory, name + ".sqlite3")
+    settings.DATA_SQLITE = config
+    call_command("migrate", verbosity=0)
+    connections.close_all()
+
+
+def run(duration, threads, readers):
+    from django.contrib.auth import get_user_model
+    from django.db import OperationalError, close_old_connections, connections
+
+    from generic import sqlite
+    from generic.models import Data
+
+    user = get_user_model().objects.create_user(username="benchmark", password="benchmark")
+    counts = {"writes": 0, "reads": 0, "locked": 0}
+    lock = threading.Lock()
+    stop = monotonic() + duration
+
+    def count(name):
+        with lock:
+            counts[name] += 1
+
+    def write():
+        close_old_connections()
+        try:
+            i = 0
+            while monotonic() < stop:
+                fields = {"instrument": "BNP", "quantity": i, "initial_price": 1.5, "user": user}
+                try:
+                    if sqlite.batching_enabled():
+                        sqlite.get_batch_writer().create(**fields).result(sqlite.WRITE_TIMEOUT)
+                    else:
+                        Data.objects.create(**fields)
+                except OperationalError as e:
+                    if "locked" not in str(e):
+                        raise
+                    count("locked")
+                else:
+                    count("writes")
+                i += 1
+        finally:
+            connections.close_all()
+
+    def read():
+        close_old_connections()
+        try:
+            while monotonic() < stop:
+                try:
+                    queryset = Data.objects.filter(user=user)
+                    queryset.count()
+                    list(queryset.order_by("-id")[:10])
+                except OperationalError as e:
+                    if "locked" not in str(e):
+                        raise
+                    count("locked")
+                else:
+                    count("reads")
+        finally:
+            connections.close_all()
+
+    workers = [threading.Thread(target=write) for _ in range(threads)]
+    workers += [threading.Thread(target=read) for _ in range(readers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    sqlite.reset_batch_writer()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32, help="writing threads")
+    parser.add_argument("--readers", type=int, default=2, help="reading threads")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds each setup runs")
+    args = parser.parse_args()
+
+    settings.DATABASES["default"]["ENGINE"] = "django.db.backends.sqlite3"
+    # The notifications are sent to the processes of the benchmark only
+    settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    django.setup()
+    logging.getLogger("generic").setLevel(logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        print("{:<10}{:>12}{:>12}{:>10}".format("setup", "writes/s", "reads/s", "locked"))
+        for name, config in SETUPS.items():
+            setup(directory, name, config)
+            counts = run(args.duration, args.threads, args.readers)
+            print("{:<10}{:>12.0f}{:>12.0f}{:>10}".format(
+                name, counts["writes"] / args.duration, counts["reads"] / args.duration, counts["locked"]
+            ))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
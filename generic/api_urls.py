@@ -3,3 +3,4 @@ from . import api_views
 
 router = routers.DefaultRouter()
 router.register(r'data', api_views.DataViewSet, basename='data')
+router.register(r'ws-ticket', api_views.WebsocketTicketViewSet, basename='ws-ticket')
@@ -1,8 +1,17 @@
 import logging
 from time import time
+from django.shortcuts import get_object_or_404
 from rest_framework import viewsets
 from rest_framework import permissions
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from . import auth
+from . import caching
+from . import export
+from . import pagination
 from . import serializers
+from . import sqlite
 from . import models
 
 logger = logging.getLogger(__name__)
@@ -12,9 +21,34 @@ class DataViewSet(viewsets.ModelViewSet):
     """
         Data "view" set is used as a model view set for the rest API to show the list of all the data stored.
         The API returns the user data depending if he is authenticated
+
+        Posting a list of orders upserts them in bulk : the orders without id are created and the
+        others are updated, with one batched websocket notification per user.
+
+        The list is paged by cursor with ?pagination=cursor, constant time whatever the depth of the page.
+        The datatables pages keep the OFFSET pagination, their cost grows with the depth of the page.
+        The pages are cached per user until one of their orders changes (see caching.py).
+
+        All the orders are streamed in CSV or NDJSON by the export action (see export.py).
+
+        With values_serialization, the list and retrieve actions read the rows with values() and
+        serialize them through serializers.ValuesSerializer (same output, a fraction of the CPU).
     """
     permission_classes = (permissions.DjangoModelPermissions,)
     serializer_class = serializers.DataSerializer
+    filter_backends = (pagination.DataFilterBackend,)
+    # Breaks the ties of the datatables ordering, the websocket consumer locates the new orders with it
+    datatables_additional_order_by = '-id'
+    # Fast read path of the list and retrieve actions
+    values_serialization = True
+
+    @property
+    def pagination_class(self):
+        request = getattr(self, 'request', None)
+        if request is not None and request.query_params.get('pagination') == 'cursor' and \
+                request.accepted_renderer.format != 'datatables':
+            return pagination.DataCursorPagination
+        return pagination.DataPagination
 
     def get_queryset(self):
         start = time()
@@ -24,5 +58,91 @@ class DataViewSet(viewsets.ModelViewSet):
             )
         else:
             data = models.Data.objects.none()
-        logger.debug("Elapsed time to get the query set data {}.".format(time() - start))
+        logger.debug("Elapsed time to get the query set data %s.", time() - start)
         return data.order_by("-id")
+
+    def list(self, request, *args, **kwargs):
+        key = caching.list_key(request)
+        if key is not None:
+            data = caching.lookup(key)
+            if data is not None:
+                return Response(data)
+        if self.values_serialization:
+            response = self.list_values(request)
+        else:
+            response = super().list(request, *args, **kwargs)
+        if key is not None and response.status_code == status.HTTP_200_OK:
+            caching.store(key, response.data)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.values_serialization:
+            return super().retrieve(request, *args, **kwargs)
+        values = serializers.ValuesSerializer.for_serializer(self.get_serializer_class())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        row = get_object_or_404(
+            values.values(self.filter_queryset(self.get_queryset())),
+            **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+        )
+        self.check_object_permissions(request, row)
+        return Response(values.to_representation(row))
+
+    def perform_create(self, serializer):
+        if not sqlite.batching_enabled():
+            return super().perform_create(serializer)
+        # Inserted with the orders created meanwhile by the other requests, in one transaction
+        writer = sqlite.get_batch_writer()
+        serializer.instance = writer.create(**serializer.validated_data).result(sqlite.WRITE_TIMEOUT)
+
+    def list_values(self, request):
+        """
+        The list action, reading the rows with values().
+        """
+        values = serializers.ValuesSerializer.for_serializer(self.get_serializer_class())
+        queryset = values.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(values.serialize(page))
+        return Response(values.serialize(queryset))
+
+    def create(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return super().create(request, *args, **kwargs)
+
+        start = time()
+        # Updating existing orders needs the change permission on top of the add one
+        if any(isinstance(item, dict) and item.get('id') is not None for item in request.data) and \
+                not request.user.has_perm('generic.change_data'):
+            self.permission_denied(request, message="You do not have permission to update orders.")
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        logger.debug("Elapsed time to upsert %s orders %s.", len(request.data), time() - start)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get'], url_path='export')
+    def export_orders(self, request, *args, **kwargs):
+        """
+        Streams the orders : ?output=csv (default) or ndjson, and &gzip=1 to compress them.
+        """
+        output = request.query_params.get('output', export.CSV)
+        if output not in export.CONTENT_TYPES:
+            return Response({"output": ["Expected one of {}.".format(", ".join(export.CONTENT_TYPES))]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        compress = request.query_params.get('gzip') in ('1', 'true')
+        return export.export_response(self.get_queryset().order_by("id"), output, compress)
+
+
+class WebsocketTicketViewSet(viewsets.ViewSet):
+    """
+        Issues the signed short lived tickets authenticating the websocket handshakes
+        (/data/stream/?ticket=...) without reading the session from the database.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def create(self, request):
+        return Response({
+            "ticket": auth.issue_ticket(request.user),
+            "expires_in": auth.auth_settings()["TICKET_MAX_AGE"],
+        }, status=status.HTTP_201_CREATED)
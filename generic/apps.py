@@ -1,5 +1,18 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class GenericConfig(AppConfig):
     name = 'generic'
+
+    def ready(self):
+        from . import auth
+        from . import changefeed
+        from . import sqlite
+        # SQLite profile of the connections (see sqlite.py)
+        connection_created.connect(sqlite.configure_connection)
+        # Invalidation of the users cached by the websocket authentication (see auth.py)
+        auth.connect_signals()
+        # NOTIFY trigger of the change feed, enabled in the "notify" mode only (see changefeed.py)
+        post_migrate.connect(changefeed.sync_trigger, sender=self)
@@ -0,0 +1,294 @@
+"""
+Authentication of the websocket connections.
+
+The AuthMiddlewareStack of channels reads the session and the user from the database on each
+handshake, so the reconnections following a deploy saturate the database thread pool. The
+DataAuthMiddlewareStack resolves the user from, in this order :
+
+    ?ticket=<ticket>      a signed short lived ticket (POST /api/ws-ticket/), checked without the database
+    ?token=<key>          a DRF token, or the "Authorization: Token <key>" header of the handshake
+    the session cookie    as the AuthMiddlewareStack
+
+The resolved users are kept in an in process LRU cache with a TTL, by ticket user, token and
+session. The entries of a user are dropped on logout, on a change of the user (password,
+active flag), of their permissions or groups, and on the deletion of their token. The tickets
+issued before such a change are refused.
+
+    DATA_WEBSOCKET_AUTH = {
+        "TICKET_MAX_AGE": 60,  # Seconds a ticket is valid
+        "CACHE_SIZE": 10000,   # Users kept in the cache
+        "CACHE_TTL": 60,       # Seconds a resolved user is kept
+    }
+
+The cache and the revocations are local to the process, the TTL bounds the delay of the other ones.
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+from urllib.parse import parse_qs
+
+from channels.auth import UserLazyObject, get_user
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Group
+from django.contrib.auth.signals import user_logged_out
+from django.core import signing
+from django.core.signals import setting_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from rest_framework.authtoken.models import Token
+
+from . import metrics
+
+DEFAULTS = {
+    "TICKET_MAX_AGE": 60,
+    "CACHE_SIZE": 10000,
+    "CACHE_TTL": 60,
+}
+
+# Salt of the signature of the tickets
+TICKET_SALT = "generic.websocket.ticket"
+
+hits = metrics.counter("ws_auth_cache_hits_total", "Websocket handshakes authenticated from the user cache")
+misses = metrics.counter("ws_auth_cache_misses_total", "Websocket handshakes authenticated from the database")
+rejected = metrics.counter("ws_auth_rejected_total", "Websocket handshakes with an invalid ticket or token")
+
+
+def auth_settings():
+    return dict(DEFAULTS, **getattr(settings, "DATA_WEBSOCKET_AUTH", {}))
+
+
+class UserCache:
+    """
+    LRU cache of the resolved users with a TTL, invalidated per user.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        # (kind, credential) : (user, expiry)
+        self._entries = OrderedDict()
+        # User id : keys of its entries
+        self._keys = {}
+        # User id : time of the last invalidation
+        self._revoked = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, user):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (user, monotonic() + self.ttl)
+            self._keys.setdefault(user.pk, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, user_id):
+        """
+        Drops the entries of the user, and revokes the tickets issued until now.
+        """
+        with self._lock:
+            # Kept in the order of the revocations, the oldest ones are forgotten first
+            self._revoked.pop(user_id, None)
+            self._revoked[user_id] = time()
+            while len(self._revoked) > self.max_size:
+                del self._revoked[next(iter(self._revoked))]
+            for key in list(self._keys.get(user_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        """
+        Drops all the entries, when the changed users are not known.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def revoked_since(self, user_id, issued):
+        return self._revoked.get(user_id, 0) >= issued
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._keys.get(entry[0].pk)
+            keys.discard(key)
+            if not keys:
+                del self._keys[entry[0].pk]
+
+
+_cache = None
+_lock = threading.Lock()
+
+
+def get_user_cache():
+    """
+    Returns the process user cache, built from the settings on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                config = auth_settings()
+                _cache = UserCache(max_size=config["CACHE_SIZE"], ttl=config["CACHE_TTL"])
+    return _cache
+
+
+def issue_ticket(user):
+    """
+    Returns a signed ticket authenticating the websocket handshakes of the user for TICKET_MAX_AGE seconds.
+    """
+    return signing.dumps({"user": user.pk, "issued": time()}, salt=TICKET_SALT, compress=False)
+
+
+def check_ticket(ticket):
+    """
+    Returns the id of the user of a valid ticket, None otherwise.
+    """
+    try:
+        content = signing.loads(ticket, salt=TICKET_SALT, max_age=auth_settings()["TICKET_MAX_AGE"])
+    except signing.BadSignature:
+        return None
+    if get_user_cache().revoked_since(content["user"], content["issued"]):
+        return None
+    return content["user"]
+
+
+def load_user(user_id):
+    user = get_user_model()._default_manager.filter(pk=user_id, is_active=True).first()
+    return user or AnonymousUser()
+
+
+def load_token_user(key):
+    token = Token.objects.select_related("user").filter(key=key, user__is_active=True).first()
+    return token.user if token is not None else AnonymousUser()
+
+
+def get_credentials(scope):
+    """
+    Returns the (kind, credential) of the handshake, None when only the session is left.
+    """
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if query.get("ticket"):
+        return "ticket", query["ticket"][-1]
+    if query.get("token"):
+        return "token", query["token"][-1]
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization":
+            keyword, _, key = value.decode("latin1").partition(" ")
+            if keyword == "Token" and key:
+                return "token", key
+    return None
+
+
+async def resolve_user(scope):
+    """
+    Returns the user of the handshake, from the cache when possible.
+    """
+    cache = get_user_cache()
+    credentials = get_credentials(scope)
+    if credentials is not None and credentials[0] == "ticket":
+        user_id = check_ticket(credentials[1])
+        if user_id is None:
+            rejected.inc()
+            return AnonymousUser()
+        key, load = ("user", user_id), lambda: load_user(user_id)
+    elif credentials is not None:
+        key, load = credentials, lambda: load_token_user(credentials[1])
+    else:
+        session_key = scope["session"].session_key if "session" in scope else None
+        if not session_key:
+            return AnonymousUser()
+        key, load = ("session", session_key), None
+
+    user = cache.get(key)
+    if user is not None:
+        hits.inc()
+        return user
+    misses.inc()
+    user = await (get_user(scope) if load is None else database_sync_to_async(load)())
+    if user.is_anonymous:
+        if credentials is not None:
+            rejected.inc()
+    else:
+        cache.set(key, user)
+    return user
+
+
+class WebsocketAuthMiddleware(BaseMiddleware):
+    """
+    Populates scope["user"] from a ticket, a token or the session (see resolve_user).
+    """
+
+    def populate_scope(self, scope):
+        if "user" not in scope:
+            scope["user"] = UserLazyObject()
+
+    async def resolve_scope(self, scope):
+        scope["user"]._wrapped = await resolve_user(scope)
+
+
+def DataAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(WebsocketAuthMiddleware(inner)))
+
+
+def _invalidate_user(sender, user=None, instance=None, **kwargs):
+    # The cache is built if needed, it keeps the revocations of the tickets
+    user = user if user is not None else instance
+    if user is not None:
+        get_user_cache().invalidate(user.pk)
+
+
+def _invalidate_token_user(sender, instance, **kwargs):
+    get_user_cache().invalidate(instance.user_id)
+
+
+def _invalidate_relations(sender, instance, action, model=None, pk_set=None, **kwargs):
+    if not action.startswith("post_"):
+        return
+    user_model = get_user_model()
+    cache = get_user_cache()
+    if isinstance(instance, user_model):
+        # The permissions or the groups of a user
+        cache.invalidate(instance.pk)
+    elif model is user_model and pk_set:
+        # The users added to or removed from a group, or given a permission
+        for pk in pk_set:
+            cache.invalidate(pk)
+    else:
+        # The permissions of a group, or the users of a cleared group
+        cache.clear()
+
+
+def _settings_changed(setting, **kwargs):
+    global _cache
+    if setting == "DATA_WEBSOCKET_AUTH":
+        _cache = None
+
+
+def connect_signals():
+    """
+    Drops the cached users on the changes of their credentials, called by the app config.
+    """
+    user_model = get_user_model()
+    user_logged_out.connect(_invalidate_user, dispatch_uid="generic.auth.logout")
+    post_save.connect(_invalidate_user, sender=user_model, dispatch_uid="generic.auth.user_saved")
+    post_delete.connect(_invalidate_user, sender=user_model, dispatch_uid="generic.auth.user_deleted")
+    post_delete.connect(_invalidate_token_user, sender=Token, dispatch_uid="generic.auth.token_deleted")
+    relations = (user_model.user_permissions.through, user_model.groups.through, Group.permissions.through)
+    for relation in relations:
+        m2m_changed.connect(_invalidate_relations, sender=relation, dispatch_uid="generic.auth." + relation.__name__)
+
+
+setting_changed.connect(_settings_changed)
@@ -0,0 +1,92 @@
+"""
+Cache of the pages of the data list API.
+
+The datatables page redraws its table on each new order, so the same list request is made by
+every open dashboard of the user. The responses are cached per user, keyed on the request
+parameters (without the "draw" counter of datatables), and invalidated when an order of the
+user is saved, updated or deleted : each user has a generation, part of the keys, renewed on each
+committed write (see models.publish), so the entries of the previous generation are never
+read again and age out of the cache.
+
+The cache is configured through the DATA_LIST_CACHE setting :
+
+    DATA_LIST_CACHE = {
+        "ENABLED": True,
+        "CACHE": "default",  # Alias of the Django cache, its backend handles the LRU eviction
+        "TIMEOUT": 30,       # Seconds a page is kept
+    }
+
+A shared cache backend (Redis, Memcached) keeps the invalidation consistent across the
+processes, the local memory one only within a process.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+DEFAULTS = {
+    "ENABLED": True,
+    "CACHE": "default",
+    "TIMEOUT": 30,
+}
+
+# Request parameters that don't change the listed rows : the datatables draw counter and the jQuery cache buster
+IGNORED_PARAMETERS = ("draw", "_")
+
+hits = metrics.counter("list_cache_hits_total", "Data list requests served from the cache")
+misses = metrics.counter("list_cache_misses_total", "Data list requests read from the database")
+invalidations = metrics.counter("list_cache_invalidations_total", "Data list cache generations renewed by a write")
+
+
+def cache_settings():
+    return dict(DEFAULTS, **getattr(settings, "DATA_LIST_CACHE", {}))
+
+
+def generation_key(user_id):
+    return "data_list_generation:" + str(user_id)
+
+
+def list_key(request):
+    """
+    Returns the cache key of the list request, None when it is not cached.
+    """
+    config = cache_settings()
+    if not config["ENABLED"] or not request.user.is_authenticated:
+        return None
+    cache = caches[config["CACHE"]]
+    generation = cache.get(generation_key(request.user.pk))
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.set(generation_key(request.user.pk), generation, None)
+    parameters = sorted(
+        (name, values) for name, values in request.query_params.lists() if name not in IGNORED_PARAMETERS
+    )
+    digest = hashlib.sha1(repr((request.accepted_renderer.format, parameters)).encode()).hexdigest()
+    return "data_list:" + str(request.user.pk) + ":" + generation + ":" + digest
+
+
+def lookup(key):
+    data = caches[cache_settings()["CACHE"]].get(key)
+    if data is None:
+        misses.inc()
+    else:
+        hits.inc()
+    return data
+
+
+def store(key, data):
+    config = cache_settings()
+    caches[config["CACHE"]].set(key, data, config["TIMEOUT"])
+
+
+def invalidate(user_id):
+    """
+    Renews the generation of the user, the cached pages are not read anymore.
+    """
+    config = cache_settings()
+    if config["ENABLED"]:
+        caches[config["CACHE"]].set(generation_key(user_id), uuid.uuid4().hex, None)
+        invalidations.inc()
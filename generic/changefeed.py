@@ -0,0 +1,133 @@
+"""
+Change feed of the orders from PostgreSQL triggers.
+
+By default the notifications are sent by Data.save() and the bulk methods of the queryset
+("save" mode). In the "notify" mode, triggers on the generic_data table (see the migration
+0004_data_change_triggers) send a NOTIFY on the CHANNEL for each inserted, updated or deleted
+row, and the listen_changes management command turns them into websocket notifications : the
+writes made by any client of the database (raw SQL, other services) reach the websockets. The
+triggers also increment the version of the rows updated without it. The NOTIFY trigger is only
+enabled in the "notify" mode (see sync_trigger, run after each migrate), so the writes of the
+"save" mode don't pay a pg_notify nobody listens to.
+
+    DATA_CHANGE_FEED = {
+        "MODE": "save",  # "save" or "notify" (PostgreSQL, with listen_changes running)
+    }
+
+The save methods don't send anything in the "notify" mode, a single listener process does.
+"""
+import json
+import logging
+import select
+from time import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import caching
+from . import models
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "MODE": "save",
+}
+
+SAVE = "save"
+NOTIFY = "notify"
+
+# Channel of the NOTIFY sent by the triggers
+CHANNEL = "generic_data_changes"
+# Trigger sending the NOTIFY (see the migration 0004_data_change_triggers)
+TRIGGER = "generic_data_notify"
+
+
+def feed_settings():
+    return dict(DEFAULTS, **getattr(settings, "DATA_CHANGE_FEED", {}))
+
+
+def notify_mode():
+    """
+    Returns True when the notifications are sent from the database triggers.
+    """
+    return feed_settings()["MODE"] == NOTIFY
+
+
+def sync_trigger(using="default", **kwargs):
+    """
+    Enables the NOTIFY trigger in the "notify" mode, disables it otherwise. Connected to the
+    post_migrate signal, and called by the listener when it starts.
+    """
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT tgenabled FROM pg_trigger WHERE tgname = %s", [TRIGGER])
+        row = cursor.fetchone()
+        # Before the migration 0004
+        if row is None:
+            return
+        enabled = notify_mode()
+        if (row[0] != "D") != enabled:
+            cursor.execute("ALTER TABLE generic_data {} TRIGGER {}".format("ENABLE" if enabled else "DISABLE", TRIGGER))
+            logger.info("Trigger %s %s", TRIGGER, "enabled" if enabled else "disabled")
+
+
+def handle_changes(payloads):
+    """
+    Publishes the changes sent by the triggers, as {"op": "INSERT" | "UPDATE" | "DELETE", "row": {...}}
+    JSON payloads, batched per user.
+    """
+    per_user = {}
+    deleted = set()
+    for payload in payloads:
+        change = json.loads(payload)
+        row = change["row"]
+        if change["op"] == "DELETE":
+            deleted.add(row["user_id"])
+            continue
+        data = models.Data(**{name: row[name] for name in ("id", "user_id", "version") + models.Data.NOTIFIED_FIELDS})
+        notification_type = "data.new" if change["op"] == "INSERT" else "data.update"
+        per_user.setdefault(data.user_id, []).append(
+            (data.notification_content(notification_type), data.notification_route())
+        )
+
+    for user, notifications in per_user.items():
+        for start in range(0, len(notifications), models.BROADCAST_BATCH_SIZE):
+            models.publish(user, notifications[start:start + models.BROADCAST_BATCH_SIZE])
+    for user in deleted - set(per_user):
+        caching.invalidate(user)
+
+
+def listen(using="default", timeout=5.0, handle=handle_changes):
+    """
+    Listens to the CHANNEL on a dedicated connection and hands the received payloads to handle,
+    all the ones received at once in one call.
+    """
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        raise RuntimeError("The change feed needs PostgreSQL, the {} database is {}".format(using, connection.vendor))
+    connection.ensure_connection()
+    # Autocommit, the notifications are delivered between the transactions
+    connection.set_autocommit(True)
+    sync_trigger(using)
+    with connection.cursor() as cursor:
+        cursor.execute("LISTEN " + CHANNEL)
+    pg_connection = connection.connection
+    logger.info("Listening to %s", CHANNEL)
+
+    while True:
+        if not select.select([pg_connection], [], [], timeout)[0]:
+            continue
+        pg_connection.poll()
+        payloads = [notify.payload for notify in pg_connection.notifies]
+        pg_connection.notifies.clear()
+        if payloads:
+            start = time()
+            try:
+                handle(payloads)
+            except Exception:
+                # The next changes are still relayed
+                logger.exception("Unable to publish %s changes", len(payloads))
+                continue
+            logger.debug("Elapsed time to publish %s changes %s.", len(payloads), time() - start)
@@ -1,9 +1,107 @@
+import asyncio
+from collections import deque
 from time import time
+from urllib.parse import parse_qs
 import logging
+import msgpack
+import numpy as np
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from . import encoding
+from . import log
+from . import metrics
+from .dispatch import get_dispatcher
 from .exceptions import ClientError
+from .market import MarketView, get_market_feed, market_settings
+from .market import frames_sent as market_frames_sent
+from .models import Data, group_name, merge_items
+from .pnl import PositionBook
+from .positions import MAX_LOCATED, TableView
+from .streams import get_replay_buffer
 
 logger = logging.getLogger(__name__)
+# Events of each notification received, sampled
+message_logger = log.sampled(__name__)
+
+DEFAULTS = {
+    # Coalescing window of the updates in milliseconds, 0 sends every update as soon as it is received
+    "FLUSH_INTERVAL": 0,
+    # Maximum coalescing window a client can ask for in milliseconds (caps the added latency)
+    "MAX_FLUSH_INTERVAL": 1000,
+    # Number of pending orders triggering a flush before the end of the window
+    "MAX_PENDING": 1000,
+    # Wrap the notifications in the {"type": "data.send", "content": "<JSON text>"} envelope of the old clients
+    "LEGACY_FRAMES": False,
+    # Window in milliseconds between two valuations of the positions sent to the connections asking for the P&L
+    "PNL_INTERVAL": 500,
+    # Notifications waiting to be sent to a connection before SLOW_POLICY applies, above the DATA_REPLAY SIZE
+    # so that the live notifications following a replay find room
+    "HIGH_WATER_MARK": 2000,
+    # Notifications left waiting under which a slow connection is caught up
+    "LOW_WATER_MARK": 100,
+    # What to do with a connection above HIGH_WATER_MARK : "conflate", "gap" or "disconnect"
+    "SLOW_POLICY": "conflate",
+    # Format of the frames of the connections asking for none : "json" or "msgpack"
+    "FRAME_FORMAT": "json",
+    # Size in bytes from which the frames of the connections asking for compression are compressed
+    "COMPRESS_MIN_SIZE": 4096,
+    # zlib level of the compressed frames, 1 is the fastest
+    "COMPRESS_LEVEL": 1,
+}
+
+CONFLATE = "conflate"
+GAP = "gap"
+DISCONNECT = "disconnect"
+SLOW_POLICIES = (CONFLATE, GAP, DISCONNECT)
+
+# Close code of the connections disconnected by the "disconnect" policy
+SLOW_CLOSE_CODE = 4008
+
+# Maximum number of orders a client can ask in one snapshot command
+MAX_SNAPSHOT_IDS = 1000
+
+# Default and maximum number of orders per frame of the snapshot sent on subscription
+SNAPSHOT_CHUNK_SIZE = 500
+MAX_CHUNK_SIZE = 5000
+
+# Maximum number of instruments a connection can subscribe to
+MAX_INSTRUMENTS = 100
+
+# Lookups of the "filters" subscribe option, by field and by comparison
+FILTER_FIELDS = ("quantity", "initial_price")
+FILTER_LOOKUPS = {
+    "exact": lambda value, bound: value == bound,
+    "gt": lambda value, bound: value > bound,
+    "gte": lambda value, bound: value >= bound,
+    "lt": lambda value, bound: value < bound,
+    "lte": lambda value, bound: value <= bound,
+}
+
+coalesced = metrics.counter("stream_coalesced_total", "Updates collapsed into a newer one before being sent")
+frames_sent = metrics.counter("stream_frames_sent_total", "Data frames sent to the websocket clients")
+open_connections = metrics.gauge("stream_connections", "Open data stream websocket connections")
+memberships = metrics.gauge("stream_group_memberships", "Groups joined by the data stream connections")
+outbound_queued = metrics.gauge("stream_outbound_queued", "Notifications waiting to be sent to the connections")
+slow_connections = metrics.gauge(
+    "stream_slow_connections", "Connections above their high-water mark, not caught up yet"
+)
+slow_conflated = metrics.counter(
+    "stream_slow_conflated_total", "Notifications collapsed into a newer one because their connection was slow"
+)
+slow_dropped = metrics.counter("stream_slow_dropped_total", "Notifications dropped because their connection was slow")
+slow_gaps = metrics.counter("stream_slow_gaps_total", "Gap frames sent to slow connections, asking them to resync")
+slow_disconnects = metrics.counter("stream_slow_disconnects_total", "Connections closed because they were slow")
+save_to_receive = metrics.histogram(
+    "stream_save_to_receive_seconds", "Time from the save of the data to its notification reaching a consumer"
+)
+receive_to_send = metrics.histogram(
+    "stream_receive_to_send_seconds", "Time a consumer spends on a notification until it is sent or held"
+)
+
+
+def stream_settings():
+    return dict(DEFAULTS, **getattr(settings, "DATA_STREAM", {}))
 
 
 class DataConsumer(AsyncJsonWebsocketConsumer):
@@ -14,8 +112,108 @@ class DataConsumer(AsyncJsonWebsocketConsumer):
     must be async functions, and any sync work (like ORM access) has to be
     behind database_sync_to_async or sync_to_async. For more, read
     http://channels.readthedocs.io/en/latest/topics/consumers.html
+
+    The updates can be coalesced per connection : when a flush interval is set (through the
+    DATA_STREAM setting or the "flush_interval" option of the subscribe command), the updates
+    received within the interval are collapsed to the latest state of each order and sent as
+    one frame holding the list of the notifications.
+
+    The notifications are JSON encoded once by the writer (see models.broadcast) and their text
+    is sent as is. Old clients expecting the notifications as a JSON string in the "content" key
+    of an envelope are served with the LEGACY_FRAMES setting or the "frames=legacy" query parameter.
+
+    The updates only carry the changed fields of the order, with its id and version. A client
+    missing a version (or a full row) asks for it with the "snapshot" command.
+
+    Every notification holds the sequence number of the user's stream ("seq"). A reconnecting
+    client subscribes with the "since" (and "epoch") options to get the notifications it missed
+    replayed, or is told to reload its data ("snapshot_required") when they are not available.
+
+    Subscribing with the "snapshot" option sends the current orders of the user over the websocket,
+    in "snapshot" frames of "chunk_size" orders tagged with the stream sequence number, followed by
+    the live notifications, so the client doesn't need to load them over HTTP first.
+
+    The subscription can be narrowed to some instruments ("instruments" option) : the connection
+    drops the notifications of the other instruments, or, with the INSTRUMENT_GROUPS option of
+    DATA_DISPATCH, joins the group of each instrument instead of the group of the user, so they
+    are not delivered to it at all. Instruments are added by subscribing
+    again and removed with the "instruments" option of the unsubscribe command. The "filters"
+    option (e.g. {"quantity__gte": 10}) keeps the notifications of the orders matching them, as
+    they are after the change.
+
+    Subscribing with the "pnl" option also sends the unrealised P&L of the orders valued at the
+    market data prices (see pnl.py), per instrument and in total, every PNL_INTERVAL : the orders
+    of the subscription are loaded once, and again when it changes, and kept up to date with the
+    notifications received by the connection. The deleted orders aren't notified, they stay in
+    the P&L until the subscription changes.
+
+    A datatables client describes the page it shows with the "view" command (see positions.py) :
+    its "data.new" notifications then tell where the new order lands, so it only reloads the
+    page when the order is on it.
+
+    The notifications are queued per connection and sent by a writer task, so a slow client
+    doesn't hold the consumer (and its channel in the layer, where the messages would be dropped
+    silently). Above HIGH_WATER_MARK queued notifications, the SLOW_POLICY applies : "conflate"
+    collapses them to the latest state of each order, "gap" drops them and sends a
+    {"type": "gap", "seq": <last dropped>} frame telling the client to resubscribe with "since",
+    "disconnect" closes the connection (code 4008). A conflated queue still above the mark is
+    gapped. The connection is caught up once under LOW_WATER_MARK. The replays asked with "since"
+    are queued whole, without the policy. The other frames (command responses, snapshot pages,
+    P&L) are queued behind the notifications too, so they never overtake them, but they are
+    neither counted nor dropped.
+
+    The client picks the format of its frames with the sub-protocol of its handshake or the
+    "format" and "compress" query parameters (see encoding.SUBPROTOCOLS) : JSON text frames by
+    default, or binary MessagePack frames, the large ones possibly zlib compressed. A MessagePack
+    client can send its commands as MessagePack binary frames too.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        config = stream_settings()
+        # Coalescing window in seconds
+        self.flush_interval = config["FLUSH_INTERVAL"] / 1000
+        self.max_flush_interval = config["MAX_FLUSH_INTERVAL"] / 1000
+        self.max_pending = config["MAX_PENDING"]
+        self.legacy_frames = config["LEGACY_FRAMES"]
+        self.frame_format = config["FRAME_FORMAT"]
+        self.compress = False
+        self.compress_min_size = config["COMPRESS_MIN_SIZE"]
+        self.compress_level = config["COMPRESS_LEVEL"]
+        self.frame_encoder = self.get_frame_encoder()
+        # Latest [id, type, text, seq, route] item of each order waiting for the end of the window, by order id
+        self.pending = {}
+        self.flush_task = None
+        # Sequence number of the last replayed notification
+        self.last_seq = 0
+        # Snapshot being sent, and the live items held until it is complete
+        self.snapshot_task = None
+        self.held = []
+        # Groups joined, subscribed instruments (None for all of them) and filters of the notifications
+        self.joined_groups = set()
+        self.instruments = None
+        self.filters = []
+        # Positions valued for the P&L frames
+        self.pnl_interval = config["PNL_INTERVAL"] / 1000
+        self.positions = None
+        self.pnl_task = None
+        # Table shown by the client, to locate the new orders in it
+        self.table_view = None
+        self.accepted = False
+        # Backpressure of the notifications sent to a slow client
+        self.high_water_mark = config["HIGH_WATER_MARK"]
+        self.low_water_mark = config["LOW_WATER_MARK"]
+        self.slow_policy = config["SLOW_POLICY"]
+        if self.slow_policy not in SLOW_POLICIES:
+            raise ValueError("Unknown slow policy {!r}, expected one of {}".format(self.slow_policy, SLOW_POLICIES))
+        # Lists of items waiting to be sent as one frame each, or the arguments of send of the other
+        # frames, and the number of items
+        self.outbound = deque()
+        self.queued = 0
+        self.writer_task = None
+        self.slow = False
+        self.closing = False
+
     # WebSocket event handlers
     async def connect(self):
         """
@@ -25,11 +223,38 @@ class DataConsumer(AsyncJsonWebsocketConsumer):
         if self.scope["user"].is_anonymous:
             # Reject the connection
             await self.close()
-            logger.debug("Connexion Rejected + " + str(self.scope))
+            logger.debug("Connexion Rejected + %s", self.scope)
         else:
+            query = parse_qs(self.scope.get("query_string", b"").decode())
+            if query.get("frames"):
+                self.legacy_frames = query["frames"][-1] == "legacy"
+            subprotocol = self.negotiate_format(query)
+            self.frame_encoder = self.get_frame_encoder()
             # Accept the connection
-            await self.accept()
-            logger.debug("Connexion Accepted + " + str(self.scope))
+            await self.accept(subprotocol=subprotocol)
+            self.accepted = True
+            open_connections.inc()
+            logger.debug("Connexion Accepted + %s", self.scope)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        """
+        Decodes the commands sent as MessagePack binary frames, the JSON text ones as usual.
+        """
+        if text_data is None and bytes_data is not None:
+            try:
+                content = msgpack.unpackb(bytes_data, raw=False)
+            except Exception:
+                await self.send_json({"error": "INVALID_FRAME"})
+                return
+            await self.receive_json(content)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    async def send_json(self, content, close=False):
+        """
+        Sends the content in the format of the connection, after the queued notifications.
+        """
+        await self.send_ordered(close=close, **self.frame_encoder.content(content))
 
     async def receive_json(self, content):
         """
@@ -38,21 +263,85 @@ class DataConsumer(AsyncJsonWebsocketConsumer):
         """
         # Messages will have a "command" key we can switch on
         command = content.get("command", None)
-        logger.debug("Command Received + " + str(content))
+        logger.debug("Command Received + %s", content)
         try:
             if command == "subscribe":
+                response = {"command": "subscribe", "status": "ok"}
+                if "flush_interval" in content:
+                    response["flush_interval"] = self.set_flush_interval(content["flush_interval"])
+                since = content.get("since")
+                if since is not None and (isinstance(since, bool) or not isinstance(since, int) or since < 0):
+                    raise ClientError("INVALID_SINCE")
+                snapshot = bool(content.get("snapshot", False))
+                if snapshot:
+                    chunk_size = self.get_chunk_size(content.get("chunk_size", SNAPSHOT_CHUNK_SIZE))
+                    if self.snapshot_task is not None:
+                        raise ClientError("SNAPSHOT_IN_PROGRESS")
+                instruments = None
+                if "instruments" in content:
+                    instruments = self.get_instruments(content["instruments"])
+                    if self.instruments is not None:
+                        instruments |= self.instruments
+                    response["instruments"] = sorted(instruments)
+                if "filters" in content:
+                    self.filters = self.get_filters(content["filters"])
+                    response["filters"] = content["filters"]
                 # Make them join the room
-                await self.subscribe_to_realtime()
-                await self.send_json(
-                    {"command": "subscribe",
-                     "status": "ok"}
-                )
+                await self.subscribe_to_realtime(instruments)
+                if content.get("pnl") and self.pnl_task is None:
+                    # Loaded once in the room, the notifications received since keep them up to date
+                    await self.start_pnl()
+                elif self.pnl_task is not None and ("instruments" in content or "filters" in content):
+                    await self.load_positions()
+                if self.pnl_task is not None:
+                    response["pnl"] = True
+                # Position in the stream of the user, and the notifications missed since the given one
+                stream = get_replay_buffer()
+                response["seq"] = stream.current(self.scope["user"].id)
+                response["epoch"] = stream.epoch
+                replay = None
+                if snapshot:
+                    response["snapshot"] = True
+                elif since is not None:
+                    replay = stream.since(self.scope["user"].id, since, content.get("epoch"))
+                    if replay is None:
+                        response["snapshot_required"] = True
+                await self.send_json(response)
+                if snapshot:
+                    # The live notifications are held until the snapshot, tagged with the current
+                    # sequence number, is sent
+                    self.snapshot_task = asyncio.ensure_future(self.send_snapshot(response["seq"], chunk_size))
+                elif replay:
+                    # The live notifications already replayed are skipped
+                    self.last_seq = replay[-1][3]
+                    replay = [item for item in replay if self.matches(item)]
+                    if replay:
+                        # Sent whole : dropping it would only ask for the same replay again
+                        await self.enqueue(replay, apply_policy=False)
             elif command == "unsubscribe":
-                # Leave the room
-                await self.unsubscribe_to_realtime()
+                response = {"command": "unsubscribe", "status": "ok"}
+                if "instruments" in content:
+                    # Leave the rooms of these instruments only
+                    await self.unsubscribe_to_realtime(self.get_instruments(content["instruments"]))
+                    response["instruments"] = sorted(self.instruments or ())
+                else:
+                    # Leave the room
+                    await self.unsubscribe_to_realtime()
+                if not self.joined_groups:
+                    self.stop_pnl()
+                    self.cancel_snapshot()
+                    await self.flush()
+                elif self.pnl_task is not None:
+                    await self.load_positions()
+                await self.send_json(response)
+            elif command == "view":
+                self.table_view = TableView.from_command(content)
+                await self.send_json({"command": "view", "status": "ok"})
+            elif command == "snapshot":
+                # Full state of orders, asked by the clients missing a version of them
                 await self.send_json(
-                    {"command": "unsubscribe",
-                     "status": "ok"}
+                    {"command": "snapshot",
+                     "data": await self.get_snapshot(content.get("ids"))}
                 )
         except ClientError as e:
             # Catch any errors and send it back
@@ -62,48 +351,581 @@ class DataConsumer(AsyncJsonWebsocketConsumer):
         """
         Called when the WebSocket closes for any reason.
         """
+        if self.accepted:
+            self.accepted = False
+            open_connections.dec()
         # Deactivate the Realtime
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        self.clear_outbound()
+        self.cancel_snapshot()
+        self.stop_pnl()
         try:
             await self.unsubscribe_to_realtime()
         except ClientError:
             pass
 
     # Command helper methods called by receive_json
-    async def subscribe_to_realtime(self):
+    def negotiate_format(self, query):
         """
-        Called by receive_json when someone subscribes to realtime data.
+        Sets the format and the compression of the frames from the first known sub-protocol
+        offered by the client, or else from the query parameters. Returns the accepted sub-protocol.
         """
-        start = time()
-        logger.debug("Group Added on channel " + self.channel_name + " and group realtime_" +
-                     str(self.scope["user"].id))
-        # Send a realtime activation message
-        await self.channel_layer.group_add(
-            "realtime_" + str(self.scope["user"].id),
-            self.channel_name
+        for subprotocol in self.scope.get("subprotocols", ()):
+            if subprotocol in encoding.SUBPROTOCOLS:
+                self.frame_format, self.compress = encoding.SUBPROTOCOLS[subprotocol]
+                return subprotocol
+        if query.get("format") and query["format"][-1] in encoding.FORMATS:
+            self.frame_format = query["format"][-1]
+        if query.get("compress"):
+            self.compress = query["compress"][-1] in ("1", "true", "deflate")
+        return None
+
+    def get_frame_encoder(self):
+        return encoding.FrameEncoder(
+            format=self.frame_format,
+            compress=self.compress,
+            compress_min_size=self.compress_min_size,
+            compress_level=self.compress_level,
+            legacy=self.legacy_frames,
         )
-        logger.debug("Elapsed time to subscribe to realtime {}.".format(time() - start))
 
-    async def unsubscribe_to_realtime(self):
+    def set_flush_interval(self, flush_interval):
         """
-        Called by receive_json when someones unsubscribes from the realtime data
+        Sets the coalescing window asked by the client in milliseconds, capped by MAX_FLUSH_INTERVAL.
+        Returns the applied window in milliseconds.
         """
-        start = time()
-        logger.debug("Group Discarded on channel " + self.channel_name + " and group realtime_" +
-                     str(self.scope["user"].id))
-        await self.channel_layer.group_discard(
-            "realtime_" + str(self.scope["user"].id),
-            self.channel_name
+        if isinstance(flush_interval, bool) or not isinstance(flush_interval, (int, float)) or flush_interval < 0:
+            raise ClientError("INVALID_FLUSH_INTERVAL")
+        self.flush_interval = min(flush_interval / 1000, self.max_flush_interval)
+        return self.flush_interval * 1000
+
+    def get_instruments(self, instruments):
+        if not isinstance(instruments, list) or not 0 < len(instruments) <= MAX_INSTRUMENTS or \
+                not all(isinstance(instrument, str) and instrument for instrument in instruments):
+            raise ClientError("INVALID_INSTRUMENTS")
+        return set(instruments)
+
+    def get_filters(self, filters):
+        """
+        Returns the (field, lookup, value) predicates of the filters asked by the client, given as
+        Django lookups on the numeric fields of the orders.
+        """
+        if not isinstance(filters, dict):
+            raise ClientError("INVALID_FILTERS")
+        predicates = []
+        for lookup, value in filters.items():
+            field, _, comparison = lookup.partition("__")
+            comparison = comparison or "exact"
+            if field not in FILTER_FIELDS or comparison not in FILTER_LOOKUPS or \
+                    isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ClientError("INVALID_FILTERS")
+            predicates.append((field, comparison, value))
+        return predicates
+
+    def matches(self, item):
+        """
+        Returns whether the notification item is part of the subscription, from the current values
+        of its order held in the item.
+        """
+        route = item[4]
+        if self.instruments is not None and route["instrument"] not in self.instruments:
+            return False
+        return all(FILTER_LOOKUPS[comparison](route[field], value) for field, comparison, value in self.filters)
+
+    def get_chunk_size(self, chunk_size):
+        if isinstance(chunk_size, bool) or not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ClientError("INVALID_CHUNK_SIZE")
+        return chunk_size
+
+    @database_sync_to_async
+    def get_snapshot_page(self, after, size):
+        """
+        Returns the next page of the subscribed orders of the user, by ascending id.
+        """
+        queryset = Data.objects.filter(user=self.scope["user"], id__gt=after)
+        if self.instruments is not None:
+            queryset = queryset.filter(instrument__in=self.instruments)
+        queryset = queryset.filter(**{
+            field + "__" + comparison: value for field, comparison, value in self.filters
+        })
+        return list(queryset.order_by("id").values("id", "version", *Data.NOTIFIED_FIELDS)[:size])
+
+    async def snapshot_pages(self, chunk_size):
+        """
+        Iterates over the orders of the user page by page (keyset pagination on the id), so the
+        snapshot is never loaded in memory as a whole.
+        """
+        after = 0
+        while True:
+            rows = await self.get_snapshot_page(after, chunk_size)
+            yield rows
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1]["id"]
+
+    async def send_snapshot(self, seq, chunk_size):
+        """
+        Sends the orders of the user in "snapshot" frames tagged with the stream sequence number
+        they are consistent with, then the live notifications received meanwhile that follow it.
+        """
+        try:
+            async for rows in self.snapshot_pages(chunk_size):
+                await self.send_ordered(**self.frame_encoder.content(
+                    {"type": "snapshot", "seq": seq, "data": rows, "last": len(rows) < chunk_size}
+                ))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Unable to send the snapshot")
+            await self.send_json({"error": "SNAPSHOT_FAILED"})
+        self.snapshot_task = None
+        held, self.held = self.held, []
+        # Rows changed after seq may already be in the snapshot, the versions tell the client
+        items = [item for item in held if item[3] > seq and self.matches(item)]
+        if items:
+            await self.forward(items)
+
+    def cancel_snapshot(self):
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+            self.snapshot_task = None
+        self.held = []
+
+    @database_sync_to_async
+    def get_positions(self):
+        """
+        Returns the (id, instrument, quantity, initial_price, version) of the subscribed orders.
+        """
+        queryset = Data.objects.filter(user=self.scope["user"])
+        if self.instruments is not None:
+            queryset = queryset.filter(instrument__in=self.instruments)
+        queryset = queryset.filter(**{
+            field + "__" + comparison: value for field, comparison, value in self.filters
+        })
+        return list(queryset.values_list("id", "instrument", "quantity", "initial_price", "version"))
+
+    async def load_positions(self):
+        """
+        Loads the subscribed orders in a new book, when the P&L starts or the subscription changes.
+        """
+        positions = PositionBook(get_market_feed().book)
+        positions.load(await self.get_positions())
+        self.positions = positions
+
+    async def start_pnl(self):
+        await self.load_positions()
+        self.pnl_task = asyncio.ensure_future(self.pnl_loop(get_market_feed()))
+
+    def stop_pnl(self):
+        if self.pnl_task is not None:
+            self.pnl_task.cancel()
+            self.pnl_task = None
+            self.positions = None
+
+    async def pnl_loop(self, feed):
+        """
+        Sends the valuation of the positions at the end of each window, when it changed.
+        """
+        try:
+            # Attached by the task, so that a task cancelled before its start never attaches
+            feed.attach()
+            while True:
+                frame = self.positions.frame()
+                if frame is not None:
+                    await self.send_ordered(**self.frame_encoder.text(frame))
+                await asyncio.sleep(self.pnl_interval)
+        finally:
+            feed.detach()
+
+    @database_sync_to_async
+    def get_snapshot(self, ids):
+        """
+        Called by receive_json when someone asks for the full state of some of their orders.
+        """
+        if not isinstance(ids, list) or not 0 < len(ids) <= MAX_SNAPSHOT_IDS or \
+                not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in ids):
+            raise ClientError("INVALID_IDS")
+        return list(
+            Data.objects.filter(user=self.scope["user"], id__in=ids).order_by("id").values(
+                "id", "version", *Data.NOTIFIED_FIELDS
+            )
         )
-        logger.debug("Elapsed time to unsubscribe from realtime {}.".format(time() - start))
 
-    async def data_send(self, content):
+    def subscription_groups(self, instruments):
         """
-        Called when someone has messaged our chat.
+        Returns the groups to join for the orders of the given instruments (None for all of them).
+        Without the instrument groups, the group of the user is joined and filtered.
+        """
+        user = self.scope["user"].id
+        if instruments is not None and get_dispatcher().instrument_groups:
+            return {group_name(user, instrument) for instrument in instruments}
+        return {group_name(user)} if instruments is None or instruments else set()
+
+    async def subscribe_to_realtime(self, instruments=None):
+        """
+        Called by receive_json when someone subscribes to realtime data, of all their orders or
+        of the orders on the given instruments.
         """
-        logger.debug("Data update command received : " + str(content))
         start = time()
-        # Send a message down to the client
-        await self.send_json(
-            content
+        groups = self.subscription_groups(instruments)
+        for group in groups - self.joined_groups:
+            logger.debug("Group Added on channel %s and group %s", self.channel_name, group)
+            # Send a realtime activation message
+            await self.channel_layer.group_add(group, self.channel_name)
+        for group in self.joined_groups - groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        memberships.inc(len(groups) - len(self.joined_groups))
+        self.joined_groups = groups
+        self.instruments = instruments
+        logger.debug("Elapsed time to subscribe to realtime %s.", time() - start)
+
+    async def unsubscribe_to_realtime(self, instruments=None):
+        """
+        Called by receive_json when someones unsubscribes from the realtime data, or from some of
+        the instruments. Once no group is left, the subscription (instruments and filters) is reset.
+        """
+        start = time()
+        if instruments is None:
+            groups = set(self.joined_groups)
+        elif self.instruments is None:
+            # Subscribed to all the instruments, not to some of them
+            groups = set()
+        else:
+            self.instruments = self.instruments - instruments
+            groups = self.joined_groups - self.subscription_groups(self.instruments)
+        for group in groups:
+            logger.debug("Group Discarded on channel %s and group %s", self.channel_name, group)
+            await self.channel_layer.group_discard(group, self.channel_name)
+        memberships.dec(len(groups))
+        self.joined_groups -= groups
+        if not self.joined_groups:
+            self.instruments = None
+            self.filters = []
+        logger.debug("Elapsed time to unsubscribe from realtime %s.", time() - start)
+
+    async def data_send(self, message):
+        """
+        Called when someone has messaged our chat. The message holds [id, type, JSON text,
+        sequence number, route] items, one per notification.
+        """
+        message_logger.debug("Data update command received : %s", message)
+        start = time()
+        if "time" in message:
+            save_to_receive.observe(start - message["time"])
+        items = message["items"]
+        if self.last_seq or self.filters or self.instruments is not None:
+            matching = []
+            for item in items:
+                if item[3] <= self.last_seq:
+                    continue
+                if self.matches(item):
+                    matching.append(item)
+                elif self.positions is not None:
+                    # The orders leaving the subscription are taken out of the P&L
+                    self.positions.discard(item[0], item[4]["version"])
+            items = matching
+        if self.positions is not None:
+            for item in items:
+                self.positions.apply(item[0], item[4])
+        if not items:
+            return
+        if self.table_view is not None:
+            items = await self.locate(items)
+        if self.snapshot_task is not None:
+            self.held.extend(items)
+        else:
+            await self.forward(items)
+        elapsed = time() - start
+        receive_to_send.observe(elapsed)
+        message_logger.debug("Elapsed time to send data %s.", elapsed)
+
+    async def locate(self, items):
+        """
+        Adds the position of the new orders in the table shown by the client to their notifications.
+        """
+        new = [item for item in items if item[1] == "data.new"]
+        if not new or len(new) > MAX_LOCATED:
+            return items
+        positions = await self.get_positions_in_view(new)
+        return [
+            [item[0], item[1], self.table_view.annotate(item[2], positions[item[0]]), item[3], item[4]]
+            if item[1] == "data.new" else item
+            for item in items
+        ]
+
+    async def get_positions_in_view(self, items):
+        if self.table_view.is_default():
+            return self.table_view.locate(self.scope["user"], items)
+        return await database_sync_to_async(self.table_view.locate)(self.scope["user"], items)
+
+    async def forward(self, items):
+        """
+        Sends the items to the client, right away or at the end of the coalescing window.
+        """
+        if not self.flush_interval:
+            # Send a message down to the client
+            await self.enqueue(items)
+        else:
+            self.coalesce(items)
+            if len(self.pending) >= self.max_pending:
+                await self.flush()
+            elif self.flush_task is None:
+                self.flush_task = asyncio.ensure_future(self.flush_later(self.flush_interval))
+
+    def coalesce(self, items):
+        """
+        Collapses the notifications of each order : the deltas are merged and an order created
+        within the window stays a "data.new" notification so that the client inserts it.
+        """
+        for item in items:
+            previous = self.pending.get(item[0])
+            if previous is not None:
+                coalesced.inc()
+                item = merge_items(previous, item)
+            self.pending[item[0]] = item
+
+    async def flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """
+        Sends the pending notifications as one frame.
+        """
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        pending, self.pending = self.pending, {}
+        if pending:
+            await self.enqueue(list(pending.values()))
+
+    async def enqueue(self, items, apply_policy=True):
+        """
+        Queues the items to be sent as one frame by the writer task, applying the slow policy
+        when the connection is above its high-water mark.
+        """
+        if self.closing:
+            return
+        self.outbound.append(items)
+        self.queued += len(items)
+        outbound_queued.inc(len(items))
+        if apply_policy and self.queued > self.high_water_mark:
+            if not self.slow:
+                self.slow = True
+                slow_connections.inc()
+                logger.warning("Slow connection of user %s (%s) : %s notifications queued, %s",
+                               getattr(self.scope.get("user"), "id", None), self.channel_name, self.queued,
+                               self.slow_policy)
+            if self.slow_policy == DISCONNECT:
+                slow_disconnects.inc()
+                self.closing = True
+                self.clear_outbound()
+                await self.close(code=SLOW_CLOSE_CODE)
+                return
+            if self.slow_policy == CONFLATE:
+                self.conflate()
+            if self.queued > self.high_water_mark:
+                self.gap()
+        if self.writer_task is None:
+            self.writer_task = asyncio.ensure_future(self.write_outbound())
+
+    async def send_ordered(self, **frame):
+        """
+        Sends the frame (the arguments of send) right away, or queues it behind the notifications
+        waiting for the writer task.
+        """
+        if self.writer_task is None:
+            await self.send(**frame)
+        elif not self.closing:
+            self.outbound.append(frame)
+
+    def conflate(self):
+        """
+        Collapses the queued notifications to the latest state of each order, in one frame
+        between two of the other frames or of the gap frames.
+        """
+        outbound, latest = deque(), {}
+        for entry in self.outbound:
+            # The gap frames are kept apart too, the client only reads them as single objects
+            if isinstance(entry, dict) or entry[0][0] is None:
+                if latest:
+                    outbound.append(list(latest.values()))
+                    latest = {}
+                outbound.append(entry)
+                continue
+            for item in entry:
+                previous = latest.get(item[0])
+                latest[item[0]] = item if previous is None else merge_items(previous, item)
+        if latest:
+            outbound.append(list(latest.values()))
+        count = sum(len(entry) for entry in outbound if not isinstance(entry, dict))
+        slow_conflated.inc(self.queued - count)
+        outbound_queued.dec(self.queued - count)
+        self.outbound = outbound
+        self.queued = count
+
+    def gap(self):
+        """
+        Drops the queued notifications, replaced by a gap frame telling the client to resync,
+        followed by the other frames.
+        """
+        seq = max(item[3] for entry in self.outbound if not isinstance(entry, dict) for item in entry)
+        slow_dropped.inc(self.queued)
+        slow_gaps.inc()
+        outbound_queued.dec(self.queued)
+        # Sent as the notifications, without an item of an order
+        self.outbound = deque(
+            [[[None, "gap", encoding.dumps({"type": "gap", "seq": seq}), seq, None]]] +
+            [entry for entry in self.outbound if isinstance(entry, dict)]
         )
-        logger.debug("Elapsed time to send data {}.".format(time() - start))
+        self.queued = 1
+        outbound_queued.inc()
+
+    def clear_outbound(self):
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            self.writer_task = None
+        outbound_queued.dec(self.queued)
+        self.outbound.clear()
+        self.queued = 0
+        if self.slow:
+            self.slow = False
+            slow_connections.dec()
+
+    async def write_outbound(self):
+        """
+        Sends the queued frames until the queue is empty.
+        """
+        try:
+            while self.outbound:
+                items = self.outbound.popleft()
+                if isinstance(items, dict):
+                    await self.send(**items)
+                    continue
+                self.queued -= len(items)
+                outbound_queued.dec(len(items))
+                if self.slow and self.queued <= self.low_water_mark:
+                    self.slow = False
+                    slow_connections.dec()
+                await self.send_frame([item[2] for item in items])
+        finally:
+            if self.writer_task is asyncio.current_task():
+                self.writer_task = None
+
+    async def send_frame(self, texts):
+        """
+        Sends the already encoded notifications as one frame, without decoding them in JSON.
+        """
+        await self.send(**self.frame_encoder.notifications(texts))
+        frames_sent.inc()
+
+
+class MarketDataConsumer(AsyncJsonWebsocketConsumer):
+    """
+    This market data consumer serves the prices of the instruments a connection subscribes to.
+
+    The ticks are conflated per connection (see market.py) : every flush interval, the latest
+    price of each subscribed instrument changed since the previous frame is sent in one
+    {"type": "ticks", "symbols": [...], "prices": [...]} frame. The first frame following a
+    subscription holds the current price of the new instruments.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        config = market_settings()
+        # Conflation window in seconds
+        self.flush_interval = config["FLUSH_INTERVAL"] / 1000
+        self.min_flush_interval = config["MIN_FLUSH_INTERVAL"] / 1000
+        self.max_flush_interval = config["MAX_FLUSH_INTERVAL"] / 1000
+        self.max_instruments = config["MAX_INSTRUMENTS"]
+        self.feed = None
+        self.view = None
+        self.flush_task = None
+
+    async def connect(self):
+        """
+        Called when the websocket is handshaking as part of initial connection.
+        """
+        if self.scope["user"].is_anonymous:
+            # Reject the connection
+            await self.close()
+        else:
+            self.feed = get_market_feed()
+            self.view = MarketView(self.feed.book)
+            await self.accept()
+
+    async def receive_json(self, content):
+        """
+        Called with the subscribe, unsubscribe and instruments commands.
+        """
+        command = content.get("command", None)
+        try:
+            if command == "subscribe":
+                response = {"command": "subscribe", "status": "ok"}
+                if "flush_interval" in content:
+                    response["flush_interval"] = self.set_flush_interval(content["flush_interval"])
+                slots, unknown = self.feed.book.lookup(self.get_instruments(content.get("instruments")))
+                if len(np.union1d(self.view.slots, slots)) > self.max_instruments:
+                    raise ClientError("TOO_MANY_INSTRUMENTS")
+                self.view.add(slots)
+                if self.flush_task is None:
+                    self.feed.attach()
+                    self.flush_task = asyncio.ensure_future(self.flush_loop())
+                response["count"] = len(self.view)
+                if unknown:
+                    response["unknown"] = unknown
+                await self.send_json(response)
+            elif command == "unsubscribe":
+                if "instruments" in content:
+                    slots, _ = self.feed.book.lookup(self.get_instruments(content["instruments"]))
+                    self.view.remove(slots)
+                else:
+                    self.view.remove(self.view.slots)
+                if not len(self.view):
+                    self.stop()
+                await self.send_json({"command": "unsubscribe", "status": "ok", "count": len(self.view)})
+            elif command == "instruments":
+                await self.send_json({"command": "instruments", "data": self.feed.book.symbols})
+        except ClientError as e:
+            await self.send_json({"error": e.code})
+
+    async def disconnect(self, code):
+        """
+        Called when the WebSocket closes for any reason.
+        """
+        self.stop()
+
+    def set_flush_interval(self, flush_interval):
+        """
+        Sets the conflation window asked by the client in milliseconds, within the MIN_FLUSH_INTERVAL
+        and MAX_FLUSH_INTERVAL bounds. Returns the applied window in milliseconds.
+        """
+        if isinstance(flush_interval, bool) or not isinstance(flush_interval, (int, float)) or flush_interval <= 0:
+            raise ClientError("INVALID_FLUSH_INTERVAL")
+        self.flush_interval = min(max(flush_interval / 1000, self.min_flush_interval), self.max_flush_interval)
+        return self.flush_interval * 1000
+
+    def get_instruments(self, instruments):
+        if not isinstance(instruments, list) or not 0 < len(instruments) <= self.max_instruments or \
+                not all(isinstance(instrument, str) for instrument in instruments):
+            raise ClientError("INVALID_INSTRUMENTS")
+        return instruments
+
+    def stop(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+            self.feed.detach()
+
+    async def flush_loop(self):
+        """
+        Sends the changed prices at the end of each window.
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            frame = self.view.frame()
+            if frame is not None:
+                await self.send(text_data=frame)
+                market_frames_sent.inc()
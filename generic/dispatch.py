@@ -0,0 +1,283 @@
+"""
+Post-commit, non-blocking dispatch of the websocket notifications.
+
+Notifications are registered with transaction.on_commit so that a rolled back
+transaction never reaches the websocket clients, then handed to a Dispatcher.
+By default the dispatcher owns a background thread running a single event loop
+(hence a single channel layer connection) that performs the group_send calls,
+so a write returns without waiting on Redis.
+
+The behaviour is configured through the DATA_DISPATCH setting :
+
+    DATA_DISPATCH = {
+        "BACKGROUND": True,      # False sends inline, in the committing thread
+        "MAX_QUEUE_SIZE": 10000, # Notifications waiting to be sent
+        "POLICY": "block",       # "drop", "block" or "coalesce" when the queue is full
+        "BLOCK_TIMEOUT": 1.0,    # Seconds to wait for room before dropping
+        "INSTRUMENT_GROUPS": False, # Also send the notifications to the group of their instrument
+    }
+"""
+import asyncio
+import atexit
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+
+from asgiref.sync import async_to_sync
+import channels.layers
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "BACKGROUND": True,
+    "MAX_QUEUE_SIZE": 10000,
+    "POLICY": "block",
+    "BLOCK_TIMEOUT": 1.0,
+    "INSTRUMENT_GROUPS": False,
+}
+
+DROP = "drop"
+BLOCK = "block"
+COALESCE = "coalesce"
+POLICIES = (DROP, BLOCK, COALESCE)
+
+# Maximum number of notifications taken from the queue in one go by the sender
+BATCH_SIZE = 500
+
+submitted = metrics.counter("dispatch_submitted_total", "Notifications handed to the dispatcher")
+sent = metrics.counter("dispatch_sent_total", "Notifications sent to the channel layer")
+dropped = metrics.counter("dispatch_dropped_total", "Notifications dropped because the queue was full")
+coalesced = metrics.counter(
+    "dispatch_coalesced_total", "Notifications replaced by or merged with a newer one for the same key"
+)
+errors = metrics.counter("dispatch_errors_total", "Notifications that failed to be sent")
+queue_depth = metrics.gauge("dispatch_queue_depth", "Notifications waiting to be sent")
+save_to_send = metrics.histogram(
+    "dispatch_save_to_group_send_seconds", "Time from the save of the data to the group_send of its notification"
+)
+group_send_duration = metrics.histogram("dispatch_group_send_seconds", "Duration of the group_send calls")
+
+
+def observe_save_to_send(message):
+    # The "data.send" messages hold the time of the save of their oldest notification
+    if "time" in message:
+        save_to_send.observe(time() - message["time"])
+
+
+class Dispatcher:
+    """
+    Sends channel layer group messages, either inline or from a background sender thread.
+
+    Each message is submitted with an optional key. With the "coalesce" policy, a message
+    whose key is already waiting in the queue replaces the pending one, moved to the tail of the
+    queue so the messages are sent in the order of their latest sequence numbers, and only the
+    latest state is sent. A merge function can be given to combine the pending
+    message with the new one instead of replacing it.
+
+    With instrument_groups, the notifications are also sent to the group of their instrument : the
+    connections subscribed to some instruments join these groups instead of filtering the group of
+    the user. Each notification is then submitted twice.
+    """
+
+    def __init__(self, background=True, max_queue_size=10000, policy=BLOCK, block_timeout=1.0,
+                 channel_layer=None, alias=channels.layers.DEFAULT_CHANNEL_LAYER, instrument_groups=False):
+        if policy not in POLICIES:
+            raise ValueError("Unknown dispatch policy {!r}, expected one of {}".format(policy, POLICIES))
+        self.background = background
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.instrument_groups = instrument_groups
+        self.alias = alias
+        self._channel_layer = channel_layer
+        self._pending = OrderedDict()
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULTS, **getattr(settings, "DATA_DISPATCH", {}))
+        return cls(
+            background=config["BACKGROUND"],
+            max_queue_size=config["MAX_QUEUE_SIZE"],
+            policy=config["POLICY"],
+            block_timeout=config["BLOCK_TIMEOUT"],
+            instrument_groups=config["INSTRUMENT_GROUPS"],
+        )
+
+    @property
+    def channel_layer(self):
+        if self._channel_layer is None:
+            self._channel_layer = channels.layers.get_channel_layer(self.alias)
+        return self._channel_layer
+
+    def submit(self, group, message, key=None, merge=None):
+        """
+        Queues the message for the group. Returns False if it was dropped.
+        """
+        submitted.inc()
+        if not self.background:
+            self._send_inline(group, message)
+            return True
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Dispatcher is closed")
+            self._ensure_started()
+
+            if key is not None and self.policy == COALESCE:
+                key = (group, key)
+                if key in self._pending:
+                    if merge is not None:
+                        message = merge(self._pending[key][1], message)
+                    self._pending[key] = (group, message)
+                    # Sent after the messages submitted meanwhile, in the order of the stream
+                    self._pending.move_to_end(key)
+                    coalesced.inc()
+                    return True
+            else:
+                key = None
+
+            if len(self._pending) >= self.max_queue_size:
+                if self.policy == DROP or not self._wait_for_room():
+                    dropped.inc()
+                    logger.warning("Dispatch queue full, notification to %s dropped", group)
+                    return False
+
+            self._pending[key if key is not None else next(self._sequence)] = (group, message)
+            queue_depth.set(len(self._pending))
+            self._condition.notify_all()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued notification has been sent. Returns False on timeout.
+        """
+        if not self.background:
+            return True
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._in_flight, timeout)
+
+    def close(self, timeout=5.0):
+        """
+        Sends the remaining notifications and stops the sender thread.
+        """
+        self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _wait_for_room(self):
+        deadline = monotonic() + self.block_timeout
+        while len(self._pending) >= self.max_queue_size:
+            remaining = deadline - monotonic()
+            if remaining <= 0 or self._closed:
+                return False
+            self._condition.wait(remaining)
+        return True
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="data-dispatcher", daemon=True)
+            self._thread.start()
+
+    def _send_inline(self, group, message):
+        observe_save_to_send(message)
+        try:
+            with group_send_duration.time():
+                async_to_sync(self.channel_layer.group_send)(group, message)
+        except Exception:
+            errors.inc()
+            logger.exception("Unable to send notification to %s", group)
+        else:
+            sent.inc()
+
+    def _take_batch(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending or self._closed)
+            batch = []
+            while self._pending and len(batch) < BATCH_SIZE:
+                batch.append(self._pending.popitem(last=False)[1])
+            self._in_flight = len(batch)
+            queue_depth.set(len(self._pending))
+            # Wake up the writers waiting for room
+            self._condition.notify_all()
+            return batch
+
+    def _run(self):
+        # The sender owns its event loop, hence one channel layer connection for the process
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    break
+                loop.run_until_complete(self._send_batch(batch))
+                with self._condition:
+                    self._in_flight = 0
+                    self._condition.notify_all()
+        finally:
+            loop.close()
+
+    async def _send_batch(self, batch):
+        # Messages are sent one after the other to keep their order within a group
+        for group, message in batch:
+            observe_save_to_send(message)
+            start = monotonic()
+            try:
+                await self.channel_layer.group_send(group, message)
+                group_send_duration.observe(monotonic() - start)
+            except Exception:
+                errors.inc()
+                logger.exception("Unable to send notification to %s", group)
+            else:
+                sent.inc()
+
+
+_dispatcher = None
+_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """
+    Returns the process dispatcher, built from the settings on first use.
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        with _lock:
+            if _dispatcher is None:
+                _dispatcher = Dispatcher.from_settings()
+    return _dispatcher
+
+
+def reset_dispatcher():
+    """
+    Closes the process dispatcher so that the next use rebuilds it.
+    """
+    global _dispatcher
+    with _lock:
+        dispatcher, _dispatcher = _dispatcher, None
+    if dispatcher is not None:
+        dispatcher.close()
+
+
+def _settings_changed(setting, **kwargs):
+    if setting in ("DATA_DISPATCH", "CHANNEL_LAYERS"):
+        reset_dispatcher()
+
+
+setting_changed.connect(_settings_changed)
+atexit.register(reset_dispatcher)
+
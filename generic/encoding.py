@@ -0,0 +1,169 @@
+"""
+JSON encoding of the websocket notifications.
+
+The notifications are encoded once, when they are broadcast, and the resulting text travels
+untouched through the channel layer down to the websocket frames. orjson is used when it is
+installed, the standard library json module otherwise.
+
+A connection can ask for binary MessagePack frames, and for the compression of its large frames,
+with the sub-protocol of its handshake (or the "format" and "compress" query parameters) :
+
+    json              text frames, the default
+    json+deflate      text frames, the frames of at least COMPRESS_MIN_SIZE bytes zlib compressed in binary frames
+    msgpack           binary MessagePack frames
+    msgpack+deflate   binary MessagePack frames, zlib compressed from COMPRESS_MIN_SIZE bytes
+
+A compressed frame starts with the zlib header (0x78), which never starts a MessagePack frame (a
+map or an array). The MessagePack frames are transcoded from the JSON text per connection, which is
+only cheap with the C extension of msgpack.
+"""
+import json
+import zlib
+from time import perf_counter
+
+import msgpack
+
+from . import metrics
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(content):
+        """
+        Returns the compact JSON text of content.
+        """
+        return orjson.dumps(content).decode()
+
+    loads = orjson.loads
+else:  # pragma: no cover
+    _encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def dumps(content):
+        """
+        Returns the compact JSON text of content.
+        """
+        return _encoder.encode(content)
+
+    loads = json.loads
+
+
+def join(texts):
+    """
+    Returns the frame holding the already encoded notifications : the notification itself when
+    there is only one, their JSON list otherwise.
+    """
+    if len(texts) == 1:
+        return texts[0]
+    return "[" + ",".join(texts) + "]"
+
+
+def packb(content):
+    """
+    Returns the MessagePack bytes of content, its strings as str (not raw bytes).
+    """
+    return msgpack.packb(content, use_bin_type=True)
+
+
+def legacy_frame(text):
+    """
+    Wraps a frame in the envelope expected by the old clients, where the notifications are
+    a JSON encoded string in the "content" key.
+    """
+    return json.dumps({"type": "data.send", "content": text})
+
+
+JSON = "json"
+MSGPACK = "msgpack"
+FORMATS = (JSON, MSGPACK)
+
+# Sub-protocols of the websocket handshake : (format, compress)
+SUBPROTOCOLS = {
+    "json": (JSON, False),
+    "json+deflate": (JSON, True),
+    "msgpack": (MSGPACK, False),
+    "msgpack+deflate": (MSGPACK, True),
+}
+
+# Upper bounds in seconds of the buckets of the encoding times
+ENCODE_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+
+frame_bytes = {
+    JSON: metrics.counter("stream_json_frame_bytes_total", "Bytes of the JSON frames sent, after compression"),
+    MSGPACK: metrics.counter(
+        "stream_msgpack_frame_bytes_total", "Bytes of the MessagePack frames sent, after compression"
+    ),
+}
+frame_counts = {
+    JSON: metrics.counter("stream_json_frames_total", "JSON frames sent"),
+    MSGPACK: metrics.counter("stream_msgpack_frames_total", "MessagePack frames sent"),
+}
+compressed_frames = metrics.counter("stream_compressed_frames_total", "Frames sent zlib compressed")
+compression_saved = metrics.counter(
+    "stream_compression_saved_bytes_total", "Bytes saved by the compression of the frames"
+)
+encode_seconds = metrics.histogram(
+    "stream_frame_encode_seconds", "Time spent encoding a frame for its connection", buckets=ENCODE_BUCKETS
+)
+
+
+class FrameEncoder:
+    """
+    Encodes the frames of a connection in its format, compressing the ones of at least
+    compress_min_size bytes when asked. Returns the keyword arguments of the consumer send.
+    """
+
+    def __init__(self, format=JSON, compress=False, compress_min_size=4096, compress_level=1, legacy=False):
+        if format not in FORMATS:
+            raise ValueError("Unknown frame format {!r}, expected one of {}".format(format, FORMATS))
+        self.format = format
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        # The envelope of the old clients only exists in JSON
+        self.legacy = legacy and format == JSON
+
+    def notifications(self, texts):
+        """
+        Encodes the frame of the already encoded notifications, see join.
+        """
+        start = perf_counter()
+        if self.format == MSGPACK:
+            content = loads(texts[0]) if len(texts) == 1 else [loads(text) for text in texts]
+            return self._finish(packb(content), start)
+        frame = join(texts)
+        if self.legacy:
+            frame = legacy_frame(frame)
+        return self._finish(frame, start)
+
+    def text(self, text):
+        """
+        Encodes the frame of a JSON text.
+        """
+        start = perf_counter()
+        return self._finish(packb(loads(text)) if self.format == MSGPACK else text, start)
+
+    def content(self, content):
+        """
+        Encodes the frame of a JSON serializable content.
+        """
+        start = perf_counter()
+        return self._finish(packb(content) if self.format == MSGPACK else dumps(content), start)
+
+    def _finish(self, data, start):
+        # The text frames are counted in characters, their bytes for the ASCII notifications
+        size = len(data)
+        if self.compress and size >= self.compress_min_size:
+            compressed = zlib.compress(data.encode() if isinstance(data, str) else data, self.compress_level)
+            compressed_frames.inc()
+            compression_saved.inc(size - len(compressed))
+            data = compressed
+        encode_seconds.observe(perf_counter() - start)
+        frame_counts[self.format].inc()
+        frame_bytes[self.format].inc(len(data))
+        if isinstance(data, str):
+            return {"text_data": data}
+        return {"bytes_data": data}
@@ -0,0 +1,85 @@
+"""
+Streaming export of the orders in CSV or NDJSON (one JSON object per line).
+
+The rows are read with values_list and a server side iterator, and written chunk by chunk
+to a StreamingHttpResponse, so the memory used doesn't depend on the number of orders. They
+can be gzipped on the fly.
+"""
+import csv
+import io
+import zlib
+
+from django.http import StreamingHttpResponse
+
+from . import encoding
+
+# Exported columns, and the fields they are read from
+COLUMNS = ("id", "user", "instrument", "quantity", "initial_price", "version")
+FIELDS = ("id", "user_id", "instrument", "quantity", "initial_price", "version")
+
+# Rows read from the database and written at once
+CHUNK_SIZE = 2000
+
+CSV = "csv"
+NDJSON = "ndjson"
+CONTENT_TYPES = {
+    CSV: "text/csv",
+    NDJSON: "application/x-ndjson",
+}
+
+
+def chunks(queryset):
+    """
+    Iterates over the lists of CHUNK_SIZE rows of the queryset, as tuples of FIELDS.
+    """
+    chunk = []
+    for row in queryset.values_list(*FIELDS).iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_lines(queryset):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for chunk in chunks(queryset):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header of an empty export
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def ndjson_lines(queryset):
+    for chunk in chunks(queryset):
+        yield "".join(encoding.dumps(dict(zip(COLUMNS, row))) + "\n" for row in chunk)
+
+
+def gzipped(texts):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for text in texts:
+        data = compressor.compress(text.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(queryset, output=CSV, compress=False, filename="orders"):
+    """
+    Returns the StreamingHttpResponse of the orders of the queryset in the output format.
+    """
+    texts = csv_lines(queryset) if output == CSV else ndjson_lines(queryset)
+    filename += "." + output
+    if compress:
+        response = StreamingHttpResponse(gzipped(texts), content_type="application/gzip")
+        filename += ".gz"
+    else:
+        response = StreamingHttpResponse(texts, content_type=CONTENT_TYPES[output] + "; charset=utf-8")
+    response["Content-Disposition"] = 'attachment; filename="{}"'.format(filename)
+    return response
@@ -0,0 +1,350 @@
+"""
+Channel layer sharded across several Redis instances by consistent hashing.
+
+The RedisChannelLayer of channels_redis already spreads the groups and the channels over its
+hosts, but by ranges of a CRC : adding or removing a host moves almost every group to another
+one. The ShardedRedisChannelLayer places each host on a hash ring (REPLICAS points per host), so
+a change of the hosts only moves the groups of the changed host. The groups of a user (its
+realtime group and the groups of its instruments, see models.group_name) share their shard,
+hashed on the part matched by shard_key. Each host has its own connection pools, as in
+RedisChannelLayer.
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "generic.layers.ShardedRedisChannelLayer",
+            "CONFIG": {
+                "hosts": [("redis-1", 6379), ("redis-2", 6379), ("redis-3", 6379)],
+            },
+        },
+    }
+
+The shards are checked by the /health/channels view.
+
+The HybridChannelLayer wraps a shared layer (RedisChannelLayer or ShardedRedisChannelLayer) and
+keeps the groups of the channels of its process : a group_send is delivered to the local members
+through in memory queues, from any thread, and published once to the shared layer for the other
+processes, which only hold a process channel per group. The process drops its own publications.
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "generic.layers.HybridChannelLayer",
+            "CONFIG": {
+                "remote": {"BACKEND": "channels_redis.core.RedisChannelLayer", "CONFIG": {"hosts": [...]}},
+            },
+        },
+    }
+
+A local channel is forgotten when its receive is cancelled, as the consumers do when they stop.
+As with the other layers, each local channel receives its own copy of the message.
+"""
+import asyncio
+import bisect
+import hashlib
+import random
+import re
+import string
+import threading
+from copy import deepcopy
+from time import monotonic
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from channels_redis.core import RedisChannelLayer
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+# Points of each host on the ring
+REPLICAS = 160
+
+# Groups sharded on the user : realtime_<user id>, and the instrument groups realtime_<user id>.i-<instrument>
+SHARD_KEY = r"^(realtime_[^.]+)"
+
+# Seconds a shard has to answer the health check
+HEALTH_TIMEOUT = 1.0
+
+# Keys added to the messages published to the shared layer by the HybridChannelLayer
+ORIGIN_KEY = "__origin__"
+GROUP_KEY = "__group__"
+CHANNEL_KEY = "__channel__"
+ENVELOPE_KEYS = (ORIGIN_KEY, GROUP_KEY, CHANNEL_KEY)
+
+local_messages = metrics.counter(
+    "layer_local_messages_total", "Messages delivered to the channels of the process without the shared layer"
+)
+remote_messages = metrics.counter(
+    "layer_remote_messages_total", "Messages published to the shared layer for the other processes"
+)
+
+
+def ring_hash(value):
+    if isinstance(value, str):
+        value = value.encode("utf8")
+    return int.from_bytes(hashlib.md5(value).digest()[:4], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring of the nodes, each placed at replicas points.
+    """
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        points = sorted(
+            (ring_hash("{}-{}".format(node, replica)), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.indexes = [index for _, index in points]
+
+    def get(self, key):
+        """
+        Returns the index of the node owning the key : the node of the first point following its hash.
+        """
+        position = bisect.bisect(self.hashes, ring_hash(key))
+        return self.indexes[position % len(self.indexes)]
+
+
+def node_name(host):
+    """
+    Returns the name of a decoded host on the ring, its address, so that the order of the hosts doesn't matter.
+    """
+    address = host.get("address", host)
+    if isinstance(address, (list, tuple)):
+        return "{}:{}".format(*address)
+    return str(address)
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer placing the groups and the channels on its hosts by consistent hashing.
+    """
+
+    def __init__(self, hosts=None, shard_key=SHARD_KEY, replicas=REPLICAS, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.shard_key = re.compile(shard_key) if shard_key else None
+        self.ring = HashRing([node_name(host) for host in self.hosts], replicas)
+
+    def consistent_hash(self, value):
+        if isinstance(value, bytes):
+            value = value.decode("utf8")
+        if "!" in value:
+            # The process local channels live on the shard of their process, where they are received
+            # (RedisChannelLayer.send hashes their full name)
+            return self.ring.get(value[:value.index("!") + 1])
+        if self.shard_key is not None:
+            match = self.shard_key.match(value)
+            if match:
+                value = match.group(1)
+        return self.ring.get(value)
+
+    async def shard_health(self, timeout=HEALTH_TIMEOUT):
+        """
+        Returns the state of each shard : its host, whether it answers, its response time
+        and the memory and clients reported by Redis.
+        """
+        return await asyncio.gather(*(self.check_shard(index, timeout) for index in range(self.ring_size)))
+
+    async def check_shard(self, index, timeout=HEALTH_TIMEOUT):
+        health = {"shard": index, "host": node_name(self.hosts[index])}
+        start = monotonic()
+        try:
+            # The connection of the pool is made within the timeout too
+            info = await asyncio.wait_for(self.shard_info(index), timeout)
+        except Exception as e:
+            health.update(status="down", error=str(e) or e.__class__.__name__)
+        else:
+            health.update(
+                status="up",
+                response_ms=round((monotonic() - start) * 1000, 3),
+                used_memory=info.get("memory", {}).get("used_memory"),
+                connected_clients=info.get("clients", {}).get("connected_clients"),
+            )
+        return health
+
+    async def shard_info(self, index):
+        async with self.connection(index) as connection:
+            await connection.ping()
+            return await connection.info()
+
+
+class LocalChannel:
+    """
+    Queue of a channel received in this process, and the event loop receiving it.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    """
+    Channel layer delivering the messages to the channels of its process directly, and to the
+    other processes through the remote layer.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, remote=None, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        remote = remote or {"BACKEND": "channels_redis.core.RedisChannelLayer"}
+        self.remote = import_string(remote["BACKEND"])(**remote.get("CONFIG", {}))
+        # Local channel name : LocalChannel
+        self.channels = {}
+        # Group : names of its local channels
+        self.groups = {}
+        # Channel of the remote layer receiving the messages of the other processes for the local channels
+        self.process_channel = None
+        self._receiver = None
+        # The groups are sent to from the dispatcher thread
+        self._lock = threading.Lock()
+
+    async def new_channel(self, prefix="specific"):
+        if self.process_channel is None:
+            self.process_channel = await self.remote.new_channel("hybrid")
+        loop = asyncio.get_event_loop()
+        if self._receiver is None or self._receiver.done() or self._receiver.get_loop() is not loop:
+            self._receiver = loop.create_task(self._receive_remote())
+        # <process channel>.<local part> : the other processes send to the process channel
+        channel = "{}.{}".format(self.process_channel, "".join(random.choice(string.ascii_letters) for i in range(12)))
+        self.channels[channel] = LocalChannel(loop)
+        return channel
+
+    def process_of(self, channel):
+        """
+        Returns the process channel of a channel made by a HybridChannelLayer, None for the other channels.
+        """
+        process, _, local = channel.rpartition(".")
+        if "!" in process and local and "." not in process[process.index("!"):]:
+            return process
+        return None
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+        if channel in self.channels:
+            if not self._deliver(channel, message):
+                raise ChannelFull(channel)
+            return
+        process = self.process_of(channel)
+        if process is None:
+            await self.remote.send(channel, message)
+        else:
+            await self.remote.send(process, dict(message, **{CHANNEL_KEY: channel}))
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        local = self.channels.get(channel)
+        if local is None:
+            return await self.remote.receive(channel)
+        try:
+            return await local.queue.get()
+        except asyncio.CancelledError:
+            self._forget(channel)
+            raise
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if channel not in self.channels:
+            await self.remote.group_add(group, channel)
+            return
+        with self._lock:
+            self.groups.setdefault(group, set()).add(channel)
+        # Also refreshes the expiry of the membership of the process
+        await self.remote.group_add(group, self.process_channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if channel not in self.channels:
+            await self.remote.group_discard(group, channel)
+            return
+        if self._discard(group, channel):
+            await self.remote.group_discard(group, self.process_channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        self._deliver_group(group, message)
+        remote_messages.inc()
+        await self.remote.group_send(group, dict(message, **{GROUP_KEY: group, ORIGIN_KEY: self.process_channel}))
+
+    async def flush(self):
+        with self._lock:
+            self.channels = {}
+            self.groups = {}
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        await self.remote.flush()
+
+    def _deliver(self, channel, message):
+        """
+        Queues a copy of the message on the local channel, from any thread. Returns False when the
+        channel is full.
+        """
+        local = self.channels.get(channel)
+        if local is None:
+            return True
+        if local.queue.qsize() >= self.get_capacity(channel):
+            return False
+        local_messages.inc()
+        # The receivers of a group, and the sender, must not see the changes of each other
+        message = deepcopy(message)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is local.loop:
+            local.queue.put_nowait(message)
+        elif not local.loop.is_closed():
+            local.loop.call_soon_threadsafe(local.queue.put_nowait, message)
+        return True
+
+    def _deliver_group(self, group, message):
+        with self._lock:
+            channels = list(self.groups.get(group, ()))
+        for channel in channels:
+            # As the other layers, a full channel misses the messages of its groups
+            self._deliver(channel, message)
+
+    async def _receive_remote(self):
+        """
+        Delivers the messages of the other processes to the local channels.
+        """
+        while True:
+            message = await self.remote.receive(self.process_channel)
+            channel, group, origin = (message.get(key) for key in (CHANNEL_KEY, GROUP_KEY, ORIGIN_KEY))
+            # Without the envelope, copied for each local channel by _deliver
+            message = {key: value for key, value in message.items() if key not in ENVELOPE_KEYS}
+            if channel is not None:
+                self._deliver(channel, message)
+            elif group is not None and origin != self.process_channel:
+                # The local channels already have the messages sent from this process
+                self._deliver_group(group, message)
+
+    def _discard(self, group, channel):
+        """
+        Removes the local channel from the group, returns True when it was its last local channel.
+        """
+        with self._lock:
+            channels = self.groups.get(group)
+            if channels is None or channel not in channels:
+                return False
+            channels.discard(channel)
+            if channels:
+                return False
+            del self.groups[group]
+            return True
+
+    def _forget(self, channel):
+        self.channels.pop(channel, None)
+        with self._lock:
+            groups = [group for group, channels in self.groups.items() if channel in channels]
+        for group in groups:
+            if self._discard(group, channel):
+                asyncio.ensure_future(self.remote.group_discard(group, self.process_channel))
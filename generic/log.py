@@ -0,0 +1,111 @@
+"""
+Logging of the notification hot path.
+
+The per-message events (each save, each notification received by a consumer) go through a
+SampledLogger : only one call in SAMPLE_RATE is logged, and the message is only formatted when
+it is. The handlers of settings.LOGGING are wrapped in a QueueHandler : the records are queued
+and written by a listener thread, so the event loop and the writing threads never wait on the
+console or the log file.
+
+    DATA_LOGGING = {
+        "SAMPLE_RATE": 100,  # One per-message event logged in SAMPLE_RATE, 1 logs them all
+    }
+"""
+import itertools
+import logging
+import logging.handlers
+import queue
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+DEFAULTS = {
+    "SAMPLE_RATE": 100,
+}
+
+dropped = metrics.counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+
+
+def logging_settings():
+    return dict(DEFAULTS, **getattr(settings, "DATA_LOGGING", {}))
+
+
+class SampledLogger(logging.LoggerAdapter):
+    """
+    Logger adapter logging one call in sample_rate (SAMPLE_RATE by default) of the enabled levels.
+    """
+
+    def __init__(self, logger, sample_rate=None):
+        super().__init__(logger, {})
+        self.sample_rate = sample_rate
+        self._calls = itertools.count()
+
+    def isEnabledFor(self, level):
+        if not self.logger.isEnabledFor(level):
+            return False
+        sample_rate = self.sample_rate or logging_settings()["SAMPLE_RATE"]
+        return next(self._calls) % sample_rate == 0
+
+
+def sampled(name):
+    """
+    Returns the sampled logger of the per-message events of the module.
+    """
+    return SampledLogger(logging.getLogger(name))
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Non blocking handler : the records are queued and handed to the target handlers by a
+    listener thread. Configured in settings.LOGGING with the targets as dicts of their class and
+    arguments, they share the formatter of the queue handler :
+
+        "queue": {
+            "class": "generic.log.QueueHandler",
+            "targets": [{"class": "logging.FileHandler", "filename": "debug.log"}],
+            "formatter": "standard",
+        }
+
+    The records are dropped (and counted) when max_size of them are waiting.
+    """
+
+    def __init__(self, targets=(), max_size=10000):
+        super().__init__(queue.Queue(max_size))
+        self.targets = []
+        for target in targets:
+            target = dict(target)
+            self.targets.append(import_string(target.pop("class"))(**target))
+        self.listener = logging.handlers.QueueListener(self.queue, *self.targets, respect_handler_level=True)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        # The targets format the records, in the listener thread
+        for target in self.targets:
+            target.setFormatter(fmt)
+
+    def prepare(self, record):
+        """
+        Merges the arguments into the message, as they can change once queued, and leaves the
+        formatting to the targets. The record is not copied, the merged message is the same for
+        the other handlers.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped.inc()
+
+    def close(self):
+        # Writes the queued records
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for target in self.targets:
+            target.close()
+        super().close()
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from generic import changefeed
+
+
+class Command(BaseCommand):
+    help = "Sends the websocket notifications of the changes made to the orders, from the PostgreSQL triggers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", help="Database to listen to")
+        parser.add_argument("--timeout", type=float, default=5.0, help="Seconds between two checks of the connection")
+
+    def handle(self, *args, **options):
+        if not changefeed.notify_mode():
+            self.stderr.write("DATA_CHANGE_FEED is not in the \"notify\" mode, the NOTIFY trigger is disabled")
+        try:
+            changefeed.listen(using=options["database"], timeout=options["timeout"])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,249 @@
+"""
+Market data : prices of the instruments fed by a tick source and fanned out to the websockets.
+
+The ticks are written in NumPy arrays indexed by instrument (the MarketBook) : the price of
+the instrument and the version of the book it was last changed in. Each connection keeps
+the versions it sent for its instruments (a MarketView), and at the end of its flush interval
+sends the latest price of the instruments changed since, whatever the number of ticks
+received meanwhile. The hot path (a tick) is a vectorised array assignment, the work of a
+connection depends on its flush interval and not on the tick rate.
+
+The source is configured through the MARKET_DATA setting :
+
+    MARKET_DATA = {
+        "SOURCE": "generic.market.SyntheticTickSource",
+        "OPTIONS": {"instruments": 1000, "rate": 10000},  # Arguments of the source
+        "FLUSH_INTERVAL": 100,       # Default window of a connection in milliseconds
+        "MAX_FLUSH_INTERVAL": 5000,  # Bounds of the window a client can ask for
+        "MIN_FLUSH_INTERVAL": 10,
+        "MAX_INSTRUMENTS": 10000,    # Instruments a connection can subscribe to
+    }
+
+The feed runs in the event loop of the websocket consumers while at least one of them is
+subscribed, the book lives in the process memory.
+"""
+import asyncio
+import logging
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from . import encoding
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "SOURCE": "generic.market.SyntheticTickSource",
+    "OPTIONS": {},
+    "FLUSH_INTERVAL": 100,
+    "MAX_FLUSH_INTERVAL": 5000,
+    "MIN_FLUSH_INTERVAL": 10,
+    "MAX_INSTRUMENTS": 10000,
+}
+
+ticks_received = metrics.counter("market_ticks_total", "Ticks received from the market data source")
+frames_sent = metrics.counter("market_frames_sent_total", "Market data frames sent to the websocket clients")
+
+
+def market_settings():
+    return dict(DEFAULTS, **getattr(settings, "MARKET_DATA", {}))
+
+
+class TickSource:
+    """
+    Base class of the market data sources.
+
+    instruments() returns the symbols and their initial prices, and ticks() iterates
+    asynchronously over the batches of ticks as (slots, prices) arrays, the slots being the
+    positions of the instruments in the symbols.
+    """
+
+    def instruments(self):
+        raise NotImplementedError
+
+    async def ticks(self):
+        raise NotImplementedError
+        yield
+
+
+class SyntheticTickSource(TickSource):
+    """
+    Random walk of the prices of generated (or given) instruments, for the tests and the demo.
+    """
+
+    def __init__(self, symbols=None, instruments=1000, rate=10000, batch_size=100, volatility=0.001,
+                 initial_price=100.0, seed=None):
+        self.symbols = list(symbols) if symbols is not None else ["SYN{:05d}".format(i) for i in range(instruments)]
+        self.rate = rate
+        self.batch_size = batch_size
+        self.volatility = volatility
+        self.random = np.random.default_rng(seed)
+        self.prices = np.full(len(self.symbols), initial_price, dtype=np.float64)
+
+    def instruments(self):
+        return self.symbols, self.prices.copy()
+
+    async def ticks(self):
+        # Buffer of the price moves, filled in place on each batch
+        moves = np.empty(self.batch_size, dtype=np.float64)
+        delay = self.batch_size / self.rate
+        while True:
+            slots = self.random.integers(0, len(self.symbols), self.batch_size)
+            self.random.standard_normal(out=moves)
+            moves *= self.volatility
+            np.exp(moves, out=moves)
+            prices = self.prices[slots] * moves
+            self.prices[slots] = prices
+            yield slots, prices
+            await asyncio.sleep(delay)
+
+
+class MarketBook:
+    """
+    Latest price of each instrument, and the version of the book it changed in.
+    """
+
+    def __init__(self, symbols, prices):
+        self.symbols = list(symbols)
+        self.index = {symbol: slot for slot, symbol in enumerate(self.symbols)}
+        self.prices = np.array(prices, dtype=np.float64)
+        self.versions = np.zeros(len(self.symbols), dtype=np.int64)
+        self.version = 0
+
+    def apply(self, slots, prices):
+        """
+        Records a batch of ticks, the last one wins when an instrument appears more than once.
+        """
+        self.version += 1
+        self.prices[slots] = prices
+        self.versions[slots] = self.version
+
+    def lookup(self, symbols):
+        """
+        Returns the slots of the known symbols, and the unknown ones.
+        """
+        slots = []
+        unknown = []
+        for symbol in symbols:
+            slot = self.index.get(symbol)
+            if slot is None:
+                unknown.append(symbol)
+            else:
+                slots.append(slot)
+        return np.array(slots, dtype=np.intp), unknown
+
+
+class MarketView:
+    """
+    Instruments subscribed by a connection, and the versions of their prices it was sent.
+    """
+
+    def __init__(self, book):
+        self.book = book
+        self.slots = np.empty(0, dtype=np.intp)
+        self.sent = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, slots):
+        """
+        Subscribes to the instruments, their current price is part of the next changes.
+        """
+        slots = np.setdiff1d(slots, self.slots)
+        self.slots = np.concatenate((self.slots, slots))
+        self.sent = np.concatenate((self.sent, np.full(len(slots), -1, dtype=np.int64)))
+
+    def remove(self, slots):
+        kept = ~np.isin(self.slots, slots)
+        self.slots = self.slots[kept]
+        self.sent = self.sent[kept]
+
+    def changes(self):
+        """
+        Returns the slots and latest prices of the instruments changed since the last call.
+        """
+        versions = self.book.versions[self.slots]
+        changed = np.flatnonzero(versions != self.sent)
+        self.sent[changed] = versions[changed]
+        slots = self.slots[changed]
+        return slots, self.book.prices[slots]
+
+    def frame(self):
+        """
+        Returns the {"type": "ticks", "symbols": [...], "prices": [...]} text of the changes,
+        None when there are none.
+        """
+        slots, prices = self.changes()
+        if not len(slots):
+            return None
+        symbols = self.book.symbols
+        return encoding.dumps({
+            "type": "ticks",
+            "symbols": [symbols[slot] for slot in slots.tolist()],
+            "prices": prices.tolist(),
+        })
+
+
+class MarketFeed:
+    """
+    Reads the ticks of the source into the book while connections are attached to it.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.book = MarketBook(*source.instruments())
+        self.subscribers = 0
+        self.task = None
+
+    def attach(self):
+        self.subscribers += 1
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def detach(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        try:
+            async for slots, prices in self.source.ticks():
+                self.book.apply(slots, prices)
+                ticks_received.inc(len(slots))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Market data source failed")
+            self.task = None
+
+
+_feed = None
+_lock = threading.Lock()
+
+
+def get_market_feed():
+    """
+    Returns the process market data feed, built from the settings on first use.
+    """
+    global _feed
+    if _feed is None:
+        with _lock:
+            if _feed is None:
+                config = market_settings()
+                _feed = MarketFeed(import_string(config["SOURCE"])(**config["OPTIONS"]))
+    return _feed
+
+
+def _settings_changed(setting, **kwargs):
+    global _feed
+    if setting == "MARKET_DATA":
+        _feed = None
+
+
+setting_changed.connect(_settings_changed)
@@ -0,0 +1,224 @@
+"""
+In process metrics of the data stream : counters, gauges and latency histograms.
+
+The metrics are registered once per module and updated on the hot path with a lock held for
+a few operations only. They are exposed in the Prometheus text format on the /metrics endpoint
+(see views.metrics), for the staff users or the scrapers sending the DATA_METRICS["TOKEN"] bearer token :
+
+    DATA_METRICS = {
+        "TOKEN": None,
+    }
+
+Each process exposes its own metrics, each of the workers has to be scraped.
+"""
+import bisect
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+from django.conf import settings
+
+DEFAULTS = {
+    "TOKEN": None,
+}
+
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def metrics_settings():
+    return dict(DEFAULTS, **getattr(settings, "DATA_METRICS", {}))
+
+
+class Counter:
+    """
+    Monotonically increasing value (messages sent, messages dropped...).
+    """
+
+    def __init__(self, name, documentation=""):
+        self.name = name
+        self.documentation = documentation
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            self._value = 0
+
+
+class Gauge:
+    """
+    Value that can go up and down (queue depth, open connections...).
+    """
+
+    def __init__(self, name, documentation=""):
+        self.name = name
+        self.documentation = documentation
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def reset(self):
+        self.set(0)
+
+
+class Histogram:
+    """
+    Distribution of observed values (latencies...) in cumulative buckets, with their count and sum.
+    """
+
+    def __init__(self, name, documentation="", buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # Count per bucket, the last one for the values above the highest bound
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        Observes the duration of the block in seconds.
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start)
+
+    def cumulative(self):
+        """
+        Returns the [(upper bound, count of the values below it)] of the buckets, the last one
+        for infinity, with the sum of the values.
+        """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            count += bucket_count
+            cumulative.append((bound, count))
+        return cumulative, total
+
+    @property
+    def value(self):
+        with self._lock:
+            return {"count": sum(self._counts), "sum": self._sum}
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._sum = 0.0
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    Process wide collection of the metrics, indexed by name.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError("Metric {} already registered with another type".format(metric.name))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def collect(self):
+        """
+        Returns a {name: value} snapshot of all the registered metrics.
+        """
+        return {name: metric.value for name, metric in sorted(self._metrics.items())}
+
+    def exposition(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            if metric.documentation:
+                documentation = metric.documentation.replace("\\", "\\\\").replace("\n", "\\n")
+                lines.append("# HELP {} {}".format(name, documentation))
+            lines.append("# TYPE {} {}".format(name, kind))
+            if kind == "histogram":
+                buckets, total = metric.cumulative()
+                for bound, count in buckets:
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, format_value(bound), count))
+                lines.append("{}_sum {}".format(name, format_value(total)))
+                lines.append("{}_count {}".format(name, buckets[-1][1]))
+            else:
+                lines.append("{} {}".format(name, format_value(metric.value)))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation=""):
+    """
+    Returns the counter registered under name, creating it if needed.
+    """
+    return REGISTRY.register(Counter(name, documentation))
+
+
+def gauge(name, documentation=""):
+    """
+    Returns the gauge registered under name, creating it if needed.
+    """
+    return REGISTRY.register(Gauge(name, documentation))
+
+
+def histogram(name, documentation="", buckets=LATENCY_BUCKETS):
+    """
+    Returns the histogram registered under name, creating it if needed.
+    """
+    return REGISTRY.register(Histogram(name, documentation, buckets))
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.24 on 2026-10-18 16:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generic', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.24 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generic', '0002_data_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='data',
+            index=models.Index(fields=['user', '-id'], name='generic_data_user_id_idx'),
+        ),
+    ]
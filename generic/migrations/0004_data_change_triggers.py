@@ -0,0 +1,73 @@
+from django.db import migrations
+
+# Increments the version of the rows written without it (raw SQL, other services)
+VERSION_FUNCTION = """
+CREATE OR REPLACE FUNCTION generic_data_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        IF NEW.version = 0 THEN
+            NEW.version := 1;
+        END IF;
+    ELSIF NEW.version = OLD.version THEN
+        NEW.version := OLD.version + 1;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# Sends the written row on the channel of generic.changefeed, delivered when the transaction commits.
+# Created disabled, changefeed.sync_trigger enables it in the "notify" mode after the migrations
+NOTIFY_FUNCTION = """
+CREATE OR REPLACE FUNCTION generic_data_notify() RETURNS trigger AS $$
+DECLARE
+    payload json;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        payload := json_build_object('op', TG_OP, 'row', row_to_json(OLD));
+    ELSE
+        payload := json_build_object('op', TG_OP, 'row', row_to_json(NEW));
+    END IF;
+    PERFORM pg_notify('generic_data_changes', payload::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+TRIGGERS = """
+CREATE TRIGGER generic_data_version BEFORE INSERT OR UPDATE ON generic_data
+    FOR EACH ROW EXECUTE PROCEDURE generic_data_version();
+CREATE TRIGGER generic_data_notify AFTER INSERT OR UPDATE OR DELETE ON generic_data
+    FOR EACH ROW EXECUTE PROCEDURE generic_data_notify();
+ALTER TABLE generic_data DISABLE TRIGGER generic_data_notify;
+"""
+
+DROP = """
+DROP TRIGGER IF EXISTS generic_data_notify ON generic_data;
+DROP TRIGGER IF EXISTS generic_data_version ON generic_data;
+DROP FUNCTION IF EXISTS generic_data_notify();
+DROP FUNCTION IF EXISTS generic_data_version();
+"""
+
+
+def create_triggers(apps, schema_editor):
+    # The change feed is only available on PostgreSQL
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in (VERSION_FUNCTION, NOTIFY_FUNCTION, TRIGGERS):
+            schema_editor.execute(sql)
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generic', '0003_data_user_id_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
@@ -1,24 +1,262 @@
-import json
-from asgiref.sync import async_to_sync
+import hashlib
+import re
+from collections import deque
 from time import time
-import channels.layers
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import F
 from django.conf import settings
 import logging
+from . import encoding
+from . import caching
+from . import changefeed
+from . import log
+from .dispatch import get_dispatcher
+from .streams import get_replay_buffer
 
 logger = logging.getLogger(__name__)
+# Events of each save and notification, sampled
+message_logger = log.sampled(__name__)
 
+# Maximum number of notifications packed in one batched group message
+BROADCAST_BATCH_SIZE = 1000
 
-def broadcast(user, content):
-    # Add condition if user has subscribed in Redis
-    channel_layer = channels.layers.get_channel_layer()
-    logger.info("sending socket to : " + 'realtime_' + str(user))
-    logger.info("Content : " + str(content))
-    async_to_sync(channel_layer.group_send)(
-        'realtime_' + str(user), {
-            "type": "data.send",
-            "content": json.dumps(content),
-        })
+# Maximum number of ids of the query reading back the versions of the updated orders
+BULK_READ_SIZE = 900
+
+# Numbered messages of each user waiting to be submitted, and the users whose messages are being submitted
+_unsubmitted = {}
+_submitting = set()
+
+# Characters allowed as is in the instrument part of the group names
+INSTRUMENT_NAME = re.compile(r"^[A-Za-z0-9_\-]{1,60}$")
+
+
+def group_name(user, instrument=None):
+    """
+    Returns the realtime group of the user, or of the user's orders on the instrument. The
+    instruments that can't be part of a group name are hashed.
+    """
+    if instrument is None:
+        return 'realtime_' + str(user)
+    if INSTRUMENT_NAME.match(instrument):
+        return 'realtime_' + str(user) + '.i-' + instrument
+    return 'realtime_' + str(user) + '.h-' + hashlib.sha1(instrument.encode()).hexdigest()[:20]
+
+
+def notification_item(notification, seq):
+    """
+    Returns the [id, type, JSON text, sequence number, route] item carried by the "data.send"
+    group messages for a (content, route) notification. The content is encoded here once and the
+    text is sent as is to the websocket clients. The route holds the current values of the
+    order used to filter the notifications without decoding them.
+    """
+    content, route = notification
+    content['seq'] = seq
+    return [content['id'], content['type'], encoding.dumps(content), seq, route]
+
+
+def merge_items(previous, current):
+    """
+    Collapses two successive items of the same order into one : the deltas are merged, and an
+    order created then updated stays a "data.new" item holding its latest state. A merged
+    update holds the "base_version" it applies on, the one of its oldest delta, so the clients
+    don't take the skipped versions as missed.
+    """
+    if current[1] == "data.new":
+        return current
+    oldest = encoding.loads(previous[2])
+    merged = dict(oldest, **encoding.loads(current[2]))
+    merged['type'] = previous[1]
+    if previous[1] == "data.update":
+        merged['base_version'] = oldest.get('base_version', oldest['version'] - 1)
+    return [current[0], previous[1], encoding.dumps(merged), current[3], current[4]]
+
+
+def merge_messages(previous, current):
+    """
+    Merges two pending "data.send" group messages of the same order, see merge_items.
+    """
+    merged = dict(current, items=[merge_items(previous["items"][0], current["items"][0])])
+    if "time" in previous:
+        # Pending since the first save
+        merged["time"] = previous["time"]
+    return merged
+
+
+def publish(user, notifications, key=None, merge=None):
+    """
+    Numbers the (content, route) notifications in the stream of the user (see streams.py), encodes
+    them and hands them to the dispatcher as one "data.send" message for the realtime group of
+    the user, and one for the group of each instrument (see group_name). The cached pages of the
+    user are invalidated first, so the clients reloading on the notification read the new data.
+    """
+    caching.invalidate(user)
+    stream = get_replay_buffer()
+    # Time of the oldest save, to measure the latency of the hot path (see metrics.py)
+    now = time()
+    saved = min((content.get('time', now) for content, _ in notifications), default=now)
+    # The messages are numbered and queued per user under the stream lock, and submitted once
+    # it is released (the submit can wait for room in the dispatcher queue)
+    with stream.lock:
+        items = stream.append(user, notifications, notification_item)
+        _unsubmitted.setdefault(user, deque()).append((items, saved, key, merge))
+        if user in _submitting:
+            # Submitted after the previous ones by the thread submitting them
+            return
+        _submitting.add(user)
+    submit_pending(user, stream)
+
+
+def submit_pending(user, stream):
+    """
+    Submits the queued messages of the user to the dispatcher, in the order of their sequence
+    numbers, until none is left.
+    """
+    dispatcher = get_dispatcher()
+    try:
+        while True:
+            with stream.lock:
+                pending = _unsubmitted.get(user)
+                if not pending:
+                    _unsubmitted.pop(user, None)
+                    _submitting.discard(user)
+                    return
+                items, saved, key, merge = pending.popleft()
+            dispatcher.submit(
+                group_name(user), {"type": "data.send", "items": items, "time": saved}, key=key, merge=merge
+            )
+
+            if dispatcher.instrument_groups:
+                per_instrument = {}
+                for item in items:
+                    per_instrument.setdefault(item[4]['instrument'], []).append(item)
+                for instrument, instrument_items in per_instrument.items():
+                    dispatcher.submit(
+                        group_name(user, instrument),
+                        {"type": "data.send", "items": instrument_items, "time": saved},
+                        key=key,
+                        merge=merge,
+                    )
+    except BaseException:
+        # The messages left are submitted by the next publisher of the user
+        with stream.lock:
+            _submitting.discard(user)
+        raise
+
+
+def broadcast(user, content, route, using=None):
+    """
+    Sends the content to the realtime groups of the user once the current transaction commits.
+    The group_send itself is done by the dispatcher (see dispatch.py), off the request thread.
+    Nothing is sent when the database triggers feed the notifications (see changefeed.py).
+    """
+    if changefeed.notify_mode():
+        return
+    message_logger.info("sending socket to : realtime_%s, content : %s", user, content)
+    # Successive notifications of the same order can be coalesced while waiting to be sent
+    transaction.on_commit(
+        lambda: publish(user, [(content, route)], key=content['id'], merge=merge_messages),
+        using=using,
+    )
+
+
+def broadcast_many(notifications, using=None):
+    """
+    Sends a list of (user, content, route) notifications grouped per user : each realtime group
+    receives one batched message holding the notifications, instead of one group_send per
+    notification.
+    """
+    if changefeed.notify_mode():
+        return
+    per_user = {}
+    for user, content, route in notifications:
+        per_user.setdefault(user, []).append((content, route))
+
+    for user, user_notifications in per_user.items():
+        message_logger.info("sending %s notifications to : realtime_%s", len(user_notifications), user)
+        for start in range(0, len(user_notifications), BROADCAST_BATCH_SIZE):
+            batch = user_notifications[start:start + BROADCAST_BATCH_SIZE]
+            transaction.on_commit(lambda user=user, batch=batch: publish(user, batch), using=using)
+
+
+class DataQuerySet(models.QuerySet):
+    """
+    Bulk operations bypass Data.save(), so they send their notifications themselves,
+    batched per user. The created orders are notified with the ids returned by the insert
+    (PostgreSQL) or, on SQLite, read back after it. The other backends that can't return the
+    inserted rows (MySQL) leave their ids empty, and these orders are not notified.
+    """
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.version += 1
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            connection = connections[self.db]
+            if objs and objs[0].pk is None and not kwargs.get('ignore_conflicts') and \
+                    not connection.features.can_return_rows_from_bulk_insert and connection.vendor == 'sqlite':
+                self._fetch_bulk_created_ids(objs)
+        contents = []
+        for obj in objs:
+            if obj.pk is not None:
+                obj.mark_clean()
+                contents.append((obj.user_id, obj.notification_content("data.new"), obj.notification_route()))
+        broadcast_many(contents, using=self.db)
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            # Incremented by the UPDATE, as in Data.save
+            obj.version = F('version') + 1
+        result = super().bulk_update(objs, sorted(set(fields) | {'version'}), *args, **kwargs)
+        versions = {}
+        manager = self.model._base_manager.using(self.db)
+        for start in range(0, len(objs), BULK_READ_SIZE):
+            ids = [obj.pk for obj in objs[start:start + BULK_READ_SIZE]]
+            versions.update(manager.filter(pk__in=ids).values_list('id', 'version'))
+        for obj in objs:
+            obj.version = versions[obj.pk]
+        contents = []
+        for obj in objs:
+            contents.append(
+                (obj.user_id, obj.notification_content("data.update", obj.changed_fields()), obj.notification_route())
+            )
+            obj.mark_clean()
+        broadcast_many(contents, using=self.db)
+        return result
+
+    def update(self, **kwargs):
+        # Not notified either, but the cached pages of the users of the orders are invalidated
+        users = set(self.values_list('user_id', flat=True))
+        result = super().update(**kwargs)
+        # And of the user the orders are given to (bulk_update notifies its users itself)
+        moved_to = kwargs.get('user', kwargs.get('user_id'))
+        if isinstance(moved_to, models.Model):
+            moved_to = moved_to.pk
+        if isinstance(moved_to, int):
+            users.add(moved_to)
+        for user in users:
+            transaction.on_commit(lambda user=user: caching.invalidate(user), using=self.db)
+        return result
+
+    def delete(self):
+        users = set(self.values_list('user_id', flat=True))
+        result = super().delete()
+        for user in users:
+            transaction.on_commit(lambda user=user: caching.invalidate(user), using=self.db)
+        return result
+
+    def _fetch_bulk_created_ids(self, objs):
+        # SQLite only : it can't return the inserted rows, but the insert holds the write lock of
+        # the whole database until the end of the transaction, so the inserted rows are the ones
+        # with the highest ids. Concurrent writers of other backends would interleave their ids.
+        ids = self.model._base_manager.using(self.db).order_by('-id').values_list('id', flat=True)[:len(objs)]
+        for obj, pk in zip(objs, reversed(list(ids))):
+            obj.pk = pk
+            obj._state.adding = False
+            obj._state.db = self.db
 
 
 class Data(models.Model):
@@ -41,26 +279,106 @@ class Data(models.Model):
         on_delete=models.CASCADE,
     )
 
+    # Version, incremented on each save to order the notifications
+    version = models.PositiveIntegerField(default=0)
+
+    objects = DataQuerySet.as_manager()
+
+    class Meta:
+        # Pages of the orders of a user, by descending id
+        indexes = [models.Index(fields=['user', '-id'], name='generic_data_user_id_idx')]
+
+    # Fields sent in the notifications, the updates only carry the ones changed since the data was loaded
+    NOTIFIED_FIELDS = ('quantity', 'initial_price', 'instrument')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if name in cls.NOTIFIED_FIELDS
+        }
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        loaded = getattr(self, '_loaded_values', {})
+        loaded.update(
+            (name, getattr(self, name)) for name in self.NOTIFIED_FIELDS if fields is None or name in fields
+        )
+        self._loaded_values = loaded
+
+    def changed_fields(self):
+        """
+        Returns the notified fields changed since the data was loaded (all of them if it was not).
+        """
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            return list(self.NOTIFIED_FIELDS)
+        return [name for name in self.NOTIFIED_FIELDS if name not in loaded or loaded[name] != getattr(self, name)]
+
+    def mark_clean(self):
+        self._loaded_values = {name: getattr(self, name) for name in self.NOTIFIED_FIELDS}
+
+    def notification_content(self, notification_type, fields=None):
+        """
+        Returns the notification sent to the opened channels for this data, with only the given
+        fields on top of the id and the version (all the notified fields by default).
+        """
+        content = {
+            'id': self.id,
+            'version': self.version,
+        }
+        for name in self.NOTIFIED_FIELDS if fields is None else fields:
+            content[name] = getattr(self, name)
+        content['type'] = notification_type
+        content['time'] = time()
+        return content
+
+    def notification_route(self):
+        """
+        Returns the current values of the notified fields and the version, used to route and
+        filter the notifications of this data (whatever the fields they carry).
+        """
+        route = {name: getattr(self, name) for name in self.NOTIFIED_FIELDS}
+        route["version"] = self.version
+        return route
+
     def save(self, *args, **kwargs):
-        logger.info("Saving new data")
+        message_logger.info("Saving new data")
         if not self.id:
             # Go through a serializer
             notification_type = "data.new"
+            fields = None
         else:
             notification_type = "data.update"
+            fields = self.changed_fields()
+
+        if self._state.adding:
+            self.version += 1
+        else:
+            # Incremented by the UPDATE, the concurrent saves of the order get their own version
+            self.version = F('version') + 1
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'version'}
 
         # Save the data
         super(Data, self).save(*args, **kwargs)
-
-        # Send the opened channels
-        content = {
-            'id': self.id,
-            'quantity': self.quantity,
-            'initial_price': self.initial_price,
-            'instrument': self.instrument,
-            'type': notification_type,
-            'time': time()
-        }
+        if not isinstance(self.version, int):
+            self.version = type(self)._base_manager.using(self._state.db).values_list(
+                'version', flat=True).get(pk=self.pk)
+        self.mark_clean()
 
         # Send notification to opened channels
-        broadcast(self.user.id, content)
+        broadcast(
+            self.user_id,
+            self.notification_content(notification_type, fields),
+            self.notification_route(),
+            using=self._state.db,
+        )
+
+    def delete(self, *args, **kwargs):
+        user, using = self.user_id, self._state.db
+        result = super(Data, self).delete(*args, **kwargs)
+        # The deletions are not notified, the cached pages of the user are invalidated
+        transaction.on_commit(lambda: caching.invalidate(user), using=using)
+        return result
@@ -0,0 +1,131 @@
+"""
+Pagination of the data list API.
+
+The datatables pagination counts the orders of the user on each page request. The count
+can be cached or estimated through the DATA_PAGINATION setting :
+
+    DATA_PAGINATION = {
+        "COUNT": "exact",     # "exact", "cached" (kept COUNT_TIMEOUT seconds) or "estimate"
+        "COUNT_TIMEOUT": 30,
+    }
+
+The estimate is the number of rows planned by PostgreSQL, the other databases fall back to
+the exact count. The rows of a page are sliced from the "start" parameter, so a count behind
+the table never hides rows. The slice is an OFFSET : the deep datatables pages are not constant
+time, the table jumping to any page on any ordering.
+
+The other clients page through the orders with a cursor (?pagination=cursor) : each page
+is read from the (user, -id) index after the last id of the previous one, whatever its depth.
+"""
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from rest_framework.pagination import CursorPagination
+from rest_framework_datatables.filters import DatatablesFilterBackend
+from rest_framework_datatables.pagination import DatatablesPageNumberPagination
+from rest_framework_datatables.utils import get_param
+
+DEFAULTS = {
+    "COUNT": "exact",
+    "COUNT_TIMEOUT": 30,
+}
+
+EXACT = "exact"
+CACHED = "cached"
+ESTIMATE = "estimate"
+
+
+def pagination_settings():
+    return dict(DEFAULTS, **getattr(settings, "DATA_PAGINATION", {}))
+
+
+def estimate_count(queryset):
+    """
+    Returns the number of rows of the queryset planned by the database, or counted when the
+    database doesn't give it.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return queryset.count()
+    sql, params = queryset.values("pk").query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def total_count(queryset, user):
+    """
+    Returns the number of orders of the user, counted according to the DATA_PAGINATION setting.
+    """
+    config = pagination_settings()
+    if config["COUNT"] == ESTIMATE:
+        return estimate_count(queryset)
+    if config["COUNT"] == CACHED:
+        return cache.get_or_set("data_count:" + str(user.pk), queryset.count, config["COUNT_TIMEOUT"])
+    return queryset.count()
+
+
+class DataFilterBackend(DatatablesFilterBackend):
+    """
+    Datatables filter backend counting the orders of the user through total_count.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        if not self.check_renderer_format(request):
+            return queryset
+
+        count = total_count(view.get_queryset(), request.user)
+        self.set_count_before(view, count)
+
+        datatables_query = self.parse_datatables_query(request, view)
+
+        q = self.get_q(datatables_query)
+        if q:
+            # The searches are always counted
+            queryset = queryset.filter(q).distinct()
+            count = queryset.count()
+        self.set_count_after(view, count)
+
+        ordering = self.get_ordering(request, view, datatables_query['fields'])
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+
+        return queryset
+
+
+class DataPagination(DatatablesPageNumberPagination):
+    """
+    Datatables pagination slicing the rows from the "start" parameter, without bounding them by
+    the count (which may be cached or estimated).
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.accepted_renderer.format != 'datatables':
+            return super().paginate_queryset(queryset, request, view)
+
+        self.page_size_query_param = 'length'
+        if get_param(request, self.page_size_query_param) == '-1':
+            return None
+        self.count, self.total_count = self.get_count_and_total_count(queryset, view)
+        self.is_datatable_request = True
+        page_size = self.get_page_size(request)
+        try:
+            start = max(int(get_param(request, 'start', 0)), 0)
+        except ValueError:
+            start = 0
+        self.request = request
+        return list(queryset[start:start + page_size])
+
+
+class DataCursorPagination(CursorPagination):
+    """
+    Pages of orders by descending id, the cursor holding the last id of the previous page.
+    """
+    ordering = "-id"
+    page_size_query_param = "page_size"
+    max_page_size = 1000
@@ -0,0 +1,141 @@
+"""
+Mark to market of the orders of a user against the market data prices (see market.py).
+
+The orders are kept in columns (instrument, quantity, cost) and aggregated per instrument
+with np.bincount, so the positions are rebuilt in one vectorised pass when an order changes,
+and the unrealised P&L of every instrument is revalued in one pass when the prices move :
+
+    pnl = quantity * price - cost
+
+where the cost is the sum of quantity * initial_price of the orders of the instrument. The
+instruments without a market price are left out of the valuation.
+"""
+import numpy as np
+
+from . import encoding
+
+# Initial number of order rows, doubled when full
+INITIAL_CAPACITY = 64
+
+
+class PositionBook:
+    """
+    Orders of a user and their valuation against a MarketBook.
+    """
+
+    def __init__(self, market):
+        self.market = market
+        # Instruments of the orders, and their slot in the market book (-1 without price)
+        self.symbols = []
+        self.index = {}
+        self.slots = np.empty(0, dtype=np.intp)
+        # Order rows, by order id
+        self.rows = {}
+        self.instruments = np.empty(INITIAL_CAPACITY, dtype=np.intp)
+        self.quantities = np.empty(INITIAL_CAPACITY, dtype=np.float64)
+        self.costs = np.empty(INITIAL_CAPACITY, dtype=np.float64)
+        self.versions = np.empty(INITIAL_CAPACITY, dtype=np.int64)
+        self._positions = None
+        self._changed = True
+        self._sent = None
+
+    def load(self, orders):
+        """
+        Adds the (id, instrument, quantity, initial_price, version) orders.
+        """
+        for pk, instrument, quantity, initial_price, version in orders:
+            self.apply(pk, {"instrument": instrument, "quantity": quantity, "initial_price": initial_price,
+                            "version": version})
+
+    def apply(self, pk, route):
+        """
+        Records the current state of an order, given by the route of its notification (see
+        models.Data.notification_route). The states older than the recorded one are ignored.
+        """
+        row = self.rows.get(pk)
+        if row is None:
+            row = self.rows[pk] = len(self.rows)
+            if row == len(self.quantities):
+                self._grow()
+        elif self.versions[row] >= route["version"]:
+            return
+        self.versions[row] = route["version"]
+        self.instruments[row] = self._instrument(route["instrument"])
+        self.quantities[row] = route["quantity"]
+        self.costs[row] = route["quantity"] * route["initial_price"]
+        self._positions = None
+        self._changed = True
+
+    def discard(self, pk, version):
+        """
+        Takes out an order that left the subscription (its instrument or its filters), unless the
+        recorded state is newer.
+        """
+        row = self.rows.get(pk)
+        if row is None or self.versions[row] >= version:
+            return
+        self.versions[row] = version
+        self.quantities[row] = 0
+        self.costs[row] = 0
+        self._positions = None
+        self._changed = True
+
+    def positions(self):
+        """
+        Returns the quantity and the cost of each instrument.
+        """
+        if self._positions is None:
+            count = len(self.rows)
+            self._positions = (
+                np.bincount(self.instruments[:count], self.quantities[:count], minlength=len(self.symbols)),
+                np.bincount(self.instruments[:count], self.costs[:count], minlength=len(self.symbols)),
+            )
+        return self._positions
+
+    def valuation(self):
+        """
+        Returns the priced instruments, with their quantity and unrealised P&L.
+        """
+        quantities, costs = self.positions()
+        priced = np.flatnonzero(self.slots >= 0)
+        quantities = quantities[priced]
+        pnl = quantities * self.market.prices[self.slots[priced]] - costs[priced]
+        return priced, quantities, pnl
+
+    def frame(self):
+        """
+        Returns the {"type": "pnl", "instruments": [...], "quantity": [...], "pnl": [...], "total": ...}
+        text of the valuation, None when neither the orders nor their prices changed since the
+        last frame.
+        """
+        # Version of the book the prices of the instruments last changed in
+        version = int(self.market.versions[self.slots[self.slots >= 0]].max(initial=0))
+        if not self._changed and version == self._sent:
+            return None
+        self._changed = False
+        self._sent = version
+        priced, quantities, pnl = self.valuation()
+        symbols = self.symbols
+        return encoding.dumps({
+            "type": "pnl",
+            "instruments": [symbols[i] for i in priced.tolist()],
+            "quantity": quantities.tolist(),
+            "pnl": pnl.tolist(),
+            "total": float(pnl.sum()),
+        })
+
+    def _instrument(self, symbol):
+        position = self.index.get(symbol)
+        if position is None:
+            position = self.index[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+            self.slots = np.append(self.slots, self.market.index.get(symbol, -1))
+        return position
+
+    def _grow(self):
+        capacity = 2 * len(self.quantities)
+        for name in ("instruments", "quantities", "costs", "versions"):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
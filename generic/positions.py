@@ -0,0 +1,117 @@
+"""
+Position of the new orders in the table shown by a client.
+
+A datatables client showing a page of its orders (sorted and searched server side) tells the
+websocket consumer about it with the "view" command. The "data.new" notifications sent to it
+then hold the index of the new order under this ordering and search ("position", null when the
+search filters it out) and whether it lands on the shown page ("visible"), so the client only
+reloads its page when it changes.
+
+The ordering is the one of the data list API : the given columns, then the descending id.
+"""
+import operator
+from functools import reduce
+
+from django.db.models import Q
+
+from .exceptions import ClientError
+from .models import Data
+
+# Columns of the table, as named by the clients
+COLUMNS = ("id", "instrument", "quantity", "initial_price")
+
+# Number of new orders of a message located by a query, beyond it the client reloads its page
+MAX_LOCATED = 20
+
+
+class TableView:
+    """
+    Ordering, search and page of the table shown by a client.
+    """
+
+    def __init__(self, order=(), search="", start=0, length=10):
+        order = list(order)
+        columns = [column for column, _ in order]
+        if "id" in columns:
+            # The columns following the id don't change the ordering
+            order = order[:columns.index("id") + 1]
+        else:
+            # The descending id breaks the ties, as in the data list API
+            order.append(("id", "desc"))
+        self.order = order
+        self.search = search
+        self.start = start
+        self.length = length
+
+    @classmethod
+    def from_command(cls, content):
+        """
+        Returns the view described by the "view" command :
+
+            {"command": "view", "order": [["quantity", "desc"]], "search": "", "start": 0, "length": 10}
+        """
+        order = content.get("order", [])
+        search = content.get("search", "")
+        start = content.get("start", 0)
+        length = content.get("length", 10)
+        if not isinstance(order, list) or not all(
+                isinstance(item, list) and len(item) == 2 and item[0] in COLUMNS and item[1] in ("asc", "desc")
+                for item in order):
+            raise ClientError("INVALID_VIEW")
+        if not isinstance(search, str) or not all(
+                isinstance(value, int) and not isinstance(value, bool) and value >= 0 for value in (start, length)):
+            raise ClientError("INVALID_VIEW")
+        return cls([tuple(item) for item in order], search, start, length)
+
+    def is_default(self):
+        """
+        Returns True when the new orders are always first (descending ids, no search).
+        """
+        return self.order == [("id", "desc")] and not self.search
+
+    def queryset(self, user):
+        queryset = Data.objects.filter(user=user)
+        if self.search:
+            # The search of the datatables filter backend, on each column
+            queryset = queryset.filter(reduce(operator.or_, (
+                Q(**{column + "__icontains": self.search}) for column in COLUMNS
+            )))
+        return queryset
+
+    def before(self, pk, route):
+        """
+        Returns the condition of the rows sorted before the order.
+        """
+        values = dict(route, id=pk)
+        condition = Q()
+        equal = Q()
+        for column, direction in self.order:
+            lookup = "__gt" if direction == "desc" else "__lt"
+            condition |= equal & Q(**{column + lookup: values[column]})
+            equal &= Q(**{column: values[column]})
+        return condition
+
+    def locate(self, user, items):
+        """
+        Returns the position of the new orders of the [id, type, text, seq, route] items, by id :
+        None when the search filters them out.
+        """
+        if self.is_default():
+            # The highest ids, first of the table in the order they were created
+            return {item[0]: position for position, item in enumerate(reversed(items))}
+        queryset = self.queryset(user)
+        ids = [item[0] for item in items]
+        if self.search:
+            ids = set(queryset.filter(id__in=ids).values_list("id", flat=True))
+        return {
+            item[0]: queryset.filter(self.before(item[0], item[4])).count() if item[0] in ids else None
+            for item in items
+        }
+
+    def annotate(self, text, position):
+        """
+        Adds the position of the order to the JSON text of its notification.
+        """
+        visible = position is not None and self.start <= position < self.start + self.length
+        return text[:-1] + ',"position":' + ("null" if position is None else str(position)) + \
+            ',"visible":' + ("true" if visible else "false") + "}"
@@ -1,8 +1,131 @@
+from django.db import transaction
 from rest_framework import serializers
 from . import models
 
 
+class DataListSerializer(serializers.ListSerializer):
+    """
+    Upserts a list of orders by id : the orders without id are inserted with a single bulk_create
+    and the existing ones are updated with a single bulk_update (each sending its notifications
+    batched per user).
+    """
+
+    def run_child_validation(self, data):
+        attrs = super().run_child_validation(data)
+        if data.get('id') is not None:
+            attrs['id'] = serializers.IntegerField().run_validation(data['id'])
+        return attrs
+
+    def validate(self, attrs):
+        ids = [item['id'] for item in attrs if 'id' in item]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError("The same order id is present more than once.")
+
+        view = self.context.get('view')
+        queryset = view.get_queryset() if view is not None else models.Data.objects.all()
+        self.existing = queryset.in_bulk(ids)
+        unknown = sorted(set(ids) - set(self.existing))
+        if unknown:
+            raise serializers.ValidationError("Unknown order ids : {}.".format(unknown))
+        return attrs
+
+    def create(self, validated_data):
+        results, new, updated, fields = [], [], [], set()
+        for attrs in validated_data:
+            pk = attrs.pop('id', None)
+            if pk is None:
+                instance = models.Data(**attrs)
+                new.append(instance)
+            else:
+                instance = self.existing[pk]
+                for attr, value in attrs.items():
+                    setattr(instance, attr, value)
+                fields.update(attrs)
+                updated.append(instance)
+            results.append(instance)
+
+        with transaction.atomic():
+            if new:
+                models.Data.objects.bulk_create(new)
+            if updated:
+                models.Data.objects.bulk_update(updated, sorted(fields))
+        return results
+
+
 class DataSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Data
-        fields = ('id', 'user', 'instrument', 'initial_price', 'quantity')
+        fields = ('id', 'user', 'instrument', 'initial_price', 'quantity', 'version')
+        read_only_fields = ('version',)
+        # Needed by the page to apply the websocket updates, even if not shown in a column
+        datatables_always_serialize = ('id', 'version')
+        list_serializer_class = DataListSerializer
+
+
+class ValuesSerializer:
+    """
+    Fast read path of a ModelSerializer : the rows are read with queryset.values() and mapped to
+    the representation of the serializer with a field mapping compiled once, giving the same output
+    without instantiating the models nor running the fields one by one.
+
+    The fields whose representation is the database value (numbers, strings, primary keys) are
+    copied as is, the others go through their to_representation.
+    """
+    # Fields represented by the value read from the database
+    PLAIN_FIELDS = (
+        serializers.IntegerField,
+        serializers.FloatField,
+        serializers.CharField,
+        serializers.BooleanField,
+        serializers.PrimaryKeyRelatedField,
+    )
+
+    _compiled = {}
+
+    def __init__(self, serializer_class):
+        self.names = []
+        self.sources = []
+        self.converters = []
+        model = serializer_class.Meta.model
+        for name, field in serializer_class().fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.PrimaryKeyRelatedField):
+                if field.pk_field is not None:
+                    raise ValueError("Field {} is not supported by the values serialization".format(name))
+                source = model._meta.get_field(field.source).attname
+            elif '.' in field.source or field.source == '*':
+                raise ValueError("Field {} is not supported by the values serialization".format(name))
+            else:
+                source = field.source
+            self.names.append(name)
+            self.sources.append(source)
+            if not isinstance(field, self.PLAIN_FIELDS):
+                self.converters.append((name, field.to_representation))
+        self.plain = not self.converters and self.names == self.sources
+
+    @classmethod
+    def for_serializer(cls, serializer_class):
+        """
+        Returns the values serializer of the serializer class, compiled on first use.
+        """
+        compiled = cls._compiled.get(serializer_class)
+        if compiled is None:
+            compiled = cls._compiled[serializer_class] = cls(serializer_class)
+        return compiled
+
+    def values(self, queryset):
+        return queryset.values(*self.sources)
+
+    def to_representation(self, row):
+        if self.plain:
+            return row
+        data = dict(zip(self.names, map(row.__getitem__, self.sources)))
+        for name, convert in self.converters:
+            if data[name] is not None:
+                data[name] = convert(data[name])
+        return data
+
+    def serialize(self, rows):
+        to_representation = self.to_representation
+        return [to_representation(row) for row in rows]
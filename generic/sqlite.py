@@ -0,0 +1,192 @@
+"""
+SQLite profile for the small deployments.
+
+With the profile enabled, each new SQLite connection is set up with the PRAGMAS : the WAL journal
+lets the readers run while a writer commits, synchronous=NORMAL only syncs at the checkpoints,
+and the busy timeout makes the writers wait for the lock instead of failing with "database is
+locked". The orders created through the API are also handed to a single writer thread, which
+inserts the ones arriving within BATCH_WINDOW milliseconds in one transaction (one bulk_create,
+one commit), so the writers don't compete for the lock.
+
+The profile is configured through the DATA_SQLITE setting :
+
+    DATA_SQLITE = {
+        "ENABLED": False,
+        "PRAGMAS": {"journal_mode": "wal", "synchronous": "normal", "mmap_size": 268435456, "busy_timeout": 5000},
+        "BATCH_WINDOW": 5,  # Milliseconds the writer waits for more orders, 0 disables the batching
+        "MAX_BATCH": 500,   # Orders inserted in one transaction
+    }
+"""
+import atexit
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections, transaction
+
+from .models import Data
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": False,
+    "PRAGMAS": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 268435456,
+        "busy_timeout": 5000,
+    },
+    "BATCH_WINDOW": 5,
+    "MAX_BATCH": 500,
+}
+
+# Seconds a request waits for its order to be written
+WRITE_TIMEOUT = 30
+
+
+def sqlite_settings():
+    return dict(DEFAULTS, **getattr(settings, "DATA_SQLITE", {}))
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    Applies the PRAGMAS to the new SQLite connections, connected to the connection_created signal.
+    """
+    config = sqlite_settings()
+    if connection.vendor != "sqlite" or not config["ENABLED"]:
+        return
+    with connection.cursor() as cursor:
+        for name, value in config["PRAGMAS"].items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+
+
+def batching_enabled():
+    config = sqlite_settings()
+    return config["ENABLED"] and config["BATCH_WINDOW"] > 0
+
+
+class BatchWriter:
+    """
+    Single writer thread inserting the orders in batches.
+
+    create() queues the fields of an order and returns a Future of the created instance. The
+    writer takes the orders queued within the window (up to max_batch) and inserts them with one
+    bulk_create in one transaction. When the batch fails, its orders are inserted one by one so
+    that only the invalid ones fail.
+    """
+
+    def __init__(self, model, window=0.005, max_batch=500, using="default"):
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self.using = using
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def create(self, **fields):
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((fields, future))
+        return future
+
+    def close(self, timeout=5.0):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def _take_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Stop after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._take_batch()
+                if batch is None:
+                    break
+                # The connection of the thread is kept open across the batches
+                self._write(batch)
+        finally:
+            connections.close_all()
+
+    def _write(self, batch):
+        instances = [self.model(**fields) for fields, _ in batch]
+        try:
+            with transaction.atomic(using=self.using):
+                self.model.objects.using(self.using).bulk_create(instances)
+        except Exception:
+            logger.exception("Batch of %s orders failed, inserting them one by one", len(batch))
+            # Reconnects if the connection was lost
+            connections[self.using].close()
+            for (fields, future), instance in zip(batch, instances):
+                try:
+                    instance = self.model(**fields)
+                    instance.save(using=self.using)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(instance)
+        else:
+            for (_, future), instance in zip(batch, instances):
+                future.set_result(instance)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_batch_writer():
+    """
+    Returns the process writer of the orders, built from the settings on first use.
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                config = sqlite_settings()
+                _writer = BatchWriter(Data, window=config["BATCH_WINDOW"] / 1000, max_batch=config["MAX_BATCH"])
+    return _writer
+
+
+def reset_batch_writer():
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+
+def _settings_changed(setting, **kwargs):
+    if setting == "DATA_SQLITE":
+        reset_batch_writer()
+
+
+setting_changed.connect(_settings_changed)
+atexit.register(reset_batch_writer)
@@ -0,0 +1,115 @@
+"""
+Per-user notification streams : sequence numbers and replay buffer.
+
+Each notification of a user gets the next number of the user's stream, and the last ones
+are kept so that a reconnecting client asks for the notifications it missed (see the "since"
+option of the subscribe command) instead of reloading all its data.
+
+The buffer is configured through the DATA_REPLAY setting :
+
+    DATA_REPLAY = {
+        "BACKEND": "generic.streams.MemoryReplayBuffer",
+        "SIZE": 1000,  # Notifications kept per user
+    }
+
+The memory backend lives in the process memory, it needs the writers and the websocket
+consumers to run in the same process (runserver, a single daphne instance). Its epoch
+changes on each start, so that the clients resuming a stream of a previous run are told to
+reload their data.
+"""
+import threading
+import uuid
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+DEFAULTS = {
+    "BACKEND": "generic.streams.MemoryReplayBuffer",
+    "SIZE": 1000,
+}
+
+
+class MemoryReplayBuffer:
+    """
+    Keeps the last notifications of each user in memory.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.epoch = uuid.uuid4().hex[:12]
+        # Held by the publishers while they number and queue the notifications, so that they
+        # are submitted in the order of their sequence numbers (see models.publish)
+        self.lock = threading.RLock()
+        self._streams = {}
+        self._sequences = {}
+
+    def append(self, user, notifications, item):
+        """
+        Numbers the notifications with the next sequence numbers of the user and records them.
+        item(notification, seq) builds what is recorded and returned for a notification.
+        """
+        with self.lock:
+            stream = self._streams.get(user)
+            if stream is None:
+                stream = self._streams[user] = deque(maxlen=self.size)
+            sequence = self._sequences.get(user, 0)
+            items = []
+            for notification in notifications:
+                sequence += 1
+                items.append(item(notification, sequence))
+            stream.extend(items)
+            self._sequences[user] = sequence
+            return items
+
+    def current(self, user):
+        """
+        Returns the sequence number of the last notification of the user (0 if none).
+        """
+        return self._sequences.get(user, 0)
+
+    def since(self, user, sequence, epoch=None):
+        """
+        Returns the recorded items of the user numbered after sequence, or None when they
+        can't all be replayed (rolled over, or numbered by another epoch).
+        """
+        if epoch is not None and epoch != self.epoch:
+            return None
+        with self.lock:
+            current = self._sequences.get(user, 0)
+            if sequence > current:
+                return None
+            if sequence == current:
+                return []
+            stream = self._streams[user]
+            missed = current - sequence
+            if missed > len(stream):
+                return None
+            return list(stream)[-missed:]
+
+
+_buffer = None
+_lock = threading.Lock()
+
+
+def get_replay_buffer():
+    """
+    Returns the process replay buffer, built from the settings on first use.
+    """
+    global _buffer
+    if _buffer is None:
+        with _lock:
+            if _buffer is None:
+                config = dict(DEFAULTS, **getattr(settings, "DATA_REPLAY", {}))
+                _buffer = import_string(config["BACKEND"])(size=config["SIZE"])
+    return _buffer
+
+
+def _settings_changed(setting, **kwargs):
+    global _buffer
+    if setting == "DATA_REPLAY":
+        _buffer = None
+
+
+setting_changed.connect(_settings_changed)
@@ -0,0 +1,326 @@
+import asyncio
+import json
+import logging
+import threading
+from time import time
+from unittest import mock
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.test import override_settings
+
+from generic import changefeed
+from generic import dispatch
+from generic import log
+from generic import metrics
+from generic.dispatch import Dispatcher, get_dispatcher
+from generic.models import Data, publish
+
+
+class RecordingChannelLayer:
+    """
+    Channel layer double keeping the sent group messages, optionally held until the gate opens.
+    """
+
+    def __init__(self, gate=None):
+        self.sent = []
+        self.gate = gate
+
+    async def group_send(self, group, message):
+        while self.gate is not None and not self.gate.is_set():
+            await asyncio.sleep(0.001)
+        self.sent.append((group, message))
+
+
+def hold_sender(dispatcher, layer):
+    # The first message is taken by the sender, which waits on the gate, the next ones stay queued
+    dispatcher.submit("realtime_1", {"n": 0})
+    while not dispatcher._in_flight:
+        pass
+
+
+class TestDispatcher:
+
+    def test_background_sends_in_order(self):
+        layer = RecordingChannelLayer()
+        dispatcher = Dispatcher(channel_layer=layer)
+        for i in range(100):
+            dispatcher.submit("realtime_1", {"n": i})
+        assert dispatcher.flush(timeout=5)
+        assert [message["n"] for _, message in layer.sent] == list(range(100))
+        dispatcher.close()
+
+    def test_inline_sends_immediately(self):
+        layer = RecordingChannelLayer()
+        dispatcher = Dispatcher(background=False, channel_layer=layer)
+        dispatcher.submit("realtime_1", {"n": 1})
+        assert layer.sent == [("realtime_1", {"n": 1})]
+
+    def test_drop_policy_when_queue_is_full(self):
+        layer = RecordingChannelLayer(gate=threading.Event())
+        dispatcher = Dispatcher(channel_layer=layer, max_queue_size=2, policy="drop")
+        hold_sender(dispatcher, layer)
+        assert dispatcher.submit("realtime_1", {"n": 1}) is True
+        assert dispatcher.submit("realtime_1", {"n": 2}) is True
+        assert dispatcher.submit("realtime_1", {"n": 3}) is False
+        layer.gate.set()
+        assert dispatcher.flush(timeout=5)
+        assert [message["n"] for _, message in layer.sent] == [0, 1, 2]
+        dispatcher.close()
+
+    def test_block_policy_waits_for_room(self):
+        layer = RecordingChannelLayer(gate=threading.Event())
+        dispatcher = Dispatcher(channel_layer=layer, max_queue_size=1, policy="block", block_timeout=5)
+        hold_sender(dispatcher, layer)
+        dispatcher.submit("realtime_1", {"n": 1})
+        threading.Timer(0.05, layer.gate.set).start()
+        assert dispatcher.submit("realtime_1", {"n": 2}) is True
+        assert dispatcher.flush(timeout=5)
+        assert [message["n"] for _, message in layer.sent] == [0, 1, 2]
+        dispatcher.close()
+
+    def test_coalesce_policy_keeps_latest_per_key(self):
+        layer = RecordingChannelLayer(gate=threading.Event())
+        dispatcher = Dispatcher(channel_layer=layer, policy="coalesce")
+        hold_sender(dispatcher, layer)
+        dispatcher.submit("realtime_1", {"n": 1}, key=7)
+        dispatcher.submit("realtime_1", {"n": 2})
+        dispatcher.submit("realtime_1", {"n": 3}, key=7)
+        layer.gate.set()
+        assert dispatcher.flush(timeout=5)
+        # The replacement is sent after the messages submitted before it
+        assert [message["n"] for _, message in layer.sent] == [0, 2, 3]
+        dispatcher.close()
+
+    def test_coalesce_policy_merges_pending_message(self):
+        layer = RecordingChannelLayer(gate=threading.Event())
+        dispatcher = Dispatcher(channel_layer=layer, policy="coalesce")
+        hold_sender(dispatcher, layer)
+        merge = lambda previous, current: dict(previous, **current)
+        dispatcher.submit("realtime_1", {"a": 1}, key=7, merge=merge)
+        dispatcher.submit("realtime_1", {"b": 2}, key=7, merge=merge)
+        layer.gate.set()
+        assert dispatcher.flush(timeout=5)
+        assert layer.sent[1] == ("realtime_1", {"a": 1, "b": 2})
+        dispatcher.close()
+
+    def test_unknown_policy_is_rejected(self):
+        with pytest.raises(ValueError):
+            Dispatcher(policy="unknown")
+
+
+class TestMetrics:
+
+    def test_histogram_exposition(self):
+        registry = metrics.Registry()
+        histogram = registry.register(metrics.Histogram("test_seconds", "Test durations", buckets=(0.1, 1.0)))
+        registry.register(metrics.Counter("test_total", "Test count")).inc(3)
+        for value in (0.05, 0.5, 0.5, 2.0):
+            histogram.observe(value)
+
+        assert histogram.value == {"count": 4, "sum": 3.05}
+        assert registry.exposition() == "\n".join([
+            "# HELP test_seconds Test durations",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            "test_seconds_sum 3.05",
+            "test_seconds_count 4",
+            "# HELP test_total Test count",
+            "# TYPE test_total counter",
+            "test_total 3",
+        ]) + "\n"
+
+    def test_dispatcher_observes_the_hot_path(self):
+        dispatch.save_to_send.reset()
+        dispatch.group_send_duration.reset()
+        dispatcher = Dispatcher(background=False, channel_layer=RecordingChannelLayer())
+        dispatcher.submit("realtime_1", {"type": "data.send", "items": [], "time": time() - 0.2})
+        dispatcher.submit("realtime_1", {"n": 1})
+
+        assert dispatch.save_to_send.value["count"] == 1
+        assert dispatch.save_to_send.value["sum"] >= 0.2
+        assert dispatch.group_send_duration.value["count"] == 2
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestLogging:
+
+    def test_sampled_logger_logs_one_call_in_sample_rate(self):
+        logger = logging.getLogger("generic.tests.sampled")
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            sampled = log.SampledLogger(logger, sample_rate=10)
+            for i in range(25):
+                sampled.info("message %s", i)
+            sampled.debug("disabled level")
+            assert [record.getMessage() for record in handler.records] == ["message 0", "message 10", "message 20"]
+        finally:
+            logger.removeHandler(handler)
+
+    def test_queue_handler_writes_from_the_listener(self):
+        handler = log.QueueHandler(targets=[{"class": "logging.StreamHandler"}])
+        target = RecordingHandler()
+        handler.listener.handlers = (target,)
+        content = {"id": 1}
+        handler.handle(logging.makeLogRecord({"msg": "content %s", "args": (content,), "levelno": logging.INFO}))
+        content["id"] = 2
+        handler.close()
+        assert [record.getMessage() for record in target.records] == ["content {'id': 1}"]
+
+
+@pytest.mark.django_db(transaction=True)
+class TestDispatchOnCommit:
+
+    def test_rolled_back_transaction_is_not_broadcast(self):
+        user = get_user_model().objects.create_user(username="user1", password="user1")
+        with override_settings(DATA_DISPATCH={"BACKGROUND": False}):
+            with mock.patch.object(Dispatcher, "submit") as submit:
+                with pytest.raises(RuntimeError):
+                    with transaction.atomic():
+                        Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=user)
+                        raise RuntimeError()
+                submit.assert_not_called()
+
+                with transaction.atomic():
+                    Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=user)
+                    submit.assert_not_called()
+                assert [call[0][0] for call in submit.call_args_list] == ["realtime_" + str(user.id)]
+
+    def test_instrument_groups_are_sent_when_enabled(self):
+        user = get_user_model().objects.create_user(username="user1", password="user1")
+        with override_settings(DATA_DISPATCH={"BACKGROUND": False, "INSTRUMENT_GROUPS": True}):
+            assert get_dispatcher().instrument_groups is True
+            with mock.patch.object(Dispatcher, "submit") as submit:
+                Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=user)
+                assert [call[0][0] for call in submit.call_args_list] == [
+                    "realtime_" + str(user.id), "realtime_" + str(user.id) + ".i-BNP"]
+
+    def test_dispatcher_follows_settings(self):
+        with override_settings(DATA_DISPATCH={"BACKGROUND": False, "POLICY": "drop"}):
+            dispatcher = get_dispatcher()
+            assert dispatcher.background is False
+            assert dispatcher.policy == "drop"
+        assert get_dispatcher() is not dispatcher
+
+
+class TestPublish:
+
+    def test_a_waiting_submit_holds_neither_the_other_users_nor_the_order(self):
+        # Users without notifications in the other tests
+        first, second = 90001, 90002
+        entered, gate, submitted = threading.Event(), threading.Event(), []
+
+        def submit(dispatcher, group, message, key=None, merge=None):
+            if not entered.is_set():
+                # The dispatcher queue is full
+                entered.set()
+                gate.wait(5)
+            submitted.append((group, message["items"][0][0]))
+
+        def notification(order):
+            return {"id": order, "version": 1, "type": "data.new"}, {"instrument": "BNP"}
+
+        with override_settings(DATA_DISPATCH={"BACKGROUND": False}):
+            with mock.patch.object(Dispatcher, "submit", submit):
+                waiting = threading.Thread(target=publish, args=(first, [notification(1)]))
+                waiting.start()
+                assert entered.wait(5)
+                # Queued behind the first message of the user, the other users are sent right away
+                publish(first, [notification(2)])
+                publish(second, [notification(3)])
+                assert submitted == [("realtime_90002", 3)]
+                gate.set()
+                waiting.join()
+        assert submitted[1:] == [("realtime_90001", 1), ("realtime_90001", 2)]
+
+
+class FakePostgresConnection:
+    """
+    Database connection double delivering the NOTIFY payloads of one batch per poll.
+    """
+    vendor = "postgresql"
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.notifies = []
+        self.executed = []
+        self.connection = self
+
+    def ensure_connection(self):
+        pass
+
+    def set_autocommit(self, autocommit):
+        pass
+
+    def cursor(self):
+        cursor = mock.MagicMock()
+        cursor.__enter__.return_value.execute.side_effect = lambda sql, *args: self.executed.append(sql)
+        cursor.__enter__.return_value.fetchone.return_value = ("O",)
+        return cursor
+
+    def poll(self):
+        if not self.batches:
+            raise KeyboardInterrupt()
+        self.notifies.extend(mock.Mock(payload=payload) for payload in self.batches.pop(0))
+
+
+@pytest.mark.django_db(transaction=True)
+class TestChangeFeed:
+
+    def test_triggers_payloads_are_published(self):
+        user = get_user_model().objects.create_user(username="user1", password="user1")
+        row = {"id": 7, "user_id": user.id, "instrument": "BNP", "quantity": 10.0, "initial_price": 99.0,
+               "version": 2}
+        with override_settings(DATA_DISPATCH={"BACKGROUND": False}):
+            with mock.patch.object(Dispatcher, "submit") as submit:
+                changefeed.handle_changes([
+                    json.dumps({"op": "INSERT", "row": dict(row, version=1)}),
+                    json.dumps({"op": "UPDATE", "row": row}),
+                    json.dumps({"op": "DELETE", "row": row}),
+                ])
+                submit.assert_called_once()
+                group, message = submit.call_args[0]
+                assert group == "realtime_" + str(user.id)
+                contents = [json.loads(item[2]) for item in message["items"]]
+                assert [(content["type"], content["version"]) for content in contents] == [
+                    ("data.new", 1), ("data.update", 2)]
+                assert contents[1] == dict(contents[1], id=7, quantity=10.0, instrument="BNP")
+
+    def test_listener_survives_a_failing_batch(self):
+        connection = FakePostgresConnection([["first"], ["second"]])
+        handled = []
+
+        def handle(payloads):
+            handled.append(payloads)
+            if payloads == ["first"]:
+                raise ValueError()
+
+        with mock.patch.dict(changefeed.connections._connections.__dict__, {"default": connection}):
+            with mock.patch("select.select", lambda readers, *args: (readers, [], [])):
+                with pytest.raises(KeyboardInterrupt):
+                    changefeed.listen(handle=handle)
+        assert handled == [["first"], ["second"]]
+        # The NOTIFY trigger is disabled out of the "notify" mode
+        assert "ALTER TABLE generic_data DISABLE TRIGGER generic_data_notify" in connection.executed
+
+    def test_saves_are_not_notified_in_notify_mode(self):
+        user = get_user_model().objects.create_user(username="user1", password="user1")
+        with override_settings(DATA_DISPATCH={"BACKGROUND": False}, DATA_CHANGE_FEED={"MODE": "notify"}):
+            with mock.patch.object(Dispatcher, "submit") as submit:
+                Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=user)
+                Data.objects.bulk_create([Data(instrument="BNP", quantity=2, initial_price=1, user=user)])
+                submit.assert_not_called()
@@ -0,0 +1,299 @@
+import gzip
+import json
+from unittest import mock
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from rest_framework.test import APIClient
+
+from generic import caching
+from generic import consumers  # noqa: F401, registers the metrics of the websocket consumers
+from generic import sqlite
+from generic.dispatch import Dispatcher
+from generic.models import Data
+
+TEST_DATA_DISPATCH = {
+    'BACKGROUND': False,
+}
+
+
+def create_user(username='admin', password='admin', permissions=('add_data', 'change_data', 'view_data')):
+    user = get_user_model().objects.create_user(
+        username=username,
+        password=password
+    )
+    user.user_permissions.set(Permission.objects.filter(codename__in=permissions))
+    return user
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # The users of the different tests can share their ids
+    cache.clear()
+
+
+@pytest.fixture
+def submit():
+    with override_settings(DATA_DISPATCH=TEST_DATA_DISPATCH):
+        with mock.patch.object(Dispatcher, "submit") as submit:
+            yield submit
+
+
+def user_messages(submit, user):
+    """
+    Returns the messages submitted to the realtime group of the user, leaving the instrument groups.
+    """
+    return [call[0][1] for call in submit.call_args_list if call[0][0] == "realtime_" + str(user.id)]
+
+
+def api_client(user):
+    client = APIClient()
+    client.force_authenticate(user=user)
+    return client
+
+
+@pytest.mark.django_db(transaction=True)
+class TestBulkWrite:
+
+    def test_bulk_create_sends_one_message_per_user(self, submit):
+        user = create_user()
+        orders = [
+            {"user": user.id, "instrument": "BNP", "quantity": i, "initial_price": 10}
+            for i in range(50)
+        ]
+        response = api_client(user).post('/api/data/', orders, format='json')
+
+        assert response.status_code == 201
+        assert Data.objects.filter(user=user).count() == 50
+        ids = [order["id"] for order in response.json()]
+        assert ids == sorted(Data.objects.values_list("id", flat=True))
+
+        messages = user_messages(submit, user)
+        assert len(messages) == 1
+        message = messages[0]
+        content = [json.loads(item[2]) for item in message["items"]]
+        assert [item["id"] for item in content] == ids
+        assert {item["type"] for item in content} == {"data.new"}
+
+    def test_created_ids_are_only_guessed_on_sqlite(self, submit):
+        user = create_user()
+        Data.objects.create(user=user, instrument="BNP", quantity=1, initial_price=10)
+        submit.reset_mock()
+        with mock.patch.object(connection, "vendor", "mysql"):
+            orders = Data.objects.bulk_create([Data(user=user, instrument="EDF", quantity=2, initial_price=10)])
+        # Without RETURNING, the highest ids may be the rows of another writer
+        assert orders[0].pk is None
+        assert user_messages(submit, user) == []
+
+    def test_bulk_upsert_by_id(self, submit):
+        user = create_user()
+        existing = Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=user)
+        submit.reset_mock()
+        orders = [
+            {"id": existing.id, "user": user.id, "instrument": "BNP", "quantity": 2, "initial_price": 1},
+            {"user": user.id, "instrument": "EDF", "quantity": 3, "initial_price": 1},
+        ]
+        response = api_client(user).post('/api/data/', orders, format='json')
+
+        assert response.status_code == 201
+        assert response.json()[0]["id"] == existing.id
+        existing.refresh_from_db()
+        assert existing.quantity == 2
+        assert Data.objects.filter(user=user).count() == 2
+
+        messages = user_messages(submit, user)
+        types = [message["items"][0][1] for message in messages]
+        assert types == ["data.new", "data.update"]
+        # The update only carries the changed quantity
+        update = json.loads(messages[1]["items"][0][2])
+        assert update == dict(update, id=existing.id, version=2, quantity=2)
+        assert "instrument" not in update and "initial_price" not in update
+
+    def test_concurrent_saves_get_their_own_version(self, submit):
+        user = create_user()
+        order = Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=user)
+        first, second = Data.objects.get(pk=order.pk), Data.objects.get(pk=order.pk)
+        first.quantity = 2
+        first.save()
+        second.initial_price = 3
+        second.save()
+        assert (first.version, second.version) == (2, 3)
+        Data.objects.bulk_update([first], ['quantity'])
+        assert first.version == 4
+
+    def test_bulk_update_of_unknown_order_is_rejected(self, submit):
+        user = create_user()
+        other = create_user(username='other', password='other')
+        order = Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=other)
+        orders = [{"id": order.id, "user": user.id, "instrument": "BNP", "quantity": 2, "initial_price": 1}]
+
+        response = api_client(user).post('/api/data/', orders, format='json')
+
+        assert response.status_code == 400
+        order.refresh_from_db()
+        assert order.quantity == 1
+
+    def test_bulk_update_needs_change_permission(self, submit):
+        user = create_user(permissions=('add_data', 'view_data'))
+        order = Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=user)
+        orders = [{"id": order.id, "user": user.id, "instrument": "BNP", "quantity": 2, "initial_price": 1}]
+
+        response = api_client(user).post('/api/data/', orders, format='json')
+
+        assert response.status_code == 403
+
+
+@pytest.mark.django_db(transaction=True)
+class TestPagination:
+
+    def test_cursor_pagination(self, submit):
+        user = create_user()
+        Data.objects.bulk_create([
+            Data(instrument="BNP", quantity=i, initial_price=1, user=user) for i in range(25)
+        ])
+        client = api_client(user)
+
+        ids = []
+        url = '/api/data/?pagination=cursor&page_size=10'
+        while url:
+            page = client.get(url, format='json').json()
+            assert 'count' not in page
+            ids.extend(order["id"] for order in page["results"])
+            url = page["next"]
+        assert ids == sorted(Data.objects.filter(user=user).values_list("id", flat=True), reverse=True)
+
+    def test_datatables_cached_count(self, submit):
+        user = create_user()
+        Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=user)
+        client = api_client(user)
+        url = '/api/data/?format=datatables&draw=1&start=0&length=10'
+
+        with override_settings(DATA_PAGINATION={"COUNT": "cached", "COUNT_TIMEOUT": 60},
+                               DATA_LIST_CACHE={"ENABLED": False}):
+            assert client.get(url).json()["recordsTotal"] == 1
+            Data.objects.create(instrument="BNP", quantity=2, initial_price=1, user=user)
+            response = client.get(url).json()
+            assert response["recordsTotal"] == 1
+            assert len(response["data"]) == 2
+
+        with override_settings(DATA_LIST_CACHE={"ENABLED": False}):
+            assert client.get(url).json()["recordsTotal"] == 2
+
+
+@pytest.mark.django_db(transaction=True)
+class TestListCache:
+
+    def test_pages_are_cached_until_a_write(self, submit, django_assert_num_queries):
+        user = create_user()
+        order = Data.objects.create(instrument="BNP", quantity=1, initial_price=1, user=user)
+        client = api_client(user)
+        url = '/api/data/?format=datatables&start=0&length=10&draw='
+
+        response = client.get(url + '1').json()
+        assert response["recordsTotal"] == 1
+        hits = caching.hits.value
+        # Only the draw counter changes
+        with django_assert_num_queries(0):
+            response = client.get(url + '2').json()
+        assert caching.hits.value == hits + 1
+        assert response["draw"] == 2 and response["recordsTotal"] == 1
+
+        Data.objects.create(instrument="EDF", quantity=2, initial_price=1, user=user)
+        assert client.get(url + '3').json()["recordsTotal"] == 2
+
+        order.delete()
+        assert client.get(url + '4').json()["recordsTotal"] == 1
+
+        # The queryset updates bypass the save
+        Data.objects.filter(user=user).update(quantity=50)
+        assert client.get(url + '5').json()["data"][0]["quantity"] == 50
+
+
+@pytest.mark.django_db(transaction=True)
+class TestExport:
+
+    def test_csv_and_ndjson_export(self, submit):
+        user = create_user()
+        orders = Data.objects.bulk_create([
+            Data(instrument="BNP", quantity=i, initial_price=1.5, user=user) for i in range(3)
+        ])
+        client = api_client(user)
+
+        response = client.get('/api/data/export/')
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'text/csv; charset=utf-8'
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        assert lines[0] == "id,user,instrument,quantity,initial_price,version"
+        assert lines[1] == "{},{},BNP,0.0,1.5,1".format(orders[0].id, user.id)
+        assert len(lines) == 4
+
+        response = client.get('/api/data/export/?output=ndjson&gzip=1')
+        assert response['Content-Disposition'] == 'attachment; filename="orders.ndjson.gz"'
+        rows = [json.loads(line) for line in gzip.decompress(b"".join(response.streaming_content)).splitlines()]
+        assert [row["id"] for row in rows] == [order.id for order in orders]
+        assert rows[2] == {"id": orders[2].id, "user": user.id, "instrument": "BNP", "quantity": 2.0,
+                           "initial_price": 1.5, "version": 1}
+
+        assert client.get('/api/data/export/?output=xml').status_code == 400
+
+
+@pytest.mark.django_db(transaction=True)
+class TestSQLiteProfile:
+
+    def test_pragmas_applied_when_enabled(self):
+        with override_settings(DATA_SQLITE={"ENABLED": False}):
+            sqlite.configure_connection(sender=None, connection=connection)
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout = 0")
+            with override_settings(DATA_SQLITE={"ENABLED": True}):
+                sqlite.configure_connection(sender=None, connection=connection)
+            cursor.execute("PRAGMA busy_timeout")
+            assert cursor.fetchone()[0] == 5000
+
+    def test_orders_created_by_the_batch_writer(self, submit):
+        user = create_user()
+        client = api_client(user)
+        with override_settings(DATA_SQLITE={"ENABLED": True, "PRAGMAS": {}, "BATCH_WINDOW": 50}):
+            futures = [
+                sqlite.get_batch_writer().create(instrument="BNP", quantity=i, initial_price=1.5, user=user)
+                for i in range(5)
+            ]
+            content = {"instrument": "GLE", "quantity": 10, "initial_price": 2.5, "user": user.id}
+            response = client.post('/api/data/', content, format='json')
+            orders = [future.result(5) for future in futures]
+        assert response.status_code == 201
+        assert Data.objects.get(id=response.data["id"]).instrument == "GLE"
+        assert [order.quantity for order in orders] == [0, 1, 2, 3, 4]
+        assert Data.objects.filter(user=user).count() == 6
+
+
+@pytest.mark.django_db(transaction=True)
+class TestMetricsEndpoint:
+
+    def test_prometheus_exposition(self, client):
+        staff = get_user_model().objects.create_user(username="staff", password="staff", is_staff=True)
+        client.force_login(staff)
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+        text = response.content.decode()
+        assert "# TYPE dispatch_group_send_seconds histogram" in text
+        assert 'stream_save_to_receive_seconds_bucket{le="+Inf"}' in text
+        assert "# TYPE stream_connections gauge" in text
+
+    def test_staff_or_token_is_required(self, client):
+        with override_settings(DATA_METRICS={"TOKEN": None}):
+            assert client.get('/metrics').status_code == 403
+            assert client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code == 403
+            user = get_user_model().objects.create_user(username="user1", password="user1")
+            client.force_login(user)
+            assert client.get('/metrics').status_code == 403
+        client.logout()
+        with override_settings(DATA_METRICS={"TOKEN": "secret"}):
+            assert client.get('/metrics').status_code == 403
+            assert client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code == 403
+            assert client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code == 200
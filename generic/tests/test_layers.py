@@ -0,0 +1,176 @@
+import asyncio
+import threading
+from unittest import mock
+
+import pytest
+from django.test import override_settings
+
+from generic.layers import HashRing, HybridChannelLayer, ShardedRedisChannelLayer
+from generic.models import group_name
+
+HOSTS = [("redis-1", 6379), ("redis-2", 6379), ("redis-3", 6379)]
+
+TEST_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'generic.layers.ShardedRedisChannelLayer',
+        'CONFIG': {'hosts': HOSTS},
+    },
+}
+
+
+class FakeRedis:
+    """
+    Connection double of a shard answering the health checks.
+    """
+    closed = False
+
+    def __init__(self, host):
+        self.host = host
+
+    async def ping(self):
+        return b"PONG"
+
+    async def info(self):
+        return {"memory": {"used_memory": 1024}, "clients": {"connected_clients": 3}}
+
+    def close(self):
+        pass
+
+
+async def fake_pop(pool, loop=None):
+    if pool.host["address"][0] == "redis-2":
+        raise ConnectionRefusedError("Connection refused")
+    connection = FakeRedis(pool.host)
+    pool.in_use[connection] = loop
+    return connection
+
+
+class TestHashRing:
+
+    def test_keys_are_spread_and_mostly_kept_when_a_host_is_added(self):
+        keys = ["realtime_{}".format(user) for user in range(10000)]
+        ring = HashRing(["redis-1:6379", "redis-2:6379", "redis-3:6379"])
+        owners = [ring.get(key) for key in keys]
+        for index in range(3):
+            assert 2500 < owners.count(index) < 4200
+
+        larger = HashRing(["redis-1:6379", "redis-2:6379", "redis-3:6379", "redis-4:6379"])
+        moved = [key for key, owner in zip(keys, owners) if larger.get(key) != owner]
+        # Only the keys taken by the new host move
+        assert all(larger.get(key) == 3 for key in moved)
+        assert 1500 < len(moved) < 3500
+
+
+class TestShardedRedisChannelLayer:
+
+    def test_groups_of_a_user_share_their_shard(self):
+        layer = ShardedRedisChannelLayer(hosts=HOSTS)
+        for user in range(100):
+            shard = layer.consistent_hash(group_name(user))
+            assert layer.consistent_hash(group_name(user, "BNP")) == shard
+            assert layer.consistent_hash(group_name(user, "not a symbol")) == shard
+        assert len({layer.consistent_hash(group_name(user)) for user in range(100)}) == 3
+
+    def test_process_channels_are_hashed_on_their_process(self):
+        layer = ShardedRedisChannelLayer(hosts=HOSTS)
+        channel = "specific." + layer.client_prefix + "!abcdefghijkl"
+        assert layer.consistent_hash(channel) == layer.consistent_hash(layer.non_local_name(channel))
+
+    def test_order_of_the_hosts_does_not_move_the_groups(self):
+        layer = ShardedRedisChannelLayer(hosts=HOSTS)
+        reversed_layer = ShardedRedisChannelLayer(hosts=HOSTS[::-1])
+        for user in range(100):
+            assert layer.hosts[layer.consistent_hash(group_name(user))] == \
+                reversed_layer.hosts[reversed_layer.consistent_hash(group_name(user))]
+
+    def test_health_view(self, client):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_METRICS={"TOKEN": "secret"}):
+            assert client.get('/health/channels').status_code == 403
+            with mock.patch("channels_redis.core.ConnectionPool.pop", fake_pop):
+                response = client.get('/health/channels', HTTP_AUTHORIZATION='Bearer secret')
+        assert response.status_code == 503
+        shards = response.json()["shards"]
+        assert [(shard["host"], shard["status"]) for shard in shards] == [
+            ("redis-1:6379", "up"), ("redis-2:6379", "down"), ("redis-3:6379", "up"),
+        ]
+        assert shards[0]["used_memory"] == 1024
+        assert shards[1]["error"] == "Connection refused"
+
+
+def hybrid_layers(count):
+    """
+    Returns the layers of count processes sharing an in memory remote layer.
+    """
+    layers = [HybridChannelLayer(remote={"BACKEND": "channels.layers.InMemoryChannelLayer"}) for _ in range(count)]
+    for layer in layers[1:]:
+        layer.remote = layers[0].remote
+    return layers
+
+
+@pytest.mark.asyncio
+class TestHybridChannelLayer:
+
+    async def test_group_messages_are_delivered_once_to_local_and_remote_channels(self):
+        local, other = hybrid_layers(2)
+        channels = [await local.new_channel(), await local.new_channel(), await other.new_channel()]
+        for layer, channel in zip((local, local, other), channels):
+            await layer.group_add("realtime_1", channel)
+        # The other process only holds its process channel in the remote group
+        assert set(local.remote.groups["realtime_1"]) == {local.process_channel, other.process_channel}
+
+        await local.group_send("realtime_1", {"type": "data.send", "id": 1})
+        assert await local.receive(channels[0]) == {"type": "data.send", "id": 1}
+        assert await local.receive(channels[1]) == {"type": "data.send", "id": 1}
+        assert await asyncio.wait_for(other.receive(channels[2]), 1) == {"type": "data.send", "id": 1}
+        # The copy published for the other processes is dropped by the sender
+        await asyncio.sleep(0.01)
+        assert all(local.channels[channel].queue.empty() for channel in channels[:2])
+        await local.flush()
+        await other.flush()
+
+    async def test_local_channels_receive_their_own_copy(self):
+        layer, = hybrid_layers(1)
+        channels = [await layer.new_channel(), await layer.new_channel()]
+        for channel in channels:
+            await layer.group_add("realtime_1", channel)
+        message = {"type": "data.send", "items": [[1, "data.new"]]}
+        await layer.group_send("realtime_1", message)
+        message["items"].append([2, "data.new"])
+        first = await layer.receive(channels[0])
+        first["items"][0][1] = "data.update"
+        assert await layer.receive(channels[1]) == {"type": "data.send", "items": [[1, "data.new"]]}
+        await layer.flush()
+
+    async def test_group_send_from_another_thread(self):
+        layer, = hybrid_layers(1)
+        channel = await layer.new_channel()
+        await layer.group_add("realtime_1", channel)
+        sender = threading.Thread(target=asyncio.run, args=(layer.group_send("realtime_1", {"type": "data.send"}),))
+        sender.start()
+        sender.join()
+        assert await asyncio.wait_for(layer.receive(channel), 1) == {"type": "data.send"}
+        await layer.flush()
+
+    async def test_send_to_a_channel_of_another_process(self):
+        local, other = hybrid_layers(2)
+        channel = await other.new_channel()
+        assert local.process_of(channel) == other.process_channel
+        await local.send(channel, {"type": "data.send"})
+        assert await asyncio.wait_for(other.receive(channel), 1) == {"type": "data.send"}
+        await local.flush()
+        await other.flush()
+
+    async def test_channel_is_forgotten_when_its_receive_is_cancelled(self):
+        layer, = hybrid_layers(1)
+        channel = await layer.new_channel()
+        await layer.group_add("realtime_1", channel)
+        receive = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0)
+        receive.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await receive
+        await asyncio.sleep(0)
+        assert channel not in layer.channels
+        assert "realtime_1" not in layer.groups
+        assert "realtime_1" not in layer.remote.groups
+        await layer.flush()
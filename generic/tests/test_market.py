@@ -0,0 +1,163 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+from django.test import override_settings
+
+from generic import consumers
+from generic.market import MarketBook, MarketView, get_market_feed
+from generic.pnl import PositionBook
+from generic.tests.test_websockets import (
+    TEST_CHANNEL_LAYERS, TEST_DATA_DISPATCH, auth_connect, create_order, create_user, update_order
+)
+
+TEST_MARKET_DATA = {
+    "OPTIONS": {"symbols": ["BNP", "EDF", "SGO"], "rate": 100000, "batch_size": 10, "seed": 1},
+    "FLUSH_INTERVAL": 20,
+    "MIN_FLUSH_INTERVAL": 1,
+}
+
+
+class TestMarketView:
+
+    def test_only_latest_prices_are_sent(self):
+        book = MarketBook(["BNP", "EDF", "SGO"], [10.0, 20.0, 30.0])
+        view = MarketView(book)
+        slots, unknown = book.lookup(["SGO", "BNP", "XXX"])
+        assert unknown == ["XXX"]
+        view.add(slots)
+
+        # The current prices follow the subscription
+        assert json.loads(view.frame()) == {"type": "ticks", "symbols": ["BNP", "SGO"], "prices": [10.0, 30.0]}
+        assert view.frame() is None
+
+        for price in (11.0, 12.0, 13.0):
+            book.apply(np.array([0, 1]), np.array([price, price]))
+        assert json.loads(view.frame()) == {"type": "ticks", "symbols": ["BNP"], "prices": [13.0]}
+
+        view.remove(book.lookup(["BNP"])[0])
+        book.apply(np.array([0, 2]), np.array([14.0, 31.0]))
+        assert json.loads(view.frame()) == {"type": "ticks", "symbols": ["SGO"], "prices": [31.0]}
+
+
+class TestPositionBook:
+
+    def test_positions_are_marked_to_market(self):
+        market = MarketBook(["BNP", "EDF"], [10.0, 20.0])
+        positions = PositionBook(market)
+        positions.load([
+            (1, "BNP", 2, 8.0, 1),
+            (2, "BNP", 1, 12.0, 1),
+            (3, "EDF", 5, 20.0, 1),
+            (4, "XXX", 1, 1.0, 1),
+        ])
+        assert json.loads(positions.frame()) == {
+            "type": "pnl", "instruments": ["BNP", "EDF"], "quantity": [3.0, 5.0], "pnl": [2.0, 0.0], "total": 2.0}
+        assert positions.frame() is None
+
+        # Order updates, the outdated ones are ignored
+        positions.apply(1, {"instrument": "BNP", "quantity": 4, "initial_price": 8.0, "version": 3})
+        positions.apply(1, {"instrument": "BNP", "quantity": 3, "initial_price": 8.0, "version": 2})
+        assert json.loads(positions.frame())["pnl"] == [6.0, 0.0]
+
+        # Price ticks, only the ones of the instruments held change the valuation
+        market.apply(np.array([0]), np.array([11.0]))
+        assert json.loads(positions.frame())["pnl"] == [11.0, 0.0]
+        market.apply(np.array([1]), np.array([20.0]))
+        assert json.loads(positions.frame())["total"] == 11.0
+        assert positions.frame() is None
+
+        # An order leaving the subscription, unless its state is outdated
+        positions.discard(3, 1)
+        assert positions.frame() is None
+        positions.discard(3, 2)
+        assert json.loads(positions.frame())["quantity"] == [5.0, 0.0]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+class TestMarketDataConsumer:
+
+    async def test_subscribed_instruments_are_streamed(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, MARKET_DATA=TEST_MARKET_DATA):
+            user = await create_user()
+            communicator = await auth_connect(user, path='/market/stream/')
+
+            await communicator.send_json_to({"command": "subscribe", "instruments": ["BNP", "XXX"]})
+            assert await communicator.receive_json_from() == {
+                "command": "subscribe", "status": "ok", "count": 1, "unknown": ["XXX"]}
+
+            # One price per instrument and frame, whatever the number of ticks
+            for _ in range(3):
+                frame = await communicator.receive_json_from()
+                assert frame["type"] == "ticks"
+                assert frame["symbols"] == ["BNP"] and len(frame["prices"]) == 1
+
+            await communicator.send_json_to({"command": "subscribe", "instruments": "BNP"})
+            assert await communicator.receive_json_from() == {"error": "INVALID_INSTRUMENTS"}
+
+            await communicator.send_json_to({"command": "unsubscribe"})
+            response = await communicator.receive_json_from()
+            while response.get("type") == "ticks":
+                response = await communicator.receive_json_from()
+            assert response == {"command": "unsubscribe", "status": "ok", "count": 0}
+            assert await communicator.receive_nothing() is True
+            await communicator.disconnect()
+
+    async def test_pnl_follows_order_updates(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH,
+                               MARKET_DATA=TEST_MARKET_DATA, DATA_STREAM={'PNL_INTERVAL': 10}):
+            user = await create_user()
+            order = await create_order(instrument="BNP", quantity=100, initial_price=99, user=user)
+            communicator = await auth_connect(user)
+
+            await communicator.send_json_to({"command": "subscribe", "pnl": True})
+            response = await communicator.receive_json_from()
+            assert response['pnl'] is True
+            frame = await communicator.receive_json_from()
+            assert frame['type'] == 'pnl'
+            assert frame['instruments'] == ["BNP"] and frame['quantity'] == [100]
+
+            await update_order(order, quantity=200)
+            while frame.get('type') != 'pnl' or frame['quantity'] != [200]:
+                frame = await communicator.receive_json_from()
+            assert frame['total'] == frame['pnl'][0]
+            await communicator.disconnect()
+
+    async def test_pnl_follows_the_subscribed_instruments(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH,
+                               MARKET_DATA=TEST_MARKET_DATA, DATA_STREAM={'PNL_INTERVAL': 10}):
+            user = await create_user()
+            await create_order(instrument="BNP", quantity=100, initial_price=99, user=user)
+            other = await create_order(instrument="EDF", quantity=50, initial_price=99, user=user)
+            communicator = await auth_connect(user)
+
+            await communicator.send_json_to({"command": "subscribe", "instruments": ["BNP"], "pnl": True})
+            assert (await communicator.receive_json_from())['pnl'] is True
+            assert (await communicator.receive_json_from())['instruments'] == ["BNP"]
+
+            # The orders of the other instruments are left out
+            await update_order(other, quantity=60)
+            for _ in range(3):
+                assert (await communicator.receive_json_from())['instruments'] == ["BNP"]
+            await communicator.send_json_to({"command": "subscribe", "instruments": ["EDF"]})
+            frame = await communicator.receive_json_from()
+            while frame.get('command') != 'subscribe':
+                frame = await communicator.receive_json_from()
+            # and loaded once subscribed to
+            while frame.get('type') != 'pnl':
+                frame = await communicator.receive_json_from()
+            assert frame['instruments'] == ["BNP", "EDF"] and frame['quantity'] == [100, 60]
+            await communicator.disconnect()
+
+    async def test_feed_is_detached_when_the_pnl_stops_before_its_start(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, MARKET_DATA=TEST_MARKET_DATA):
+            user = await create_user()
+            consumer = consumers.DataConsumer({"type": "websocket", "user": user, "path": "/data/stream/"})
+            feed = get_market_feed()
+            subscribers = feed.subscribers
+            await consumer.start_pnl()
+            consumer.stop_pnl()
+            await asyncio.sleep(0)
+            assert feed.subscribers == subscribers
@@ -0,0 +1,69 @@
+import os
+from time import perf_counter
+from unittest import mock
+
+import pytest
+from django.test import override_settings
+from rest_framework.renderers import JSONRenderer
+
+from generic.api_views import DataViewSet
+from generic.models import Data
+from generic.serializers import DataSerializer, ValuesSerializer
+from generic.tests.test_http import api_client, clear_cache, create_user, submit  # noqa: F401
+
+# The larger benchmarks are only run on demand
+BENCHMARK_SIZES = [1000] + ([10000, 100000] if os.environ.get("RUN_BENCHMARKS") else [])
+
+
+@pytest.mark.django_db(transaction=True)
+class TestValuesSerialization:
+
+    @pytest.mark.parametrize("url", [
+        '/api/data/',
+        '/api/data/?format=json&page=2',
+        '/api/data/?pagination=cursor&page_size=3',
+        '/api/data/?format=datatables&draw=1&start=2&length=5&columns[0][data]=id&columns[1][data]=quantity'
+        '&order[0][column]=1&order[0][dir]=asc',
+    ])
+    def test_same_output_as_the_serializer(self, submit, url):
+        user = create_user()
+        orders = Data.objects.bulk_create([
+            Data(instrument="BNP" if i % 2 else "EDF", quantity=i * 1.5, initial_price=10 - i, user=user)
+            for i in range(30)
+        ])
+        client = api_client(user)
+
+        with override_settings(DATA_LIST_CACHE={"ENABLED": False}), override_values_serialization(False):
+            expected = client.get(url).content, client.get('/api/data/{}/'.format(orders[3].id)).content
+        with override_settings(DATA_LIST_CACHE={"ENABLED": False}), override_values_serialization(True):
+            assert (client.get(url).content, client.get('/api/data/{}/'.format(orders[3].id)).content) == expected
+        assert client.get('/api/data/0/').status_code == 404
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("size", BENCHMARK_SIZES)
+def test_values_serialization_benchmark(size):
+    user = create_user()
+    Data.objects.bulk_create(
+        [Data(instrument="BNP", quantity=i, initial_price=99.5, user=user) for i in range(size)],
+        batch_size=5000,
+    )
+    queryset = Data.objects.filter(user=user).order_by("-id")
+    renderer = JSONRenderer()
+
+    start = perf_counter()
+    serialized = renderer.render(DataSerializer(queryset, many=True).data)
+    serializer_time = perf_counter() - start
+
+    values = ValuesSerializer.for_serializer(DataSerializer)
+    start = perf_counter()
+    fast = renderer.render(values.serialize(values.values(queryset)))
+    values_time = perf_counter() - start
+
+    print("\n{} rows : serializer {:.3f}s, values {:.3f}s ({:.1f}x)".format(
+        size, serializer_time, values_time, serializer_time / values_time))
+    assert fast == serialized
+
+
+def override_values_serialization(enabled):
+    return mock.patch.object(DataViewSet, "values_serialization", enabled)
@@ -1,3 +1,9 @@
+import asyncio
+import json
+import zlib
+from types import SimpleNamespace
+
+import msgpack
 import pytest
 from django.test import override_settings
 from django.contrib.auth import get_user_model
@@ -5,8 +11,10 @@ from django.test import Client
 from channels.db import database_sync_to_async
 from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
+from rest_framework.authtoken.models import Token
 
 from webapp.routing import application
+from generic import auth, consumers, encoding
 from generic.models import Data
 
 TEST_CHANNEL_LAYERS = {
@@ -15,6 +23,11 @@ TEST_CHANNEL_LAYERS = {
     },
 }
 
+# The in memory channel layer can only be used from the test event loop
+TEST_DATA_DISPATCH = {
+    'BACKGROUND': False,
+}
+
 
 @database_sync_to_async
 def create_user(username='admin', password='admin'):
@@ -44,13 +57,13 @@ def update_order(order, **kwargs):
 class TestWebsockets:
 
     async def test_authorized_user_can_connect(self, settings):
-        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
             user = await create_user()
             communicator = await auth_connect(user)
             await communicator.disconnect()
 
     async def test_user_can_subscribe_to_realtime(self, settings):
-        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
             user = await create_user()
             channel_layer = get_channel_layer()
 
@@ -59,7 +72,7 @@ class TestWebsockets:
 
             response = await communicator.receive_json_from()
 
-            assert response == {'command': 'subscribe', 'status': 'ok'}
+            assert subscribed(response)
             if response is not None:
                 # Assert that a group is created within channel layer  :
                 assert len(channel_layer.groups) == 1
@@ -76,7 +89,7 @@ class TestWebsockets:
             # assert channel_layer.groups == {} issue group is not deleted
 
     async def test_user_can_receive_new_orders(self, settings):
-        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
             channel_layer = get_channel_layer()
             user1 = await create_user(username='user1', password='user1')
             user2 = await create_user(username='user2', password='user2')
@@ -86,8 +99,8 @@ class TestWebsockets:
             communicator2 = await send_command(user2, command="subscribe")
 
             # Assert responses received
-            assert await communicator1.receive_json_from() == {'command': 'subscribe', 'status': 'ok'}
-            assert await communicator2.receive_json_from() == {'command': 'subscribe', 'status': 'ok'}
+            assert subscribed(await communicator1.receive_json_from())
+            assert subscribed(await communicator2.receive_json_from())
 
             # Add sample orders for both users
             order1 = await create_order(
@@ -106,9 +119,8 @@ class TestWebsockets:
             # Test the websocket for the initial order is received only through the first channel
             response1 = await communicator1.receive_json_from()
 
-            assert '{"id": 1, "quantity": 100, "initial_price": 99, "instrument": "BNP", ' \
-                   '"type": "data.new"' in response1['content']
-            assert response1['type'] == 'data.send'
+            assert response1 == dict(response1, id=order1.id, quantity=100, initial_price=99, instrument="BNP",
+                                     type="data.new")
 
             # Assert that nothing else is received through the first communicator
             assert await communicator1.receive_nothing() is True
@@ -116,10 +128,8 @@ class TestWebsockets:
             # Test the websocket for the second order is received only through the second channel
             response2 = await communicator2.receive_json_from()
 
-            assert '{"id": 2, "quantity": 200, "initial_price": 222, "instrument": "EDF", ' \
-                   '"type": "data.new"' in response2['content']
-
-            assert response2['type'] == 'data.send'
+            assert response2 == dict(response2, id=order2.id, quantity=200, initial_price=222, instrument="EDF",
+                                     type="data.new")
 
             # Assert that nothing else is received through the second communicator
             assert await communicator1.receive_nothing() is True
@@ -129,7 +139,7 @@ class TestWebsockets:
             assert channel_layer.groups == {}
 
     async def test_user_can_receive_update_orders(self, settings):
-        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
             channel_layer = get_channel_layer()
             user1 = await create_user(username='user1', password='user1')
             user2 = await create_user(username='user2', password='user2')
@@ -153,8 +163,8 @@ class TestWebsockets:
             communicator2 = await send_command(user2, command="subscribe")
 
             # Assert responses received
-            assert await communicator1.receive_json_from() == {'command': 'subscribe', 'status': 'ok'}
-            assert await communicator2.receive_json_from() == {'command': 'subscribe', 'status': 'ok'}
+            assert subscribed(await communicator1.receive_json_from())
+            assert subscribed(await communicator2.receive_json_from())
 
             # Add sample orders for both users
             await update_order(
@@ -175,9 +185,10 @@ class TestWebsockets:
             # Test the websocket for the initial order is received only through the first channel
             response1 = await communicator1.receive_json_from()
 
-            assert '{"id": 3, "quantity": 333, "initial_price": 33, "instrument": "BNP", ' \
-                   '"type": "data.update"' in response1['content']
-            assert response1['type'] == 'data.send'
+            # Only the changed fields are sent with the id and the version
+            assert response1 == dict(response1, id=order1.id, version=2, quantity=333, initial_price=33,
+                                     type="data.update")
+            assert 'instrument' not in response1
 
             # Assert that nothing else is received through the first communicator
             assert await communicator1.receive_nothing() is True
@@ -185,10 +196,10 @@ class TestWebsockets:
             # Test the websocket for the second order is received only through the second channel
             response2 = await communicator2.receive_json_from()
 
-            assert '{"id": 4, "quantity": 444, "initial_price": 44, "instrument": "EDF", ' \
-                   '"type": "data.update"' in response2['content']
-
-            assert response2['type'] == 'data.send'
+            # Only the changed fields are sent with the id and the version
+            assert response2 == dict(response2, id=order2.id, version=2, quantity=444, initial_price=44,
+                                     type="data.update")
+            assert 'instrument' not in response2
 
             # Assert that nothing else is received through the second communicator
             assert await communicator1.receive_nothing() is True
@@ -197,16 +208,481 @@ class TestWebsockets:
             await communicator2.disconnect()
             assert channel_layer.groups == {}
 
+    async def test_updates_are_coalesced_within_flush_interval(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
+            user = await create_user()
+            order1 = await create_order(instrument="BNP", quantity=100, initial_price=99, user=user)
+
+            communicator = await send_command(user, command="subscribe", flush_interval=100)
+            assert subscribed(await communicator.receive_json_from(), flush_interval=100)
+
+            for quantity in (1, 2, 3):
+                await update_order(order1, quantity=quantity)
+            order2 = await create_order(instrument="EDF", quantity=200, initial_price=222, user=user)
+            await update_order(order2, quantity=201)
+
+            # A single frame holding the latest state of each order
+            content = await communicator.receive_json_from(timeout=1)
+            assert [(item['id'], item['type'], item['quantity'], item['version']) for item in content] == [
+                (order1.id, 'data.update', 3, 4),
+                (order2.id, 'data.new', 201, 2),
+            ]
+            # The merged updates apply on the version preceding the first one
+            assert content[0]['base_version'] == 1 and 'base_version' not in content[1]
+            # The created order holds its full state
+            assert content[1]['instrument'] == "EDF"
+            assert await communicator.receive_nothing() is True
 
-async def send_command(user, command="subscribe"):
+            await communicator.disconnect()
+
+    async def test_user_can_ask_for_snapshot(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
+            user1 = await create_user(username='user1', password='user1')
+            user2 = await create_user(username='user2', password='user2')
+            order1 = await create_order(instrument="BNP", quantity=100, initial_price=99, user=user1)
+            order2 = await create_order(instrument="EDF", quantity=200, initial_price=222, user=user2)
+            await update_order(order1, quantity=101)
+
+            communicator = await auth_connect(user1)
+            await communicator.send_json_to({"command": "snapshot", "ids": [order1.id, order2.id]})
+
+            # Only the orders of the user are sent
+            assert await communicator.receive_json_from() == {'command': 'snapshot', 'data': [
+                {'id': order1.id, 'version': 2, 'quantity': 101, 'initial_price': 99, 'instrument': "BNP"},
+            ]}
+
+            await communicator.send_json_to({"command": "snapshot", "ids": "all"})
+            assert await communicator.receive_json_from() == {'error': 'INVALID_IDS'}
+
+            await communicator.disconnect()
+
+    async def test_reconnecting_user_gets_missed_notifications(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
+            user = await create_user()
+
+            communicator = await send_command(user, command="subscribe")
+            response = await communicator.receive_json_from()
+            order = await create_order(instrument="BNP", quantity=100, initial_price=99, user=user)
+            notification = await communicator.receive_json_from()
+            assert notification['seq'] == response['seq'] + 1
+            await communicator.disconnect()
+
+            # Updates missed while disconnected
+            await update_order(order, quantity=101)
+            await update_order(order, quantity=102)
+
+            communicator = await send_command(
+                user, command="subscribe", since=notification['seq'], epoch=response['epoch'])
+            assert subscribed(await communicator.receive_json_from())
+            replay = await communicator.receive_json_from()
+            assert [(item['seq'], item['quantity']) for item in replay] == [
+                (notification['seq'] + 1, 101),
+                (notification['seq'] + 2, 102),
+            ]
+            assert await communicator.receive_nothing() is True
+            await communicator.disconnect()
+
+    async def test_snapshot_required_when_replay_is_not_available(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH,
+                               DATA_REPLAY={'SIZE': 2}):
+            user = await create_user()
+            order = await create_order(instrument="BNP", quantity=100, initial_price=99, user=user)
+            for quantity in (101, 102, 103):
+                await update_order(order, quantity=quantity)
+
+            # The first notifications rolled over
+            communicator = await send_command(user, command="subscribe", since=1)
+            response = await communicator.receive_json_from()
+            assert response['snapshot_required'] is True
+            assert response['seq'] == 4
+
+            # Stream of another epoch
+            await communicator.send_json_to({"command": "subscribe", "since": 3, "epoch": "previous"})
+            assert (await communicator.receive_json_from())['snapshot_required'] is True
+
+            await communicator.send_json_to({"command": "subscribe", "since": -1})
+            assert await communicator.receive_json_from() == {'error': 'INVALID_SINCE'}
+            await communicator.disconnect()
+
+    async def test_subscribe_with_snapshot(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
+            user = await create_user()
+            orders = [
+                await create_order(instrument="BNP", quantity=quantity, initial_price=99, user=user)
+                for quantity in range(5)
+            ]
+
+            communicator = await send_command(user, command="subscribe", snapshot=True, chunk_size=2)
+            response = await communicator.receive_json_from()
+            assert subscribed(response, snapshot=True)
+
+            # The orders are sent in chunks tagged with the stream position
+            frames = [await communicator.receive_json_from() for _ in range(3)]
+            assert [frame['last'] for frame in frames] == [False, False, True]
+            assert {frame['seq'] for frame in frames} == {response['seq']}
+            rows = [row for frame in frames for row in frame['data']]
+            assert [row['id'] for row in rows] == [order.id for order in orders]
+            assert rows[1] == {'id': orders[1].id, 'version': 1, 'quantity': 1, 'initial_price': 99,
+                               'instrument': "BNP"}
+
+            # Followed by the live notifications
+            await update_order(orders[0], quantity=10)
+            notification = await communicator.receive_json_from()
+            assert notification['seq'] == response['seq'] + 1
+
+            await communicator.send_json_to({"command": "subscribe", "snapshot": True, "chunk_size": 0})
+            assert await communicator.receive_json_from() == {'error': 'INVALID_CHUNK_SIZE'}
+            await communicator.disconnect()
+
+    async def test_legacy_frames(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
+            user = await create_user()
+
+            communicator = await auth_connect(user, path='/data/stream/?frames=legacy')
+            await communicator.send_json_to({"command": "subscribe"})
+            assert subscribed(await communicator.receive_json_from())
+
+            order = await create_order(instrument="BNP", quantity=100, initial_price=99, user=user)
+
+            # The notification is a JSON string in the content of the envelope
+            response = await communicator.receive_json_from()
+            assert response['type'] == 'data.send'
+            content = json.loads(response['content'])
+            assert content == dict(content, id=order.id, quantity=100, type="data.new")
+
+            await communicator.disconnect()
+
+    @pytest.mark.parametrize("instrument_groups", [False, True])
+    async def test_instrument_and_filter_subscription(self, settings, instrument_groups):
+        dispatch = dict(TEST_DATA_DISPATCH, INSTRUMENT_GROUPS=instrument_groups)
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=dispatch):
+            user = await create_user()
+            everything = await send_command(user, command="subscribe")
+            assert subscribed(await everything.receive_json_from())
+            dashboard = await send_command(
+                user, command="subscribe", instruments=["BNP"], filters={"quantity__gte": 100})
+            assert subscribed(await dashboard.receive_json_from(), instruments=["BNP"],
+                              filters={"quantity__gte": 100})
+
+            small = await create_order(instrument="BNP", quantity=10, initial_price=99, user=user)
+            other = await create_order(instrument="EDF", quantity=500, initial_price=99, user=user)
+            large = await create_order(instrument="BNP", quantity=500, initial_price=99, user=user)
+
+            # The connection subscribed to everything gets every order, the dashboard only the matching one
+            assert [(await everything.receive_json_from())['id'] for _ in range(3)] == [small.id, other.id, large.id]
+            assert (await dashboard.receive_json_from())['id'] == large.id
+            assert await dashboard.receive_nothing() is True
+
+            # Instruments are added and removed without reconnecting
+            await dashboard.send_json_to({"command": "subscribe", "instruments": ["EDF"]})
+            assert (await dashboard.receive_json_from())['instruments'] == ["BNP", "EDF"]
+            await update_order(other, quantity=600)
+            assert (await dashboard.receive_json_from())['id'] == other.id
+
+            await dashboard.send_json_to({"command": "unsubscribe", "instruments": ["BNP"]})
+            assert await dashboard.receive_json_from() == {"command": "unsubscribe", "status": "ok",
+                                                           "instruments": ["EDF"]}
+            await update_order(large, quantity=700)
+            assert await dashboard.receive_nothing() is True
+
+            await dashboard.send_json_to({"command": "subscribe", "filters": {"price__gt": 1}})
+            assert await dashboard.receive_json_from() == {'error': 'INVALID_FILTERS'}
+            await everything.disconnect()
+            await dashboard.disconnect()
+
+    @pytest.mark.parametrize("instrument_groups", [False, True])
+    async def test_group_memberships_are_released_on_disconnect(self, settings, instrument_groups):
+        dispatch = dict(TEST_DATA_DISPATCH, INSTRUMENT_GROUPS=instrument_groups)
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=dispatch):
+            user = await create_user()
+            consumers.memberships.reset()
+            communicator = await send_command(user, command="subscribe", instruments=["BNP", "EDF"])
+            assert subscribed(await communicator.receive_json_from(), instruments=["BNP", "EDF"])
+            assert consumers.memberships.value == (2 if instrument_groups else 1)
+            await communicator.disconnect()
+            assert consumers.memberships.value == 0
+
+    async def test_new_orders_are_located_in_the_view(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH):
+            user = await create_user()
+            for quantity in (10, 20, 30, 40):
+                await create_order(instrument="BNP", quantity=quantity, initial_price=99, user=user)
+            communicator = await send_command(user, command="subscribe")
+            assert subscribed(await communicator.receive_json_from())
+
+            # Second page of 2 rows by descending quantity
+            await communicator.send_json_to(
+                {"command": "view", "order": [["quantity", "desc"]], "start": 2, "length": 2})
+            assert await communicator.receive_json_from() == {"command": "view", "status": "ok"}
+            await create_order(instrument="BNP", quantity=25, initial_price=99, user=user)
+            notification = await communicator.receive_json_from()
+            assert (notification['position'], notification['visible']) == (2, True)
+            await create_order(instrument="BNP", quantity=5, initial_price=99, user=user)
+            notification = await communicator.receive_json_from()
+            assert (notification['position'], notification['visible']) == (5, False)
+
+            # Filtered out by the search
+            await communicator.send_json_to({"command": "view", "search": "EDF"})
+            assert await communicator.receive_json_from() == {"command": "view", "status": "ok"}
+            await create_order(instrument="BNP", quantity=1, initial_price=99, user=user)
+            assert (await communicator.receive_json_from())['position'] is None
+
+            # Default ordering, the new orders come first
+            await communicator.send_json_to({"command": "view", "start": 0, "length": 10})
+            assert await communicator.receive_json_from() == {"command": "view", "status": "ok"}
+            await create_order(instrument="BNP", quantity=1, initial_price=99, user=user)
+            notification = await communicator.receive_json_from()
+            assert (notification['position'], notification['visible']) == (0, True)
+
+            await communicator.send_json_to({"command": "view", "order": [["price", "asc"]]})
+            assert await communicator.receive_json_from() == {'error': 'INVALID_VIEW'}
+            await communicator.disconnect()
+
+    async def test_flush_interval_is_capped(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH,
+                               DATA_STREAM={'MAX_FLUSH_INTERVAL': 500}):
+            user = await create_user()
+
+            communicator = await send_command(user, command="subscribe", flush_interval=60000)
+            assert subscribed(await communicator.receive_json_from(), flush_interval=500)
+
+            await communicator.send_json_to({"command": "subscribe", "flush_interval": "fast"})
+            assert await communicator.receive_json_from() == {'error': 'INVALID_FLUSH_INTERVAL'}
+
+            await communicator.disconnect()
+
+    async def test_msgpack_frames_compressed_from_their_min_size(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_DISPATCH=TEST_DATA_DISPATCH,
+                               DATA_STREAM={"COMPRESS_MIN_SIZE": 300}):
+            user = await create_user()
+            for quantity in range(10):
+                await create_order(instrument="BNP", quantity=quantity, initial_price=10, user=user)
+            communicator = await auth_connect(user, subprotocols=["msgpack+deflate", "json"])
+            await communicator.send_to(bytes_data=encoding.packb({"command": "subscribe", "snapshot": True}))
+            response = unpack((await communicator.receive_output())["bytes"])
+            assert response == dict(response, command="subscribe", status="ok", snapshot=True)
+
+            # The snapshot is compressed, the notification is not
+            snapshot = (await communicator.receive_output())["bytes"]
+            assert snapshot[0] == 0x78
+            assert [row["quantity"] for row in unpack(zlib.decompress(snapshot))["data"]] == list(range(10))
+            order = await create_order(instrument="EDF", quantity=5, initial_price=1, user=user)
+            notification = unpack((await communicator.receive_output())["bytes"])
+            assert notification == dict(notification, id=order.id, type="data.new", quantity=5)
+            await communicator.disconnect()
+
+    async def test_format_query_parameter(self, settings):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS):
+            user = await create_user()
+            communicator = await auth_connect(user, path='/data/stream/?format=msgpack')
+            await communicator.send_json_to({"command": "view", "start": "a"})
+            assert unpack((await communicator.receive_output())["bytes"]) == {"error": "INVALID_VIEW"}
+            await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+class TestWebsocketAuth:
+
+    async def test_ticket_and_token_authentication(self):
+        # A new cache, the users of the other tests can share their ids
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_WEBSOCKET_AUTH={"TICKET_MAX_AGE": 60}):
+            user = await create_user()
+            for path in ('/data/stream/?ticket=' + auth.issue_ticket(user),
+                         '/data/stream/?token=' + (await create_token(user)).key):
+                communicator = WebsocketCommunicator(application=application, path=path)
+                connected, _ = await communicator.connect()
+                assert connected is True
+                await communicator.disconnect()
+
+            communicator = WebsocketCommunicator(application=application, path='/data/stream/?ticket=forged')
+            connected, _ = await communicator.connect()
+            assert connected is False
+
+    async def test_cached_users_are_invalidated(self):
+        with override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, DATA_WEBSOCKET_AUTH={"TICKET_MAX_AGE": 60}):
+            user = await create_user()
+            ticket = auth.issue_ticket(user)
+            client = Client()
+            await database_sync_to_async(client.force_login)(user=user)
+            headers = [(b'cookie', f'sessionid={client.cookies["sessionid"].value}'.encode('ascii'))]
+            hits = auth.hits.value
+            for _ in range(2):
+                communicator = WebsocketCommunicator(application=application, path='/data/stream/', headers=headers)
+                connected, _ = await communicator.connect()
+                assert connected is True
+                await communicator.disconnect()
+            assert auth.hits.value == hits + 1
+
+            # The password change drops the cached sessions and revokes the tickets
+            await database_sync_to_async(user.set_password)('changed')
+            await database_sync_to_async(user.save)()
+            communicator = WebsocketCommunicator(application=application, path='/data/stream/?ticket=' + ticket)
+            connected, _ = await communicator.connect()
+            assert connected is False
+            assert auth.get_user_cache().get(("user", user.pk)) is None
+
+
+class SlowConsumer(consumers.DataConsumer):
+    """
+    Consumer of a client reading its frames when told to.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.channel_name = "specific.test!slow"
+        self.frames = []
+        self.closed_with = None
+        self.read = asyncio.Event()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await self.read.wait()
+        frame = json.loads(text_data)
+        self.frames.append(frame if isinstance(frame, list) else [frame])
+
+    async def close(self, code=None):
+        self.closed_with = code
+
+
+def slow_consumer(policy):
+    with override_settings(DATA_STREAM={"HIGH_WATER_MARK": 4, "LOW_WATER_MARK": 1, "SLOW_POLICY": policy}):
+        return SlowConsumer({"type": "websocket", "user": SimpleNamespace(id=1), "path": "/data/stream/"})
+
+
+def update(seq, order, quantity):
+    content = {"id": order, "version": seq, "quantity": quantity, "type": "data.update", "seq": seq}
+    route = {"instrument": "BNP", "quantity": quantity, "initial_price": 10.0}
+    return {"type": "data.send", "items": [[order, "data.update", json.dumps(content), seq, route]]}
+
+
+@pytest.mark.asyncio
+class TestSlowConnections:
+
+    async def test_conflate_policy_keeps_the_latest_state_of_each_order(self):
+        consumer = slow_consumer("conflate")
+        conflated = consumers.slow_conflated.value
+        await consumer.data_send(update(1, order=1, quantity=1))
+        # The first frame is being sent
+        await asyncio.sleep(0)
+        for seq in range(2, 9):
+            await consumer.data_send(update(seq, order=seq % 2, quantity=seq))
+        # The 5 queued updates were collapsed per order
+        assert consumer.queued == 4
+        assert consumer.slow is True
+        assert consumers.slow_conflated.value - conflated == 3
+        consumer.read.set()
+        while consumer.writer_task is not None:
+            await asyncio.sleep(0)
+        assert [[item["quantity"] for item in frame] for frame in consumer.frames] == [[1], [6, 5], [7], [8]]
+        assert consumer.slow is False
+
+    async def test_gap_policy_drops_and_asks_for_a_resync(self):
+        consumer = slow_consumer("gap")
+        gaps = consumers.slow_gaps.value
+        await consumer.data_send(update(1, order=1, quantity=1))
+        await asyncio.sleep(0)
+        for seq in range(2, 8):
+            await consumer.data_send(update(seq, order=seq, quantity=seq))
+        assert consumers.slow_gaps.value == gaps + 1
+        consumer.read.set()
+        while consumer.writer_task is not None:
+            await asyncio.sleep(0)
+        assert [frame[0]["seq"] for frame in consumer.frames] == [1, 6, 7]
+        assert consumer.frames[1] == [{"type": "gap", "seq": 6}]
+
+    async def test_replay_is_queued_whole(self):
+        consumer = slow_consumer("gap")
+        gaps = consumers.slow_gaps.value
+        replay = [update(seq, order=seq, quantity=seq)["items"][0] for seq in range(1, 8)]
+        await consumer.enqueue(replay, apply_policy=False)
+        assert consumers.slow_gaps.value == gaps
+        consumer.read.set()
+        while consumer.writer_task is not None:
+            await asyncio.sleep(0)
+        assert [[item["seq"] for item in frame] for frame in consumer.frames] == [list(range(1, 8))]
+
+    async def test_responses_are_sent_after_the_queued_notifications(self):
+        consumer = slow_consumer("conflate")
+        await consumer.data_send(update(1, order=1, quantity=1))
+        await asyncio.sleep(0)
+        await consumer.data_send(update(2, order=1, quantity=2))
+        await consumer.send_json({"command": "view", "status": "ok"})
+        for seq in range(3, 8):
+            await consumer.data_send(update(seq, order=seq % 2, quantity=seq))
+        consumer.read.set()
+        while consumer.writer_task is not None:
+            await asyncio.sleep(0)
+        # The updates queued after the response are conflated without it
+        assert [[item.get("quantity", item.get("command")) for item in frame] for frame in consumer.frames] == [
+            [1], [2], ["view"], [5, 6], [7]]
+
+    async def test_gap_is_not_conflated_with_the_following_notifications(self):
+        consumer = slow_consumer("conflate")
+        await consumer.data_send(update(1, order=1, quantity=1))
+        await asyncio.sleep(0)
+        # Too many orders to conflate : gapped
+        for seq in range(2, 7):
+            await consumer.data_send(update(seq, order=seq, quantity=seq))
+        # Conflated after the gap
+        for seq in range(7, 11):
+            await consumer.data_send(update(seq, order=7, quantity=seq))
+        consumer.read.set()
+        while consumer.writer_task is not None:
+            await asyncio.sleep(0)
+        assert consumer.frames[1] == [{"type": "gap", "seq": 6}]
+        assert [[item["quantity"] for item in frame] for frame in consumer.frames[2:]] == [[10]]
+
+    async def test_disconnect_policy_closes_the_connection(self):
+        consumer = slow_consumer("disconnect")
+        for seq in range(1, 7):
+            await consumer.data_send(update(seq, order=seq, quantity=seq))
+        assert consumer.closed_with == consumers.SLOW_CLOSE_CODE
+        assert consumer.queued == 0
+        assert consumer.writer_task is None
+
+
+class TestFrameEncoder:
+
+    def test_json_frames_are_sent_as_is_under_the_min_size(self):
+        encoder = encoding.FrameEncoder(compress=True, compress_min_size=100)
+        texts = ['{"id":1}', '{"id":2}']
+        assert encoder.notifications(texts) == {"text_data": '[{"id":1},{"id":2}]'}
+        assert encoding.FrameEncoder(legacy=True).notifications(texts[:1]) == \
+            {"text_data": '{"type": "data.send", "content": "{\\"id\\":1}"}'}
+
+        saved = encoding.compression_saved.value
+        frame = encoder.notifications(['{"id":%d,"instrument":"BNP"}' % i for i in range(20)])
+        assert json.loads(zlib.decompress(frame["bytes_data"]))[19] == {"id": 19, "instrument": "BNP"}
+        assert encoding.compression_saved.value > saved
+
+    def test_msgpack_frames(self):
+        encoder = encoding.FrameEncoder(format=encoding.MSGPACK, legacy=True)
+        sent = encoding.frame_bytes[encoding.MSGPACK].value
+        frame = encoder.notifications(['{"id":1}'])["bytes_data"]
+        assert unpack(frame) == {"id": 1}
+        assert encoding.frame_bytes[encoding.MSGPACK].value == sent + len(frame)
+        assert unpack(encoder.content({"command": "subscribe"})["bytes_data"]) == {"command": "subscribe"}
+
+
+def unpack(frame):
+    return msgpack.unpackb(frame, raw=False)
+
+
+def subscribed(response, **options):
+    """
+    Returns True if the response acknowledges the subscription, whatever the stream position.
+    """
+    acknowledgement = {key: value for key, value in response.items() if key not in ('seq', 'epoch')}
+    return acknowledgement == dict(options, command='subscribe', status='ok')
+
+
+async def send_command(user, command="subscribe", **options):
     communicator = await auth_connect(user)
-    await communicator.send_json_to({
-        "command": command
-    })
+    await communicator.send_json_to(dict(options, command=command))
     return communicator
 
 
-async def auth_connect(user):
+async def auth_connect(user, path='/data/stream/', subprotocols=None):
     # Force authentication to get session ID.
     client = Client()
     client.force_login(user=user)
@@ -214,11 +690,12 @@ async def auth_connect(user):
     # Pass session ID in headers to authenticate.
     communicator = WebsocketCommunicator(
         application=application,
-        path='/data/stream/',
+        path=path,
         headers=[(
             b'cookie',
             f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
-        )]
+        )],
+        subprotocols=subprotocols,
     )
     connected, _ = await communicator.connect()
     assert connected is True
@@ -228,3 +705,8 @@ async def auth_connect(user):
 @database_sync_to_async
 def create_order(**kwargs):
     return Data.objects.create(**kwargs)
+
+
+@database_sync_to_async
+def create_token(user):
+    return Token.objects.create(user=user)
@@ -1,5 +1,12 @@
+import hmac
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_GET
+from . import metrics as data_metrics
 from .models import Data
 
 
@@ -11,3 +18,45 @@ def index(request):
     """
     # Render that in the index template
     return render(request, "index.html")
+
+
+@require_GET
+def metrics(request):
+    """
+    Metrics of the process in the Prometheus text format, for the scrapers. The request must hold
+    the configured token in its "Authorization: Bearer <token>" header, or come from a staff user.
+    """
+    if not scraper_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(data_metrics.REGISTRY.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@require_GET
+def channels_health(request):
+    """
+    State of each shard of the channel layer (see layers.py), with a 503 status when one of
+    them is down. Served to the same requests as the metrics.
+    """
+    if not scraper_allowed(request):
+        return HttpResponseForbidden()
+    layer = get_channel_layer()
+    # The shards of the shared layer of a HybridChannelLayer
+    layer = getattr(layer, "remote", layer)
+    if not hasattr(layer, "shard_health"):
+        return JsonResponse({"layer": layer.__class__.__name__, "shards": []})
+    shards = async_to_sync(layer.shard_health)()
+    return JsonResponse(
+        {"layer": layer.__class__.__name__, "shards": shards},
+        status=200 if all(shard["status"] == "up" for shard in shards) else 503,
+    )
+
+
+def scraper_allowed(request):
+    """
+    Returns True when the request holds the metrics token, or comes from a logged in staff user.
+    Without a configured token, only the staff users are allowed.
+    """
+    if request.user.is_active and request.user.is_staff:
+        return True
+    token = data_metrics.metrics_settings()["TOKEN"]
+    return bool(token) and hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + token)
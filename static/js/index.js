@@ -1,8 +1,14 @@
+// Window in milliseconds during which the server collapses the updates of an order before sending them
+var FLUSH_INTERVAL = 100;
+
 $(document).ready(function () {
     var table = $('#data').DataTable({
         "deferRender": true
     });
-    var new_orders_table = $('#new_data').DataTable();
+    // The updates only carry the changed fields, the missing cells of the monitor are left empty
+    var new_orders_table = $('#new_data').DataTable({
+        "columnDefs": [{"targets": "_all", "defaultContent": ""}]
+    });
 
     $(function () {
         // Correctly decide between ws:// and wss://
@@ -12,6 +18,10 @@ $(document).ready(function () {
         var socket = new ReconnectingWebSocket(ws_path);
         console.log(socket);
 
+        // Sequence number of the last received notification, and epoch of the stream
+        var last_seq = 0;
+        var stream_epoch = null;
+
         // Handle incoming websocket messages
         socket.onmessage = function (message) {
             // Decode the JSON
@@ -23,59 +33,138 @@ $(document).ready(function () {
                 return;
             }
 
-            // If content received from the websocket
-            if (data.content) {
-                var data_content = JSON.parse(data.content);
-                $("#datalog").append(data.content);
-                // Measure the latency between the time when the websocket is sent and the time when it's received
-                let latency = Date.now() - data_content.time * 1000;
-                console.log("Elapsed time to get the realtime data : " + latency.toString());
-
-                // Show the latency in the dashboard
-                $("#position_latency").html(latency.toFixed(2));
-
-                // If the command is to update existing data
-                if (data_content.type === "data.update") {
-                    var numberOfRows = table.data().length;
-
-                    // Update only in the shown rows
-                    for (var i = 0; i < numberOfRows; i++) {
-                        var row = table.row(i);
-                        var data_line = row.data();
-                        if (data_line.id === data_content.id) {
-                            row.data(data_content);
-                            $(row.node()).addClass("table-success");
-                            // Remove class after 5 seconds
-                            setTimeout(function () {
-                                $(row.node()).removeClass("table-success");
-                            }, 5000);
-                            break;
-                        }
+            // Full state of orders asked after a missed version
+            if (data.command === "snapshot") {
+                data.data.forEach(function (row_data) {
+                    var row = findRow(row_data.id);
+                    if (row !== null) {
+                        row.data(row_data);
                     }
+                });
+                return;
+            }
 
-                    // Add the row to the broadcaster table
-                    let amendedRow = new_orders_table.row.add(data_content).draw();
-                    let amendedRowNode = amendedRow.node();
-                    $(amendedRowNode).addClass("table-success");
-
-                } else if (data_content.type === "data.new") {
-                    // We draw the shown results as there is no way to append a new row to existing data when
-                    // using datatable with serverside data. The draw request contacts the server to refresh the page
+            // Position in the stream of notifications of the user
+            if (data.command === "subscribe") {
+                stream_epoch = data.epoch;
+                if (data.snapshot_required) {
+                    // The missed notifications can't be replayed, reload the shown rows
                     table.draw();
-                    // We add the new orders to the boadcaster
-                    let addedRow = new_orders_table.row.add(data_content).draw();
-                    let addedRowNode = addedRow.node();
-                    $(addedRowNode).addClass("table-warning");
-
-                } else {
-                    console.log(data_content.type + "Not recognised");
                 }
+                last_seq = data.seq;
+            }
 
-            } else {
+            // Notifications dropped by the server as the connection was too slow : resubscribe to
+            // get them replayed since the last received one
+            if (data.type === "gap") {
+                subscribe(true);
+                return;
+            }
+
+            // Command acknowledgements
+            if (data.command) {
+                console.log("Command " + data.command + " : " + data.status);
+                return;
+            }
+
+            // The notifications are received as is, a single one or a list of them when they were
+            // batched or coalesced by the server
+            var notifications = Array.isArray(data) ? data : [data];
+            if (notifications.length === 0 || !notifications[0].type) {
                 console.log("Cannot handle message!");
+                return;
+            }
+            $("#datalog").append(message.data);
+            last_seq = Math.max(last_seq, notifications[notifications.length - 1].seq);
+
+            var new_data = false;
+            notifications.forEach(function (notification) {
+                new_data = handleNotification(notification) || new_data;
+            });
+
+            if (new_data) {
+                // We draw the shown results as there is no way to append a new row to existing data when
+                // using datatable with serverside data. The draw request contacts the server to refresh the page,
+                // only when a new order lands on or before the shown page
+                table.draw();
             }
         };
 
+        // Returns the shown row of the order, null if it is not shown
+        function findRow(id) {
+            var numberOfRows = table.data().length;
+            for (var i = 0; i < numberOfRows; i++) {
+                var row = table.row(i);
+                if (row.data().id === id) {
+                    return row;
+                }
+            }
+            return null;
+        }
+
+        // Applies a notification, returns true if the table needs to be drawn again
+        function handleNotification(data_content) {
+            // Measure the latency between the time when the websocket is sent and the time when it's received
+            let latency = Date.now() - data_content.time * 1000;
+            console.log("Elapsed time to get the realtime data : " + latency.toString());
+
+            // Show the latency in the dashboard
+            $("#position_latency").html(latency.toFixed(2));
+
+            // If the command is to update existing data
+            if (data_content.type === "data.update") {
+                var row = findRow(data_content.id);
+
+                // Update only in the shown rows
+                if (row !== null) {
+                    var data_line = row.data();
+                    if (data_content.version <= data_line.version) {
+                        // Older than the shown data, received out of order
+                        return false;
+                    }
+                    // A delta merged by the server applies on the version of its oldest part
+                    var base_version = data_content.base_version !== undefined ?
+                        data_content.base_version : data_content.version - 1;
+                    if (base_version > data_line.version) {
+                        // Missed version, the delta can't be applied : ask for the full row
+                        socket.send(JSON.stringify({
+                            "command": "snapshot",
+                            "ids": [data_content.id]
+                        }));
+                    } else {
+                        // Apply the changed fields
+                        row.data(Object.assign({}, data_line, data_content));
+                    }
+                    $(row.node()).addClass("table-success");
+                    // Remove class after 5 seconds
+                    setTimeout(function () {
+                        $(row.node()).removeClass("table-success");
+                    }, 5000);
+                }
+
+                // Add the row to the broadcaster table
+                let amendedRow = new_orders_table.row.add(data_content).draw();
+                let amendedRowNode = amendedRow.node();
+                $(amendedRowNode).addClass("table-success");
+
+            } else if (data_content.type === "data.new") {
+                // We add the new orders to the boadcaster
+                let addedRow = new_orders_table.row.add(data_content).draw();
+                let addedRowNode = addedRow.node();
+                $(addedRowNode).addClass("table-warning");
+                // The server tells where the order lands in the shown table (see sendView), the page only
+                // changes when it lands on it or before it
+                if (data_content.position === undefined) {
+                    return true;
+                }
+                return data_content.position !== null && data_content.position < table.page.info().end;
+
+            } else {
+                console.log(data_content.type + "Not recognised");
+            }
+            return false;
+        }
+
         // Realtime button to subscribe or not to realtime data
         $("#realtime").click(function () {
             var realtime = $(this).attr("data-realtime-active");
@@ -92,16 +181,51 @@ $(document).ready(function () {
                 console.log("Realtime Activation");
                 $(this).removeClass("btn-secondary");
                 $(this).addClass("btn-success");
-                socket.send(JSON.stringify({
-                    "command": "subscribe"
-                }));
+                subscribe(false);
                 $(this).attr("data-realtime-active", "True");
             }
         });
 
-        // Helpful debugging
+        // Subscribes to the realtime data, asking for the notifications missed since the last
+        // received one when resuming after a reconnection
+        function subscribe(resume) {
+            var command = {
+                "command": "subscribe",
+                "flush_interval": FLUSH_INTERVAL
+            };
+            if (resume && stream_epoch !== null) {
+                command.since = last_seq;
+                command.epoch = stream_epoch;
+            }
+            socket.send(JSON.stringify(command));
+        }
+
+        // Describes the shown page to the server, which locates the new orders in it
+        function sendView() {
+            if (socket.readyState !== WebSocket.OPEN) {
+                return;
+            }
+            var info = table.page.info();
+            socket.send(JSON.stringify({
+                "command": "view",
+                "order": table.order().map(function (order) {
+                    return [table.column(order[0]).dataSrc(), order[1]];
+                }),
+                "search": table.search(),
+                "start": info.start,
+                "length": info.length
+            }));
+        }
+
+        table.on("draw", sendView);
+
         socket.onopen = function () {
             console.log("Connected to realtime socket");
+            sendView();
+            // The subscription is lost with the connection
+            if ($("#realtime").attr("data-realtime-active") == "True") {
+                subscribe(true);
+            }
         };
         socket.onclose = function () {
             console.log("Disconnected from realtime socket");
@@ -2,9 +2,8 @@ from django.urls import path
 
 from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-
-from generic.consumers import DataConsumer
+from generic.auth import DataAuthMiddlewareStack
+from generic.consumers import DataConsumer, MarketDataConsumer
 
 
 # The channel routing defines what connections get handled by what consumers,
@@ -16,10 +15,12 @@ application = ProtocolTypeRouter({
     # Channels will do this for you automatically. It's included here as an example.
     # "http": AsgiHandler,
 
-    "websocket": AuthMiddlewareStack(
+    # The users are resolved from a ticket, a token or the session, and cached (see generic/auth.py)
+    "websocket": DataAuthMiddlewareStack(
         URLRouter([
             # URLRouter just takes standard Django path() or url() entries.
             path("data/stream/", DataConsumer),
+            path("market/stream/", MarketDataConsumer),
         ]),
     ),
 
@@ -19,6 +19,12 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # Channels Settings
 
 redis_host = os.environ.get('REDIS_HOST', 'localhost')
+# Several Redis instances sharing the groups, as "host:port,host:port"
+redis_hosts = [
+    (host, int(port or 6379))
+    for host, _, port in (entry.strip().partition(':') for entry in os.environ.get('REDIS_HOSTS', '').split(','))
+    if host
+]
 
 # Channel layer definitions
 # http://channels.readthedocs.io/en/latest/topics/channel_layers.html
@@ -31,6 +37,22 @@ CHANNEL_LAYERS = {
         },
     },
 }
+if redis_hosts:
+    # The groups of each user on one of the hosts, by consistent hashing (see generic/layers.py)
+    CHANNEL_LAYERS["default"] = {
+        "BACKEND": "generic.layers.ShardedRedisChannelLayer",
+        "CONFIG": {
+            "hosts": redis_hosts,
+        },
+    }
+if os.environ.get('HYBRID_CHANNEL_LAYER') == 'on':
+    # Delivers to the consumers of the same process without Redis (see generic/layers.py)
+    CHANNEL_LAYERS["default"] = {
+        "BACKEND": "generic.layers.HybridChannelLayer",
+        "CONFIG": {
+            "remote": CHANNEL_LAYERS["default"],
+        },
+    }
 
 # ASGI_APPLICATION should be set to your outermost router
 ASGI_APPLICATION = 'webapp.routing.application'
@@ -38,6 +60,109 @@ ASGI_APPLICATION = 'webapp.routing.application'
 
 # Project Settings
 
+# Websocket notifications dispatch (see generic/dispatch.py)
+DATA_DISPATCH = {
+    # Send the notifications from a background thread instead of the writing thread
+    "BACKGROUND": True,
+    # Maximum number of notifications waiting to be sent
+    "MAX_QUEUE_SIZE": 10000,
+    # What to do when the queue is full : "drop", "block" or "coalesce" (updates of the same order)
+    "POLICY": "block",
+    # Seconds a writer waits for room in the queue before the notification is dropped
+    "BLOCK_TIMEOUT": 1.0,
+    # Also send each notification to the group of its instrument, for the connections subscribed to some
+    # instruments. Off, these connections filter the notifications of the group of the user
+    "INSTRUMENT_GROUPS": False,
+}
+
+# Notifications replay buffer used by the reconnecting clients (see generic/streams.py)
+DATA_REPLAY = {
+    # The memory buffer needs the writers and the websocket consumers to run in the same process
+    "BACKEND": "generic.streams.MemoryReplayBuffer",
+    # Number of notifications kept per user
+    "SIZE": 1000,
+}
+
+# Websocket data stream (see generic/consumers.py)
+DATA_STREAM = {
+    # Default coalescing window of the updates sent to a connection in milliseconds (0 sends them immediately)
+    "FLUSH_INTERVAL": 0,
+    # Maximum coalescing window a client can ask for through the subscribe command, in milliseconds
+    "MAX_FLUSH_INTERVAL": 1000,
+    # Number of pending orders of a connection that triggers a flush before the end of the window
+    "MAX_PENDING": 1000,
+    # Window between two P&L frames sent to the connections subscribed with the "pnl" option, in milliseconds
+    "PNL_INTERVAL": 500,
+    # Notifications waiting to be sent to a connection before it is handled as slow, above the DATA_REPLAY SIZE
+    "HIGH_WATER_MARK": 2000,
+    # Notifications left waiting under which a slow connection is caught up
+    "LOW_WATER_MARK": 100,
+    # What to do with a slow connection : "conflate" to the latest state of each order, "gap" (drop and tell the
+    # client to resync) or "disconnect"
+    "SLOW_POLICY": "conflate",
+}
+
+# Source of the websocket notifications (see generic/changefeed.py) : the saves of the models ("save"), or the
+# PostgreSQL triggers relayed by the listen_changes command ("notify")
+DATA_CHANGE_FEED = {
+    "MODE": os.environ.get('DATA_CHANGE_FEED', 'save'),
+}
+
+# Counts of the datatables pages of the data list API (see generic/pagination.py)
+DATA_PAGINATION = {
+    # "exact", "cached" (per user, for COUNT_TIMEOUT seconds) or "estimate" (PostgreSQL planner estimate)
+    "COUNT": "exact",
+    "COUNT_TIMEOUT": 30,
+}
+
+# Cache of the pages of the data list API, invalidated on the writes (see generic/caching.py)
+DATA_LIST_CACHE = {
+    "ENABLED": True,
+    # Alias of the cache in CACHES, use a shared backend (Redis) when running several processes
+    "CACHE": "data_list",
+    # Seconds a page is kept
+    "TIMEOUT": 30,
+}
+
+# SQLite profile : WAL journal, busy timeout and batched inserts of the orders (see generic/sqlite.py)
+DATA_SQLITE = {
+    "ENABLED": os.environ.get('DATA_SQLITE_PROFILE', '') == 'on',
+    # Milliseconds the writer thread waits for more orders to insert in the same transaction (0 disables the batching)
+    "BATCH_WINDOW": 5,
+    "MAX_BATCH": 500,
+}
+
+# Metrics of the process exposed on /metrics (see generic/metrics.py)
+DATA_METRICS = {
+    # Bearer token the scrapers have to send, only the staff users are allowed when it is not set
+    "TOKEN": os.environ.get('METRICS_TOKEN'),
+}
+
+# Logging of the notification hot path (see generic/log.py)
+DATA_LOGGING = {
+    # One per-message event (save, notification received by a consumer) logged in SAMPLE_RATE
+    "SAMPLE_RATE": 100,
+}
+
+# Authentication of the websocket handshakes by ticket, token or session, with a user cache (see generic/auth.py)
+DATA_WEBSOCKET_AUTH = {
+    # Seconds a ticket issued by /api/ws-ticket/ is valid
+    "TICKET_MAX_AGE": 60,
+    # Users kept in the process cache, and seconds they are kept
+    "CACHE_SIZE": 10000,
+    "CACHE_TTL": 60,
+}
+
+# Market data served over the websockets (see generic/market.py)
+MARKET_DATA = {
+    # Source of the ticks, the synthetic one generates random prices
+    "SOURCE": "generic.market.SyntheticTickSource",
+    "OPTIONS": {"instruments": 1000, "rate": 10000},
+    # Default conflation window of the prices sent to a connection in milliseconds
+    "FLUSH_INTERVAL": 100,
+    # Maximum number of instruments a connection can subscribe to
+    "MAX_INSTRUMENTS": 10000,
+}
 
 
 # Django Settings
@@ -96,14 +221,44 @@ TEMPLATES = [
 WSGI_APPLICATION = 'webapp.wsgi.application'
 
 
+# Cache
+# https://docs.djangoproject.com/en/dev/topics/cache/
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'data_list': {
+        # The least recently used pages are evicted beyond MAX_ENTRIES
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'data_list',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
 # Database
 # https://docs.djangoproject.com/en/dev/ref/settings/#databases
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# SQLite by default, PostgreSQL (needs psycopg2) with DATABASE_ENGINE=postgresql
+if os.environ.get('DATABASE_ENGINE') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'datastream'),
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Persistent connections, not a pool : each worker thread keeps its own connection open for
+            # CONN_MAX_AGE seconds between its requests. Sharing them needs an external pooler (pgbouncer)
+            'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 60)),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        }
     }
-}
 
 
 # Password validation
@@ -141,26 +296,25 @@ LOGGING = {
         },
     },
     "handlers": {
-        "console": {
+        # The console and the file are written by a listener thread (see generic/log.py)
+        "queue": {
             "level": "DEBUG",
-            "class": "logging.StreamHandler",
+            "class": "generic.log.QueueHandler",
+            "targets": [
+                {"class": "logging.StreamHandler"},
+                {"class": "logging.FileHandler", "filename": "debug.log"},
+            ],
             "formatter": "standard",
         },
-        "file": {
-            "level": "DEBUG",
-            "class": "logging.FileHandler",
-            "filename": "debug.log",
-            "formatter": "standard",
-        }
     },
     "loggers": {
         "webapp": {
-            "handlers": ["console", "file"],
+            "handlers": ["queue"],
             "level": "INFO",
             "propagate": True,
         },
         "generic": {
-            "handlers": ["console", "file"],
+            "handlers": ["queue"],
             "level": "INFO",
             "propagate": True,
         }
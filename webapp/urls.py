@@ -1,7 +1,7 @@
 from django.urls import path, include
 from django.contrib import admin
 from django.contrib.auth.views import LoginView, LogoutView
-from generic.views import index
+from generic.views import channels_health, index, metrics
 from generic.api_urls import router as data_router
 from . import routers
 
@@ -18,4 +18,6 @@ urlpatterns = [
     path('accounts/logout/', LogoutView.as_view(template_name='registration/logged_out.html'), name="logout"),
     path('admin/', admin.site.urls),
     path('api/', include(router.urls)),
+    path('metrics', metrics, name="metrics"),
+    path('health/channels', channels_health, name="channels-health"),
 ]
\ No newline at end of file